@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+""" Build benchmark, over a synthetic site.
+
+Generates a scratch copy of the build (this directory's scripts, Makefile,
+templates and stylesheets) whose pages/ holds a synthetic blog: a home page
+listing every post, an about page, and `--pages` posts, each with the given
+number of images, code blocks, tex equations and references to other posts
+(get_srcinfo + onsite_link). The scratch tree is its own git repository, with
+a PUBLISH commit, as extract_git.py expects.
+
+The site is then built three times, and each build is timed:
+
+    cold    from an empty build directory
+    warm    again, with nothing changed
+    edit    after changing the text of one post
+
+    ./bench.py [--pages N] [--images N] [--code N] [--equations N] [--refs N]
+               [--builder make|site] [-j JOBS] [--scratch DIR] [--stub-fonts]
+               [--output results.json]
+
+The results are printed (or written to --output) as JSON, for tracking
+regressions. --stub-fonts replaces the webfont stylesheets with stubs, for
+machines without the font toolchain (fontforge, webify, woff2).
+
+    ./bench.py --startup [--budget SECONDS] [--output results.json]
+
+instead times how long each of STARTUP_STEPS takes to import, in a fresh
+interpreter, as it does for every target Make builds. It fails if any takes
+longer than the budget, or imports one of HEAVY_MODULES (which page_info
+leaves to page_render and media_info, to be imported on demand).
+"""
+import argparse, glob, json, os, platform, random, shutil, subprocess, sys, time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+# What the scratch build needs from this directory, besides the pages
+COPIED = ["*.py", "*.js", "Makefile", "config.json", "templates"]
+# Real pages used as-is by the synthetic site
+COPIED_PAGES = ["css", "fonts"]
+# Build steps run once per target, and their startup budget (median seconds to import)
+STARTUP_STEPS = ["extract_build", "extract_rtdeps", "extract_srcdeps", "build_page"]
+STARTUP_BUDGET = 0.05
+HEAVY_MODULES = ["jinja2", "PIL", "pygments", "joblib", "dateutil", "xml.etree.ElementTree"]
+STARTUP_PROBE = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, imported=sorted(set(sys.modules) - before))))
+"""
+GIT_ENV = dict(GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@localhost",
+    GIT_COMMITTER_NAME="bench", GIT_COMMITTER_EMAIL="bench@localhost")
+
+WORDS = ("state machine variant compiler sine polynomial backup bucket laptop "
+    "display firmware render template cache graph vector kernel signal").split()
+
+POST_TEMPLATE = """{{% from 'base.html' import heading, onsite_link, show_image, multiline_code %}}
+{{% extends 'blog_entry.html' %}}
+{{% set page_info.title = "{title}" %}}
+
+{images}
+{refs}
+
+{{% block entry_content %}}
+{body}
+{{% endblock %}}
+"""
+
+INDEX_TEMPLATE = """{{% extends 'base.html' %}}
+
+{{% set page_info.page_type = HomePage %}}
+{{% set page_info.title = "Benchmark site" %}}
+
+{{% set articles = [
+{articles}
+] %}}
+
+{{% block page_content %}}
+{{% for entry in articles %}}
+{{{{ heading(entry.title, link_to=entry.build_path, show_icon=False, sublevel=1, class="title") }}}}
+{{% endfor %}}
+{{% endblock %}}
+"""
+
+ABOUT_TEMPLATE = """{% set page_info.page_type = AboutPage %}
+{% set page_info.title = "About the benchmark site" %}
+
+{% from 'base.html' import heading %}
+
+{% extends 'base.html' %}
+
+{% block page_content %}
+{{ heading("About this Website") }}
+<p>A synthetic site, generated by bench.py.</p>
+{{ heading("License / Attributions") }}
+<p>Public domain.</p>
+{% endblock %}
+"""
+
+STUB_FONTS_CSS = """/* Webfonts stubbed out by bench.py --stub-fonts */
+.fa { display: inline-block; font-style: normal; }
+"""
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def paragraph(rng, sentences=5):
+    return "<p>\n%s\n</p>" %" ".join(sentence(rng) for _ in range(sentences))
+
+def code_block(rng, n):
+    lines = ["def %s_%d(x):" %(rng.choice(WORDS), n)]
+    lines += ["    x = x * %d + %d  # %s" %(rng.randint(2, 9), i, rng.choice(WORDS)) for i in range(8)]
+    lines.append("    return x")
+    return '{{ multiline_code("""\n%s\n""", "python") }}' %"\n".join(lines)
+
+def write_image(path, rng, size=(1200, 800)):
+    """Write a PNG that compresses about as well as a screenshot would"""
+    import PIL.Image, PIL.ImageDraw
+    im = PIL.Image.new("RGB", size, (255, 255, 255))
+    draw = PIL.ImageDraw.Draw(im)
+    for _ in range(60):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x, y, x + rng.randrange(20, 300), y + rng.randrange(10, 120)], fill=color)
+    im.save(path, "PNG")
+
+def post_name(i):
+    return "post-%d" %i
+
+def generate_post(pages_dir, i, args, rng):
+    post_dir = os.path.join(pages_dir, post_name(i))
+    os.makedirs(post_dir, exist_ok=True)
+    images, body = [], []
+    for k in range(args.images):
+        name = "image-%d.png" %k
+        write_image(os.path.join(post_dir, name), rng)
+        images.append('{%% set image%d = get_image("%s") %%}' %(k, name))
+    refs = []
+    targets = [(i - k) % args.pages for k in range(1, args.refs + 1) if (i - k) % args.pages != i]
+    for k, j in enumerate(targets):
+        refs.append("{%% set ref%d = get_srcinfo('../%s/index.html') %%}" %(k, post_name(j)))
+    sections = max(args.images, args.code, args.equations, args.refs, 1)
+    for s in range(sections):
+        body.append('{{ heading("Section %d") }}' %s)
+        body.append(paragraph(rng))
+        if s < args.equations:
+            body.append('<p>With {{ "x^{%d} + \\\\frac{%d}{y}"|tex }}, %s</p>' %(i, s, sentence(rng)))
+        if s < args.code:
+            body.append(code_block(rng, s))
+        if s < args.images:
+            body.append('{{ show_image(image%d) }}' %s)
+        if s < len(targets):
+            body.append('<p>See also {{ onsite_link("%s/index.html"|path_from_root, ref%d.title) }}.</p>'
+                %(post_name(targets[s]), s))
+    with open(os.path.join(post_dir, "index.html.jinja.html"), "w") as f:
+        f.write(POST_TEMPLATE.format(title="Post %d: %s" %(i, sentence(rng, 4)[:-1]),
+            images="\n".join(images), refs="\n".join(refs), body="\n\n".join(body)))
+
+def generate(scratch, args):
+    """Create the scratch tree at `scratch`, with a synthetic pages/"""
+    if os.path.exists(scratch):
+        shutil.rmtree(scratch)
+    src = os.path.join(scratch, "src")
+    os.makedirs(src)
+    for pattern in COPIED:
+        for path in glob.glob(os.path.join(SRC_DIR, pattern)):
+            if os.path.abspath(path) == os.path.abspath(__file__):
+                continue
+            dest = os.path.join(src, os.path.basename(path))
+            (shutil.copytree if os.path.isdir(path) else shutil.copy2)(path, dest)
+    node_modules = os.path.join(SRC_DIR, "..", "node_modules")
+    if os.path.isdir(node_modules):
+        os.symlink(os.path.abspath(node_modules), os.path.join(scratch, "node_modules"))
+    pages = os.path.join(src, "pages")
+    os.makedirs(pages)
+    for name in COPIED_PAGES:
+        if os.path.exists(os.path.join(SRC_DIR, "pages", name)):
+            shutil.copytree(os.path.join(SRC_DIR, "pages", name), os.path.join(pages, name))
+    if args.stub_fonts:
+        shutil.rmtree(os.path.join(pages, "fonts"), ignore_errors=True)
+        for name in ("fonts.css.jinja.css", "font-awesome.css.jinja.css"):
+            with open(os.path.join(pages, "css", name), "w") as f:
+                f.write(STUB_FONTS_CSS)
+
+    rng = random.Random(args.seed)
+    for i in range(args.pages):
+        generate_post(pages, i, args, rng)
+    with open(os.path.join(pages, "index.html.jinja.html"), "w") as f:
+        f.write(INDEX_TEMPLATE.format(articles=",\n".join(
+            "\tget_srcinfo('%s/index.html')" %post_name(i) for i in range(args.pages))))
+    os.makedirs(os.path.join(pages, "about"))
+    with open(os.path.join(pages, "about", "index.html.jinja.html"), "w") as f:
+        f.write(ABOUT_TEMPLATE)
+
+    # extract_git.py dates pages by their commits: posts are published when
+    # a commit with the message "PUBLISH" touches them
+    env = dict(os.environ, **GIT_ENV)
+    for cmd in (["init", "-q"], ["add", "-A", "--", ".", ":(exclude)src/pages"], ["commit", "-q", "-m", "Generate site"],
+            ["add", "-A"], ["commit", "-q", "-m", "PUBLISH"]):
+        subprocess.check_call(["git"] + cmd, cwd=scratch, env=env)
+
+    # Stand in for `ipfs id`, which the Makefile uses to make the config
+    build = os.path.join(scratch, "build")
+    os.makedirs(build)
+    with open(os.path.join(build, "mooooo.ipnsid"), "w") as f:
+        f.write("bench")
+    subprocess.check_call(["make", "-s", os.path.join(build, "config.json")], cwd=src)
+
+def clean(scratch):
+    """Remove everything the build produced, but not its config"""
+    build = os.path.join(scratch, "build")
+    for name in os.listdir(build):
+        if name not in ("mooooo.ipnsid", "config.json"):
+            path = os.path.join(build, name)
+            (shutil.rmtree if os.path.isdir(path) else os.remove)(path)
+
+def build_command(args):
+    if args.builder == "make":
+        return ["make", "-j%d" %args.jobs, "all"]
+    return ["./build_site.py", "-j", str(args.jobs)]
+
+def timed_build(scratch, args, label):
+    """Run a build of the scratch site, returning its wall time in seconds"""
+    print("%s build..." %label, file=sys.stderr, flush=True)
+    start = time.time()
+    proc = subprocess.run(build_command(args), cwd=os.path.join(scratch, "src"),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.time() - start
+    if proc.returncode:
+        sys.stderr.write(proc.stdout.decode(errors="replace")[-4000:])
+        raise RuntimeError("%s build failed (exit status %d)" %(label, proc.returncode))
+    print("%s build: %.2fs" %(label, elapsed), file=sys.stderr, flush=True)
+    return elapsed
+
+def edit_post(scratch):
+    """Change the text of one post, as an author would"""
+    path = os.path.join(scratch, "src", "pages", post_name(0), "index.html.jinja.html")
+    content = open(path).read()
+    marker = "{% endblock %}"
+    with open(path, "w") as f:
+        f.write(content.replace(marker, "<p>Edited by bench.py at %f.</p>\n%s" %(time.time(), marker), 1))
+
+def output_stats(scratch):
+    files = [p for p in glob.glob(os.path.join(scratch, "build", "output", "**"), recursive=True) if os.path.isfile(p)]
+    return len(files), sum(os.path.getsize(p) for p in files)
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=SRC_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    scratch = os.path.abspath(args.scratch)
+    generate(scratch, args)
+    clean(scratch)
+    timings = dict(cold=timed_build(scratch, args, "cold"))
+    timings["warm"] = timed_build(scratch, args, "warm")
+    edit_post(scratch)
+    timings["edit"] = timed_build(scratch, args, "edit")
+    num_files, num_bytes = output_stats(scratch)
+    return dict(
+        params=dict(pages=args.pages, images=args.images, code=args.code, equations=args.equations,
+            refs=args.refs, seed=args.seed, stub_fonts=args.stub_fonts),
+        builder=args.builder,
+        jobs=args.jobs,
+        commit=get_commit(),
+        python=platform.python_version(),
+        timestamp=time.time(),
+        timings=timings,
+        output_files=num_files,
+        output_bytes=num_bytes,
+    )
+
+def time_startup(module, repeat):
+    """Return (median seconds to import `module`, the HEAVY_MODULES it imported)"""
+    times, heavy = [], set()
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", STARTUP_PROBE.format(module=module)], cwd=SRC_DIR)
+        probe = json.loads(out.decode().splitlines()[-1])
+        times.append(probe["seconds"])
+        heavy.update(m for m in HEAVY_MODULES if m in probe["imported"])
+    return sorted(times)[len(times) // 2], sorted(heavy)
+
+def run_startup(args):
+    steps = {}
+    for module in STARTUP_STEPS:
+        seconds, heavy = time_startup(module, args.repeat)
+        ok = seconds <= args.budget and not heavy
+        print("%-16s %6.1fms%s%s" %(module, seconds * 1e3, " imports " + ", ".join(heavy) if heavy else "",
+            "" if ok else "  OVER BUDGET"), file=sys.stderr)
+        steps[module] = dict(seconds=seconds, heavy_imports=heavy, ok=ok)
+    return dict(
+        budget=args.budget,
+        commit=get_commit(),
+        python=platform.python_version(),
+        timestamp=time.time(),
+        startup=steps,
+        ok=all(s["ok"] for s in steps.values()),
+    )
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Time builds of a synthetic site")
+    parser.add_argument("--pages", type=int, default=20, help="number of blog posts")
+    parser.add_argument("--images", type=int, default=2, help="images per post")
+    parser.add_argument("--code", type=int, default=2, help="code blocks per post")
+    parser.add_argument("--equations", type=int, default=2, help="tex equations per post")
+    parser.add_argument("--refs", type=int, default=2, help="references to other posts, per post")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated content")
+    parser.add_argument("--builder", choices=("make", "site"), default="make",
+        help="build with recursive make (make all) or build_site.py")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="parallel build jobs")
+    parser.add_argument("--scratch", default=os.path.join(SRC_DIR, "..", "build", "bench"),
+        help="where to generate the site (deleted first!)")
+    parser.add_argument("--stub-fonts", action="store_true", help="don't build the webfonts")
+    parser.add_argument("--output", help="write the results here, rather than to stdout")
+    parser.add_argument("--startup", action="store_true", help="time the build steps' startup instead")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET, help="startup budget, in seconds")
+    parser.add_argument("--repeat", type=int, default=5, help="times to start each step")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.startup and not os.path.exists(os.path.join(SRC_DIR, "..", "build", "config.json")):
+        print("Build the config first: make ../build/config.json", file=sys.stderr)
+        sys.exit(1)
+    try:
+        results = run_startup(args) if args.startup else run(args)
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if not results.get("ok", True):
+        sys.exit(1)
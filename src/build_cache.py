@@ -0,0 +1,232 @@
+""" Content-addressed cache of build artifacts.
+
+Make decides what to rebuild based on mtimes, so a `git checkout`, a touched
+template or a regenerated config re-runs build steps even when nothing they
+depend on actually changed. Build steps consult this cache first: an artifact
+is reused when the step's inputs hash to the same values as when it was stored.
+
+Each step is identified by a key (see step_key). For every key, the cache
+remembers the hash of each file the step read (templates, .srcinfo and .build
+objects, ...) and the hash of the artifact it produced:
+
+    <root>/manifests/<key>.json     {"deps": {path: hash}, "artifact": hash}
+    <root>/objects/<hash>           the artifact itself
+
+Every cache notes its hits and misses in <root>/lookups.jsonl (see
+count_lookup), and touches what it hands out, so that the least recently used
+entries can be evicted first (see cache_manager.py).
+"""
+import hashlib, json, mmap, os, shutil, threading
+
+def hash_bytes(data):
+    """Return the hex digest used to identify `data` throughout the cache"""
+    return hashlib.sha256(data).hexdigest()
+
+# path -> ((mtime, size), hash)
+_file_hashes = {}
+
+def hash_file(path):
+    """Return the hash of the file at `path`, or None if it doesn't exist.
+    Hashes are remembered for as long as the file's mtime and size are unchanged.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _file_hashes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        # Mapped rather than read, so large assets aren't copied into memory
+        if st.st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                h.update(data)
+    digest = h.hexdigest()
+    _file_hashes[path] = (key, digest)
+    return digest
+
+def step_key(*parts):
+    """Combine the identifying parts of a build step (strings) into a cache key"""
+    return hash_bytes("\0".join(parts).encode())
+
+# Each thread may be recording the files its current build step reads
+_recording = threading.local()
+
+class recording(object):
+    """Context manager that collects every path passed to record_dep while
+    active (in the current thread) into a set.
+
+    >>> with recording() as deps:
+    ...     record_dep("templates/base.html")
+    >>> deps
+    {"templates/base.html"}
+    """
+    def __enter__(self):
+        self.deps = set()
+        _recording.__dict__.setdefault("stack", []).append(self.deps)
+        return self.deps
+    def __exit__(self, *exc):
+        _recording.stack.pop()
+
+def record_dep(path):
+    """Note that the active build step(s) read the file at `path`"""
+    for deps in getattr(_recording, "stack", ()):
+        deps.add(path)
+
+LOOKUPS_FILE = "lookups.jsonl"
+
+def count_lookup(root, hit):
+    """Note a hit or miss of the cache stored at `root`, for cache_manager.py's stats"""
+    record = json.dumps(dict(hits=int(hit), misses=int(not hit))) + "\n"
+    try:
+        os.makedirs(root, exist_ok=True)
+        # One short append per lookup, so concurrent build steps' lines don't interleave
+        with open(os.path.join(root, LOOKUPS_FILE), "a") as f:
+            f.write(record)
+    except OSError:
+        pass
+
+def touch(path):
+    """Mark the cache entry at `path` as just used, for LRU eviction"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def write_atomic(path, data):
+    """Write `data` (bytes) to `path`, such that readers never see a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "%s.%d.%d.tmp" %(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# ioctl sharing the data of one file with another, on btrfs, XFS, ...
+FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    """Make the file `dst` share the data of `src`, if the filesystem can"""
+    try:
+        import fcntl
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
+
+def _copy_in_kernel(src, dst, size):
+    """Copy `size` bytes between the files without passing them through
+    userspace, by copy_file_range, or else sendfile"""
+    for copy in getattr(os, "copy_file_range", None), getattr(os, "sendfile", None):
+        if copy is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if copy is os.sendfile:
+                    sent = copy(dst.fileno(), src.fileno(), offset, size - offset)
+                else:
+                    sent = copy(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                if not sent:
+                    break
+                offset += sent
+            return True
+        except OSError:
+            # Unsupported across these filesystems: start over
+            dst.seek(0)
+            dst.truncate()
+    return False
+
+def copy_file(src_path, dst_path):
+    """Copy the file at `src_path` to `dst_path` (atomically, as write_atomic),
+    sharing its data (a reflink) where possible, else copying it in the kernel.
+    The copy is a new file, rather than a hard link: Make needs it to be newer
+    than what it's built from, and writes to it mustn't alter the source."""
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = "%s.%d.%d.tmp" %(dst_path, os.getpid(), threading.get_ident())
+    with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+        if not _reflink(src, dst) and not _copy_in_kernel(src, dst, os.fstat(src.fileno()).st_size):
+            shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, dst_path)
+
+class ArtifactCache(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _manifest_path(self, key):
+        return os.path.join(self.root, "manifests", key + ".json")
+
+    def _object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def lookup(self, key):
+        """Return the artifact stored under `key` if none of the files it
+        was built from have changed since, else None."""
+        artifact = self._lookup(key)
+        count_lookup(self.root, artifact is not None)
+        return artifact
+
+    def _lookup(self, key):
+        try:
+            manifest = json.loads(open(self._manifest_path(key)).read())
+        except FileNotFoundError:
+            return None
+        for path, digest in manifest["deps"].items():
+            if hash_file(path) != digest:
+                return None
+        object_path = self._object_path(manifest["artifact"])
+        try:
+            artifact = open(object_path, "rb").read()
+        except FileNotFoundError:
+            return None
+        touch(self._manifest_path(key))
+        touch(object_path)
+        # The artifact depends on the same files as when it was built
+        for path in manifest["deps"]:
+            record_dep(path)
+        return artifact
+
+    def get_deps(self, key):
+        """Return the files the artifact stored under `key` was built from, or None"""
+        try:
+            return set(json.loads(open(self._manifest_path(key)).read())["deps"])
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, deps, artifact):
+        """Remember that the step identified by `key` produced `artifact`
+        (bytes) after reading the files in `deps`."""
+        digest = hash_bytes(artifact)
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            write_atomic(object_path, artifact)
+        manifest = dict(
+            deps = {path: hash_file(path) for path in sorted(deps)},
+            artifact = digest,
+        )
+        write_atomic(self._manifest_path(key), json.dumps(manifest).encode())
+
+class BlobCache(object):
+    """Cache of bytes, keyed by a hash of whatever they were derived from
+    (e.g. the input file's content and the settings of the tool applied to it)"""
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """Return the bytes stored under `key`, or None"""
+        path = self.path(key)
+        try:
+            data = open(path, "rb").read()
+        except FileNotFoundError:
+            count_lookup(self.root, False)
+            return None
+        count_lookup(self.root, True)
+        touch(path)
+        return data
+
+    def put(self, key, data):
+        write_atomic(self.path(key), data)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+""" Thin client used by the Makefile to run a build step.
+
+If build_server.py is running, the step is handed to it. Otherwise the step's
+script is executed directly, exactly as before the server existed.
+This script deliberately imports nothing beyond the standard library, since
+it's run once per Make target.
+"""
+import glob, json, os, signal, socket, sys
+
+# Keep in sync with build_server.py
+SOCKET_PATH = "../build/build_server.sock"
+STATS_DIR = "../build/build_server"
+
+def run_locally(step, args):
+    """Replace this process with the step's own script"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), step + ".py")
+    os.execv(sys.executable, [sys.executable, script] + args)
+
+def run_step(step, args):
+    """Run a build step, preferably via the build server"""
+    # The server may have a different working directory than us
+    args = [os.path.abspath(a) for a in args]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        run_locally(step, args)
+    with sock, sock.makefile("rwb") as stream:
+        # Have the server trace the step if we were asked to (see build_trace.py)
+        trace = os.environ.get("BUILD_TRACE") and os.path.abspath(os.environ["BUILD_TRACE"])
+        stream.write((json.dumps(dict(step=step, args=args, trace=trace)) + "\n").encode())
+        stream.flush()
+        response = json.loads(stream.readline().decode())
+    if not response["ok"]:
+        sys.stderr.write(response["error"])
+        sys.exit(1)
+
+def get_stats():
+    """Return the request statistics of every running server process, summed"""
+    total = dict(workers=0, requests=0, errors=0, total_time=0.0, by_step={})
+    for path in glob.glob(os.path.join(STATS_DIR, "*.json")):
+        s = json.loads(open(path).read())
+        total["workers"] += 1
+        for key in ("requests", "errors", "total_time"):
+            total[key] += s[key]
+        for step, step_stats in s["by_step"].items():
+            entry = total["by_step"].setdefault(step, dict(count=0, total_time=0.0))
+            entry["count"] += step_stats["count"]
+            entry["total_time"] += step_stats["total_time"]
+    return total
+
+def print_stats():
+    s = get_stats()
+    print("%d worker(s) served %d requests (%d errors)" %(s["workers"], s["requests"], s["errors"]))
+    if s["requests"]:
+        print("average time per request: %.3fs" %(s["total_time"] / s["requests"]))
+    for step, step_stats in sorted(s["by_step"].items()):
+        print("  %-16s %6d requests, %.3fs/request" %(
+            step, step_stats["count"], step_stats["total_time"] / step_stats["count"]))
+
+def stop_server():
+    """Kill every running server process"""
+    for path in glob.glob(os.path.join(STATS_DIR, "*.json")):
+        pid = int(os.path.basename(path)[:-len(".json")])
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.remove(path)
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "--stats":
+        print_stats()
+    elif len(sys.argv) == 2 and sys.argv[1] == "--stop":
+        stop_server()
+    elif len(sys.argv) >= 2 and not sys.argv[1].startswith("-"):
+        run_step(sys.argv[1], sys.argv[2:])
+    else:
+        print("Usage: %s <step> [args...] | --stats | --stop" %sys.argv[0])
+        sys.exit(1)
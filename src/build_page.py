@@ -2,23 +2,60 @@
 # Requires the following pip packages:
 # python-dateutil, jinja2
 
-import sys, jsonpickle
+import functools, os, sys
 
-from page_info import Page
+import build_cache, build_store, build_trace
+from page_info import CONFIG_PATH, Page, config, get_store
+
+# The code whose changes may change what a page renders to (or how it's packed)
+CODE_FILES = ("build_page.py", "build_store.py", "critical_css.py", "highlight.py", "image_variants.py",
+    "media_info.py", "minify.py", "page_info.py", "page_render.py", "tex_render.py", "tex_worker.js")
+
+def get_artifact_cache():
+    return build_cache.ArtifactCache(os.path.join(config["build"]["cache"], "artifacts"))
+
+@functools.lru_cache(maxsize=None)
+def get_code_hash():
+    """Hash of CODE_FILES, so that artifacts built by an older version of
+    the rendering code are not reused"""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    return build_cache.step_key(*(build_cache.hash_file(os.path.join(src_dir, name)) for name in CODE_FILES))
+
+def get_key(ext, in_path):
+    """Return the artifact cache key of building the `ext` object of `in_path`"""
+    # Anything not recorded while building (see build_cache.record_dep)
+    # must be part of the key
+    return build_cache.step_key(ext, in_path, get_code_hash(),
+        build_cache.hash_file(in_path), build_cache.hash_file(CONFIG_PATH))
+
+@build_trace.step
+def main(in_path, out_path):
+    """Build the .srcinfo or .build object for `in_path`, storing it at `out_path`"""
+    ext = os.path.splitext(out_path)[1]
+    key = get_key(ext, in_path)
+    artifacts = get_artifact_cache()
+    with build_trace.span("artifact lookup", "cache") as trace:
+        packed = artifacts.lookup(key)
+        trace["cache"] = "miss" if packed is None else "hit"
+    if packed is None:
+        with build_cache.recording() as deps:
+            page = Page.from_unknown_type(src_filename=in_path)
+            if ext == ".srcinfo":
+                output = page.get_src_info()
+            elif ext == ".build":
+                output = page.get_build()
+        packed = build_store.pack(output)
+        artifacts.store(key, deps, packed)
+        # Pages rendered in full while collecting their srcinfo have their
+        # .build ready too: cache it for the .build step
+        prerendered = getattr(page, "prerendered_build", None)
+        if prerendered is not None:
+            artifacts.store(get_key(".build", in_path), deps, build_store.pack(prerendered))
+    get_store().put(out_path, packed)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print("Usage: %s <input html template> <output>" %sys.argv[0])
         sys.exit(1)
 
-    in_path, out_path = sys.argv[1:]
-
-    page = Page.from_unknown_type(src_filename=in_path)
-    if out_path.endswith(".srcinfo"):
-        output = page.get_src_info()
-    elif out_path.endswith(".build"):
-        output = page.get_build()
-    serialized = jsonpickle.encode(output)
-    out_file = open(out_path, "w+")
-    out_file.write(serialized)
-
+    main(*sys.argv[1:])
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+""" Long-lived build server.
+
+Every Make target used to be produced by a fresh ./build_page.py or
+./extract_*.py process, each of which re-imported page_info (and with it
+jinja2, PIL, pygments, ...) and re-parsed the config. This server imports all
+of that (page_info and page_render) once, keeps the decoded .srcinfo objects
+in memory (see page_info.load_info) and runs build steps on behalf of
+build_client.py.
+
+Protocol: the client connects to SOCKET_PATH and sends a single line of JSON,
+e.g. {"step": "build_page", "args": ["<in>", "<out>"]}. The server replies with
+a single line of JSON: {"ok": true} or {"ok": false, "error": "<traceback>"}.
+"""
+import contextlib, importlib, json, os, shutil, socketserver, sys, threading, time, traceback
+
+# page_render too, so that pages rendered for clients don't pay for importing jinja2 & co.
+import build_trace, page_info, page_render
+
+# Where the server listens. Relative to src/, like page_info.CONFIG_PATH
+SOCKET_PATH = "../build/build_server.sock"
+# Each server process dumps its request statistics here after every request
+STATS_DIR = "../build/build_server"
+
+# Build steps the server may run. Each is a module exposing main(*args).
+STEPS = "build_page", "extract_build", "extract_git", "extract_rtdeps", "extract_srcdeps", "image_variants", "compress", "font_subset"
+
+class Stats(object):
+    """Bookkeeping of how many requests were served, and how long they took"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        # step name -> [count, total seconds]
+        self.by_step = {}
+
+    def record(self, step, elapsed, ok):
+        with self.lock:
+            self.requests += 1
+            self.total_time += elapsed
+            if not ok:
+                self.errors += 1
+            entry = self.by_step.setdefault(step, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def as_dict(self):
+        with self.lock:
+            return dict(
+                pid = os.getpid(),
+                uptime = time.time() - self.started,
+                requests = self.requests,
+                errors = self.errors,
+                total_time = self.total_time,
+                by_step = {k: dict(count=v[0], total_time=v[1]) for k, v in self.by_step.items()},
+            )
+
+    def dump(self):
+        serialized = json.dumps(self.as_dict())
+        os.makedirs(STATS_DIR, exist_ok=True)
+        path = os.path.join(STATS_DIR, "%d.json" %os.getpid())
+        tmp_path = "%s.%d.tmp" %(path, threading.get_ident())
+        with open(tmp_path, "w+") as f:
+            f.write(serialized)
+        os.replace(tmp_path, path)
+
+stats = Stats()
+_config_mtime = os.stat(page_info.CONFIG_PATH).st_mtime_ns
+# Guards _in_flight, the number of requests being run by this process
+_requests = threading.Condition()
+_in_flight = 0
+
+@contextlib.contextmanager
+def serving_request():
+    """Count a request as in flight while it runs.
+    If $(CONFIG_JSON) was regenerated since we loaded it, the config is re-read
+    first, once no request is in flight: the dict is updated in place, since
+    the build steps hold references to it, so it must not change under a
+    request that's rendering. Requests arriving meanwhile wait too.
+    """
+    global _config_mtime, _in_flight
+    with _requests:
+        mtime = os.stat(page_info.CONFIG_PATH).st_mtime_ns
+        if mtime != _config_mtime:
+            _requests.wait_for(lambda: _in_flight == 0)
+            config = page_info.load_config()
+            page_info.config.clear()
+            page_info.config.update(config)
+            _config_mtime = mtime
+        _in_flight += 1
+    try:
+        yield
+    finally:
+        with _requests:
+            _in_flight -= 1
+            _requests.notify_all()
+
+def run_step(step, args):
+    """Run build step `step` (one of STEPS) with the given arguments"""
+    if step not in STEPS:
+        raise ValueError("unknown build step: %r" %step)
+    with serving_request():
+        importlib.import_module(step).main(*args)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        step, args = request["step"], request["args"]
+        start = time.time()
+        try:
+            with build_trace.tracing_to(request.get("trace")):
+                run_step(step, args)
+            response = dict(ok=True)
+        except Exception:
+            response = dict(ok=False, error=traceback.format_exc())
+        elapsed = time.time() - start
+        stats.record(step, elapsed, response["ok"])
+        stats.dump()
+        print("%s %s (%.3fs)" %(step, " ".join(args), elapsed), flush=True)
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(num_workers=1):
+    """Listen on SOCKET_PATH until killed.
+    With num_workers > 1, that many processes share the listening socket so
+    that a `make -j` build can use more than one core.
+    """
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    shutil.rmtree(STATS_DIR, ignore_errors=True)
+    server = BuildServer(SOCKET_PATH, RequestHandler)
+    for _ in range(num_workers - 1):
+        if os.fork() == 0:
+            break
+    print("build server %d listening on %s" %(os.getpid(), SOCKET_PATH), flush=True)
+    stats.dump()
+    server.serve_forever()
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (1, 2):
+        print("Usage: %s [num workers]" %sys.argv[0])
+        sys.exit(1)
+    serve(int(sys.argv[1]) if len(sys.argv) == 2 else os.cpu_count())
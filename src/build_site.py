@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+""" Build the site without recursive Make.
+
+The Makefile discovers dependencies by generating .srcdeps/.rtdeps/.alldeps
+fragments and re-entering $(MAKE) for each of them. This script implements
+the same rules, but holds the dependency graph in memory: the srcdeps and
+rtdeps are read straight from the .srcinfo/.build objects as soon as they're
+built, and independent targets are run in parallel across a process pool.
+
+    ./build_site.py [-j <jobs>] [--subsite <folder>] [target ...]
+
+Without targets, this builds the same files as `make all`: the output of
+DEFAULT_TARGET plus everything it (transitively) needs at runtime. With
+--subsite, as `make all SUBSITE=<folder>`: only <folder>/index.html and what
+it needs, keeping the site's font subsets as they are.
+"""
+import asyncio, concurrent.futures, importlib, multiprocessing, os, subprocess, sys, traceback
+
+import build_cache, build_trace, compress, font_subset, image_variants, optimize_images
+from page_info import CONFIG_PATH, config, load_info
+
+DEFAULT_TARGET = "index.html"
+# Sources, relative to src/ as in the Makefile
+PAGES_DIR = "pages"
+IMAGE_EXTENSIONS = tuple(optimize_images.OPTIMIZERS)
+
+class BuildError(Exception):
+    pass
+
+def run_action(action, args):
+    """Run a build action in a worker process. Actions are build steps
+    (modules exposing main(*args)) or one of the Makefile's shell recipes."""
+    if action not in ("copy", "shell"):
+        # Build steps trace themselves
+        return _run_action(action, args)
+    with build_trace.span(action, "step", target=args[-1], args=list(args)):
+        _run_action(action, args)
+
+def _run_action(action, args):
+    if action == "copy":
+        build_cache.copy_file(*args)
+    elif action == "optimize":
+        src, dst = args
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        optimize_images.optimize(src, dst, config["build"]["cache"])
+    elif action == "shell":
+        subprocess.check_call(args)
+    else:
+        importlib.import_module(action).main(*args)
+
+class Rule(object):
+    """How to build a target: its (static) prerequisites and the action to run.
+    `dynamic` rules learn the rest of their prerequisites from a .srcinfo."""
+    def __init__(self, prereqs, action, args, dynamic=False):
+        self.prereqs = prereqs
+        self.action = action
+        self.args = args
+        self.dynamic = dynamic
+
+class Builder(object):
+    def __init__(self, executor):
+        self.executor = executor
+        self.intermediate = config["build"]["intermediate"]
+        self.output = config["build"]["output"]
+        self.cache = config["build"]["cache"]
+        self.config_path = os.path.abspath(CONFIG_PATH)
+        # target -> asyncio.Task building it
+        self.tasks = {}
+        # target -> targets it's currently waiting on (for cycle detection)
+        self.waiting = {}
+        # target -> all its prerequisites, including those learnt from a .srcinfo
+        self.prereqs = {}
+        # target -> (action, args) building it
+        self.steps = {}
+        self.published = set()
+        self.compress_formats = compress.get_formats()
+
+    def get_rule(self, target):
+        """Return the Rule for `target`, mirroring the Makefile's pattern rules,
+        or None for source files."""
+        I, O, C = self.intermediate + "/", self.output + "/", self.cache + "/"
+        if target.startswith(O):
+            base, ext = os.path.splitext(target)
+            if ext in (".gz", ".br") and os.path.splitext(base)[1] in compress.TEXT_EXTENSIONS:
+                return Rule([base], "compress", None)
+            # Files to be published are copied from the intermediate folder
+            return Rule([I + target[len(O):]], "copy", None)
+        if target.startswith(I):
+            rel = target[len(I):]
+            for ext in (".html", ".css"):
+                jinja = ".jinja" + ext
+                if rel.endswith(ext + jinja):
+                    return Rule([os.path.join(PAGES_DIR, rel)], "copy", None)
+                if rel.endswith(jinja + ".srcinfo"):
+                    src = os.path.join(PAGES_DIR, rel[:-len(".srcinfo")])
+                    return Rule([src, self.config_path], "extract_git", [src, target])
+                if rel.endswith(ext + ".srcinfo") and \
+                        os.path.exists(os.path.join(PAGES_DIR, rel[:-len(".srcinfo")] + jinja)):
+                    src = target[:-len(".srcinfo")] + jinja
+                    return Rule([src, src + ".srcinfo", self.config_path], "build_page", [src, target])
+            if rel.endswith(".srcinfo"):
+                src = target[:-len(".srcinfo")] + ".src.bin"
+                return Rule([src], "build_page", [src, target])
+            if rel.endswith(".src.bin"):
+                return Rule([C + rel[:-len(".src.bin")]], "copy", None)
+            if rel.endswith(".build"):
+                # The source and srcdeps are only known once the .srcinfo is built
+                return Rule([target[:-len(".build")] + ".srcinfo"], "build_page", None, dynamic=True)
+            return Rule([target + ".build"], "extract_build", [target + ".build", target])
+        if target.startswith(C):
+            rel = target[len(C):]
+            base, ext = os.path.splitext(target)
+            src = os.path.join(PAGES_DIR, rel)
+            if os.path.exists(src):
+                return Rule([src], "optimize" if ext in IMAGE_EXTENSIONS else "copy", None)
+            variant = image_variants.parse_variant(target)
+            if variant is not None:
+                return Rule([variant[0]], "image_variants", None)
+            if target.endswith(".subset.ttf"):
+                usage = font_subset.usage_path()
+                prereqs = [target[:-len(".subset.ttf")] + ".ttf"]
+                return Rule(prereqs + ([usage] if os.path.exists(usage) else []), "font_subset", None)
+            if ext == ".ttf":
+                return Rule([base + ".otf"], "shell", ["fontforge", "-c",
+                    'import fontforge; font = fontforge.open("%s"); font.generate("%s")' %(base + ".otf", target)])
+            if ext in (".woff", ".eot", ".svg"):
+                return Rule([base + ".ttf"], "shell", ["webify", base + ".ttf"])
+            if ext == ".woff2":
+                return Rule([base + ".ttf"], "shell", ["woff2_compress", base + ".ttf"])
+            if ext == ".png":
+                return Rule([base + ".svg"], "shell", ["convert", base + ".svg", target])
+        return None
+
+    def _reaches(self, start, goal):
+        """Whether `start` is (transitively) waiting on `goal`"""
+        stack, seen = [start], set()
+        while stack:
+            t = stack.pop()
+            if t == goal:
+                return True
+            if t not in seen:
+                seen.add(t)
+                stack.extend(self.waiting.get(t, ()))
+        return False
+
+    async def ensure_all(self, targets, requester=None):
+        """Bring all of `targets` up to date, in parallel"""
+        targets = list(targets)
+        if requester is not None:
+            for t in targets:
+                if self._reaches(t, requester):
+                    raise BuildError("circular dependency: %s <- %s" %(requester, t))
+            self.waiting[requester] = set(targets)
+        for t in targets:
+            if t not in self.tasks:
+                self.tasks[t] = asyncio.ensure_future(self._build(t))
+        try:
+            await asyncio.gather(*(self.tasks[t] for t in targets))
+        finally:
+            if requester is not None:
+                self.waiting.pop(requester, None)
+
+    async def _build(self, target):
+        rule = self.get_rule(target)
+        if rule is None:
+            if not os.path.exists(target):
+                raise BuildError("no rule to make target %s" %target)
+            return
+        await self.ensure_all(rule.prereqs, requester=target)
+        prereqs, args = rule.prereqs, rule.args or [rule.prereqs[0], target]
+        if rule.dynamic:
+            # The .srcdeps fragment: .build depends on each srcdep and the source
+            info = load_info(rule.prereqs[0])
+            prereqs = sorted(info["srcdeps"]) + [info["intermediate_src_path"]]
+            await self.ensure_all(prereqs, requester=target)
+            args = [info["intermediate_src_path"], target]
+        self.prereqs[target] = prereqs
+        self.steps[target] = (rule.action, args)
+        if not self.is_outdated(target, prereqs):
+            return
+        print(rule.action, " ".join(args), flush=True)
+        try:
+            await self.run(target, rule.action, args)
+        except Exception:
+            raise BuildError("failed to build %s:\n%s" %(target, traceback.format_exc()))
+
+    async def run(self, target, action, args):
+        """Run the action building `target` on the executor"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, run_action, action, args)
+
+    def is_outdated(self, target, prereqs):
+        """Make's rule: rebuild if the target is missing, or older than a prerequisite"""
+        try:
+            mtime = os.stat(target).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return any(os.stat(p).st_mtime_ns > mtime for p in prereqs)
+
+    async def publish(self, path):
+        """Build the published copy of `path` (an intermediate path), and of
+        everything it needs at runtime. This is GET_RT_DEPS of the .rtdeps."""
+        path, _sep, anchor = path.partition(".anchor.")
+        if anchor:
+            await self.publish(path)
+            # The page may be being published by another coroutine already
+            await self.ensure_all([path + ".build"])
+            # Make had a rule for each anchor a page provides, and none for broken links
+            if anchor not in load_info(path + ".build")["anchors"]:
+                raise BuildError("no anchor %r in %s" %(anchor, path))
+            return
+        if path in self.published:
+            return
+        self.published.add(path)
+        published = path.replace(self.intermediate, self.output, 1)
+        targets = [published, path + ".build"]
+        if os.path.splitext(path)[1] in compress.TEXT_EXTENSIONS:
+            targets += [published + "." + fmt for fmt in self.compress_formats]
+        await self.ensure_all(targets)
+        build = load_info(path + ".build")
+        rtdeps = [d.replace(".srcinfo", "").replace(self.output, self.intermediate)
+            for d in build["rtdeps"]]
+        await asyncio.gather(*(self.publish(d) for d in rtdeps))
+
+    def get_published_text(self):
+        """Return the published html/css files, for font_subset"""
+        return sorted(p.replace(self.intermediate, self.output, 1) for p in self.published
+            if os.path.splitext(p)[1] in (".html", ".css"))
+
+def main(targets, jobs, subsite=None):
+    # Forked workers inherit the already-imported page_info
+    context = multiprocessing.get_context("fork")
+    root = os.path.join(subsite, "index.html") if subsite else DEFAULT_TARGET
+    with concurrent.futures.ProcessPoolExecutor(jobs, mp_context=context) as executor:
+        builder = Builder(executor)
+        if targets:
+            work = builder.ensure_all([os.path.abspath(t) for t in targets])
+        else:
+            work = builder.publish(os.path.join(builder.intermediate, root))
+        try:
+            asyncio.run(work)
+            # As `make all`: subset the fonts to the characters the pages use,
+            # and if those changed, build again to get the new subsets.
+            # A subsite's pages are only some of them, so they can't say.
+            if not targets and not subsite and font_subset.update_usage(builder.get_published_text()):
+                builder = Builder(executor)
+                asyncio.run(builder.publish(os.path.join(builder.intermediate, DEFAULT_TARGET)))
+        except BuildError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    jobs = os.cpu_count()
+    subsite = None
+    while args[:1] in (["-j"], ["--subsite"]) and len(args) >= 2:
+        if args[0] == "-j":
+            jobs = int(args[1])
+        else:
+            subsite = args[1].strip("/")
+        args = args[2:]
+    if any(a.startswith("-") for a in args) or (subsite and args):
+        print("Usage: %s [-j <jobs>] [--subsite <folder>] [target ...]" %sys.argv[0])
+        sys.exit(1)
+    main(args, jobs, subsite)
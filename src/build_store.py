@@ -0,0 +1,217 @@
+""" Indexed store for .srcinfo and .build objects.
+
+These objects used to be standalone jsonpickle files, decoded in full by
+every reader, even those only interested in e.g. an image's size. They now
+live in a single SQLite database, one row per field, and are read field by
+field on demand (see Record).
+
+The .srcinfo/.build files still exist, since Make schedules the build based on
+them, but they only hold the digest of the record's current content.
+
+Field values use a small typed encoding: bytes and str are stored as-is, and
+anything else as JSON in which sets, tuples, datetimes and registered classes
+(see register_type) are tagged, e.g. {"$set": ["a", "b"]}.
+"""
+import base64, collections.abc, datetime, hashlib, json, os, sqlite3, struct, threading
+
+# Type codes of encoded field values
+BYTES, STR, JSON = b"b", b"s", b"j"
+
+# Classes (and instances thereof) which may be stored in a record, by name
+_types = {}
+
+def register_type(cls):
+    """Allow `cls`, and instances of it, to be stored in records"""
+    _types[cls.__name__] = cls
+    return cls
+
+def _to_json(obj):
+    if obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    if isinstance(obj, list):
+        return [_to_json(o) for o in obj]
+    if isinstance(obj, tuple):
+        return {"$tuple": [_to_json(o) for o in obj]}
+    if isinstance(obj, (set, frozenset)):
+        items = [_to_json(o) for o in obj]
+        try:
+            # Keep the encoding (and thereby the record's digest) deterministic
+            items.sort()
+        except TypeError:
+            pass
+        return {"$set": items}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) and not k.startswith("$") for k in obj):
+            return {k: _to_json(v) for k, v in obj.items()}
+        return {"$dict": [[_to_json(k), _to_json(v)] for k, v in obj.items()]}
+    if isinstance(obj, bytes):
+        return {"$bytes": base64.b64encode(obj).decode()}
+    if isinstance(obj, datetime.datetime):
+        return {"$datetime": obj.isoformat()}
+    if isinstance(obj, type) and _types.get(obj.__name__) is obj:
+        return {"$class": obj.__name__}
+    if _types.get(type(obj).__name__) is type(obj):
+        return {"$object": type(obj).__name__, "state": _to_json(obj.__dict__)}
+    raise TypeError("can't store %r in a build record" %obj)
+
+def _from_json(obj):
+    if isinstance(obj, list):
+        return [_from_json(o) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if "$tuple" in obj:
+        return tuple(_from_json(o) for o in obj["$tuple"])
+    if "$set" in obj:
+        return set(_from_json(o) for o in obj["$set"])
+    if "$dict" in obj:
+        return {_from_json(k): _from_json(v) for k, v in obj["$dict"]}
+    if "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    if "$datetime" in obj:
+        return datetime.datetime.fromisoformat(obj["$datetime"])
+    if "$class" in obj:
+        return _types[obj["$class"]]
+    if "$object" in obj:
+        inst = object.__new__(_types[obj["$object"]])
+        inst.__dict__.update(_from_json(obj["state"]))
+        return inst
+    return {k: _from_json(v) for k, v in obj.items()}
+
+def encode_value(value):
+    """Return (type code, encoded bytes) for a field value"""
+    if isinstance(value, bytes):
+        return BYTES, value
+    if isinstance(value, str):
+        return STR, value.encode()
+    return JSON, json.dumps(_to_json(value), sort_keys=True).encode()
+
+def decode_value(type_code, data):
+    if type_code == BYTES:
+        return bytes(data)
+    if type_code == STR:
+        return bytes(data).decode()
+    return _from_json(json.loads(bytes(data).decode()))
+
+def pack(obj):
+    """Encode a dict (a .srcinfo or .build object) into a single bytes object.
+    Each field is stored as <name length><name><type code><value length><value>.
+    """
+    parts = []
+    for name in sorted(obj):
+        type_code, data = encode_value(obj[name])
+        name = name.encode()
+        parts.append(struct.pack("<H", len(name)) + name + type_code
+            + struct.pack("<Q", len(data)) + data)
+    return b"".join(parts)
+
+def unpack_fields(packed):
+    """Yield (name, type code, encoded value) for each field of a packed object"""
+    offset = 0
+    while offset < len(packed):
+        (name_len,) = struct.unpack_from("<H", packed, offset)
+        offset += 2
+        name = packed[offset:offset + name_len].decode()
+        offset += name_len
+        type_code = packed[offset:offset + 1]
+        (data_len,) = struct.unpack_from("<Q", packed, offset + 1)
+        offset += 9
+        yield name, type_code, packed[offset:offset + data_len]
+        offset += data_len
+
+def unpack(packed):
+    """Inverse of pack"""
+    return {name: decode_value(type_code, data)
+        for name, type_code, data in unpack_fields(packed)}
+
+class Record(collections.abc.Mapping):
+    """Read-only view of a stored object. Fields are fetched (and decoded) from
+    the store the first time they're accessed. They may be accessed either as
+    items or attributes, so that templates can use e.g. `entry.title`.
+    """
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+        self._names = None
+        self._values = {}
+
+    def __repr__(self):
+        return "<Record %s>" %self._path
+
+    def __getitem__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            value = self._store.get_field(self._path, name)
+            # Don't hold on to the (potentially huge) content of binary blobs
+            if not isinstance(value, bytes):
+                self._values[name] = value
+            return value
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __iter__(self):
+        if self._names is None:
+            self._names = self._store.field_names(self._path)
+        return iter(self._names)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+class BuildStore(object):
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        """The current thread's connection to the database"""
+        # sqlite connections mustn't be shared across threads, nor forks
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            db = sqlite3.connect(self.db_path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS fields (
+                record TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type BLOB NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (record, name)
+            ) WITHOUT ROWID""")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def put(self, path, packed):
+        """Store the packed object (see pack) as the record at `path`,
+        then write its digest to the file at `path`."""
+        key = os.path.normpath(path)
+        with self.db as db:
+            db.execute("DELETE FROM fields WHERE record = ?", (key,))
+            db.executemany("INSERT INTO fields VALUES (?, ?, ?, ?)",
+                ((key, name, type_code, data) for name, type_code, data in unpack_fields(packed)))
+        with open(path, "w+") as f:
+            f.write(hashlib.sha256(packed).hexdigest() + "\n")
+
+    def get(self, path):
+        """Return a lazy Record for the object at `path`"""
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        # Pages refer to each other by relative paths, e.g. "a/../b"
+        return Record(self, os.path.normpath(path))
+
+    def get_field(self, path, name):
+        row = self.db.execute("SELECT type, value FROM fields WHERE record = ? AND name = ?",
+            (path, name)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return decode_value(bytes(row[0]), row[1])
+
+    def field_names(self, path):
+        return [name for (name,) in
+            self.db.execute("SELECT name FROM fields WHERE record = ?", (path,))]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+""" Build tracing, in Chrome's trace event format (chrome://tracing, or
+https://ui.perfetto.dev).
+
+Tracing is enabled by setting $BUILD_TRACE to a directory (see `make trace`).
+Every build step then records a span for itself (see `step`), and for the
+phases within it (see `span`): rendering, filters, git, external tools...
+Cache lookups annotate the innermost span with whether they hit (see
+`annotate`). Each process appends its events to <dir>/<pid>.trace, one JSON
+event per line, so that the processes of a `make -j` build needn't
+coordinate; the files are merged afterwards:
+
+    ./build_trace.py --merge <dir> <trace.json>
+    ./build_trace.py --summary <dir> [N]
+
+When tracing is disabled, spans cost next to nothing.
+"""
+import collections, contextlib, functools, glob, json, os, sys, threading, time
+
+_local = threading.local()
+_files = {}
+_files_lock = threading.Lock()
+
+def get_dir():
+    """Return the directory traces are written to, or None if not tracing"""
+    return getattr(_local, "dir", None) or os.environ.get("BUILD_TRACE") or None
+
+def enabled():
+    return get_dir() is not None
+
+@contextlib.contextmanager
+def tracing_to(trace_dir):
+    """Trace the current thread to `trace_dir` (None: as $BUILD_TRACE says),
+    e.g. for a build server handling a traced client's request"""
+    previous = getattr(_local, "dir", None)
+    _local.dir = trace_dir
+    try:
+        yield
+    finally:
+        _local.dir = previous
+
+def _now():
+    # Wall clock, in microseconds, so that processes' events line up
+    return time.time() * 1e6
+
+def _write(event):
+    trace_dir = get_dir()
+    pid = os.getpid()
+    with _files_lock:
+        f = _files.get((trace_dir, pid))
+        if f is None:
+            os.makedirs(trace_dir, exist_ok=True)
+            f = open(os.path.join(trace_dir, "%d.trace" %pid), "a")
+            _files[trace_dir, pid] = f
+            f.write(json.dumps(dict(name="process_name", ph="M", pid=pid,
+                args=dict(name=os.path.basename(sys.argv[0]) or "python"))) + "\n")
+        f.write(json.dumps(dict(event, pid=pid, tid=threading.get_ident())) + "\n")
+        f.flush()
+
+@contextlib.contextmanager
+def span(name, cat="phase", **args):
+    """Record the time spent in the block as an event named `name`.
+    Yields the event's args, to which details may be added."""
+    if not enabled():
+        yield args
+        return
+    target = getattr(_local, "target", None)
+    if target is not None:
+        args.setdefault("target", target)
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(args)
+    start = _now()
+    try:
+        yield args
+    finally:
+        end = _now()
+        stack.pop()
+        _write(dict(name=name, cat=cat, ph="X", ts=start, dur=end - start, args=args))
+
+def annotate(**args):
+    """Add `args` to the innermost span, e.g. annotate(cache="hit")"""
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].update(args)
+
+def bind(fn):
+    """Return `fn`, tracing as the current thread does (to the same
+    directory, and for the same target) even when called by another thread"""
+    trace_dir, target = getattr(_local, "dir", None), getattr(_local, "target", None)
+    @functools.wraps(fn)
+    def bound(*args, **kwargs):
+        previous = getattr(_local, "dir", None), getattr(_local, "target", None)
+        _local.dir, _local.target = trace_dir, target
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.dir, _local.target = previous
+    return bound
+
+def traced(name=None, cat="phase"):
+    """Decorator recording a span for each call of the function"""
+    def decorate(fn):
+        span_name = name or fn.__qualname__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def step(fn):
+    """Decorator for the main(..., out_path) of a build step: records a span
+    for the step, attributing everything within it to its target (the last
+    argument)."""
+    step_name = fn.__module__ if fn.__module__ != "__main__" else \
+        os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    @functools.wraps(fn)
+    def wrapper(*args):
+        if not enabled():
+            return fn(*args)
+        previous = getattr(_local, "target", None)
+        _local.target = args[-1] if args else None
+        try:
+            with span(step_name, "step", args=list(args)):
+                return fn(*args)
+        finally:
+            _local.target = previous
+    return wrapper
+
+def load_events(trace_dir):
+    """Return the events of every process traced to `trace_dir`"""
+    events = []
+    for path in sorted(glob.glob(os.path.join(trace_dir, "*.trace"))):
+        for line in open(path):
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A process killed mid-write
+                pass
+    return events
+
+def merge(trace_dir, out_path):
+    """Write the events of `trace_dir` to `out_path` as one Chrome trace"""
+    events = load_events(trace_dir)
+    with open(out_path, "w") as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
+    print("%d events from %d processes -> %s" %(len(events),
+        len({e["pid"] for e in events}), out_path))
+
+def print_summary(trace_dir, n=20):
+    """Show the N most expensive targets and phases/filters, with cache hit rates"""
+    events = [e for e in load_events(trace_dir) if e.get("ph") == "X"]
+    targets = collections.Counter()
+    phases = collections.defaultdict(lambda: [0, 0.0, collections.Counter()])
+    for e in events:
+        if e["cat"] == "step":
+            targets["%s %s" %(e["name"], e["args"].get("target", ""))] += e["dur"]
+        else:
+            phase = phases["%s:%s" %(e["cat"], e["name"])]
+            phase[0] += 1
+            phase[1] += e["dur"]
+            if "cache" in e["args"]:
+                phase[2][e["args"]["cache"]] += 1
+    print("Most expensive targets:")
+    for target, dur in targets.most_common(n):
+        print("  %9.3fs  %s" %(dur / 1e6, target))
+    print("Most expensive phases and filters (inclusive of nested spans):")
+    for name, (count, dur, cache) in sorted(phases.items(), key=lambda p: -p[1][1])[:n]:
+        hits = " (%s)" %", ".join("%d %s" %(c, k) for k, c in sorted(cache.items())) if cache else ""
+        print("  %9.3fs  %6d calls  %s%s" %(dur / 1e6, count, name, hits))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--merge":
+        merge(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "--summary":
+        print_summary(sys.argv[2], *(int(a) for a in sys.argv[3:]))
+    else:
+        print("Usage: %s --merge <trace dir> <trace.json> | --summary <trace dir> [N]" %sys.argv[0])
+        sys.exit(1)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+""" Size-bounded eviction across the build's caches.
+
+Showing each cache's size, hit rate, and how much of it the current build
+no longer uses:
+    ./cache_manager.py --stats
+Evicting the least recently used entries until the caches fit in a size
+limit (e.g. 500M, 2G), and, optionally, any unused for more than N days:
+    ./cache_manager.py --gc <size limit> [max age in days]
+
+The caches are the content caches under build/cache (the artifact cache and
+each tool's BlobCache, see build_cache.py), jinja's bytecode cache, the joblib
+cache of filter_tex_to_svg, and the files Make builds into build/cache and
+build/intermediate, except for Make's own bookkeeping: the .srcdeps/.rtdeps/
+.alldeps fragments, the .srcinfo/.build records, which hold rows of build.db,
+and the .src.bin copies of binary files, which the .build records point to
+(and data_uri reads) but Make, treating them as intermediate, won't remake.
+Entries still referenced by the current output graph are
+evicted only once nothing else is left: that graph is walked from index.html
+as build_site.py would build it, without building anything. A content cache
+entry is referenced if it's the artifact of a step in the graph, or has the
+content (or is keyed by the content) of a file in it. Entries of the caches
+that can't be tied to the graph (highlight, critical_css, jinja, joblib) are
+evicted by age alone.
+
+Recency is the time an entry was last written or handed out by its cache
+(build_cache.touch), or else read. Hit rates are summed from each cache's
+lookups.jsonl. Don't run --gc during a build.
+"""
+import asyncio, json, os, shutil, sys, time
+
+import build_cache
+from page_info import config
+
+# BlobCaches under build/cache, by the name of their folder
+BLOB_STORES = "compressed", "critical_css", "font_subsets", "highlight", "image_variants", "media_info", "optimized"
+ARTIFACT_STORE = "artifacts"
+JINJA_STORE = "jinja"
+# Bookkeeping, rather than cached results: never evicted
+KEEP = {build_cache.LOOKUPS_FILE, "build.db", "build.db-wal", "build.db-shm", "build.db-journal", "font_usage.json", "git_index.json",
+    "git_index.json.lock", "compress_stats.jsonl", "optimize_stats.jsonl", "optimize.stamp", "optimize.lock"}
+# Make's bookkeeping, by extension: never evicted either
+MAKE_BOOKKEEPING = ".srcdeps", ".rtdeps", ".alldeps", ".srcinfo", ".build", ".src.bin"
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+class Entry(object):
+    """One evictable unit of a cache: a file, or a folder (joblib's)"""
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.size = 0
+        self.last_used = 0.0
+        for f in _walk_files(path) if os.path.isdir(path) else [path]:
+            st = os.stat(f)
+            self.size += st.st_size
+            self.last_used = max(self.last_used, st.st_atime, st.st_mtime)
+        self.referenced = False
+
+    def remove(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        else:
+            os.remove(self.path)
+        # Drop the folders this leaves empty, up to the store's root
+        parent = os.path.dirname(self.path)
+        while parent != self.store.root and parent.startswith(self.store.root) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+class Store(object):
+    def __init__(self, name, root, entries):
+        self.name = name
+        self.root = root
+        self.entries = [Entry(self, path) for path in entries]
+
+    def get_lookups(self):
+        """Return (hits, misses) as counted by build_cache.count_lookup"""
+        hits = misses = 0
+        try:
+            for line in open(os.path.join(self.root, build_cache.LOOKUPS_FILE)):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A process killed mid-write
+                    continue
+                hits += record["hits"]
+                misses += record["misses"]
+        except FileNotFoundError:
+            pass
+        return hits, misses
+
+    def compact_lookups(self):
+        """Replace the lookup log by its totals, so it doesn't grow forever"""
+        path = os.path.join(self.root, build_cache.LOOKUPS_FILE)
+        if os.path.exists(path):
+            hits, misses = self.get_lookups()
+            build_cache.write_atomic(path, (json.dumps(dict(hits=hits, misses=misses)) + "\n").encode())
+
+def _walk_files(root, skip_dirs=()):
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+        for name in filenames:
+            if name not in KEEP and not name.endswith(MAKE_BOOKKEEPING):
+                yield os.path.join(dirpath, name)
+
+def get_stores():
+    cache = os.path.abspath(config["build"]["cache"])
+    intermediate = os.path.abspath(config["build"]["intermediate"])
+    joblib_dir = os.path.join(os.path.abspath(config["build"]["root"]), "joblib")
+    stores = [Store(ARTIFACT_STORE, os.path.join(cache, ARTIFACT_STORE),
+        _walk_files(os.path.join(cache, ARTIFACT_STORE)))]
+    for name in BLOB_STORES + (JINJA_STORE,):
+        stores.append(Store(name, os.path.join(cache, name), _walk_files(os.path.join(cache, name))))
+    # One entry per memoized call: joblib/joblib/<module>/<function>/<call hash>/
+    calls = []
+    for dirpath, dirnames, _filenames in os.walk(joblib_dir):
+        if os.path.relpath(dirpath, joblib_dir).count(os.sep) == 2:
+            calls.extend(os.path.join(dirpath, d) for d in dirnames)
+            dirnames[:] = []
+    stores.append(Store("joblib", joblib_dir, calls))
+    stores.append(Store("intermediate", intermediate, _walk_files(intermediate)))
+    skip = BLOB_STORES + (ARTIFACT_STORE, JINJA_STORE)
+    stores.append(Store("cache files", cache, _walk_files(cache, skip_dirs=skip)))
+    return stores
+
+def get_live_steps():
+    """Walk the build graph from the site's root without building anything.
+    Returns (every target & prerequisite reached, {target: (action, args)})."""
+    import build_site
+
+    class GraphWalker(build_site.Builder):
+        async def _build(self, target):
+            try:
+                await super()._build(target)
+            except Exception:
+                # Not built yet (or broken): what it leads to isn't known
+                pass
+
+        async def publish(self, path):
+            try:
+                await super().publish(path)
+            except Exception:
+                pass
+
+        async def run(self, target, action, args):
+            pass
+
+        def is_outdated(self, target, prereqs):
+            return False
+
+    walker = GraphWalker(None)
+    asyncio.run(walker.publish(os.path.join(walker.intermediate, build_site.DEFAULT_TARGET)))
+    live = set(walker.prereqs)
+    for prereqs in walker.prereqs.values():
+        live.update(prereqs)
+    return {os.path.abspath(p) for p in live}, walker.steps
+
+def mark_referenced(stores):
+    """Set `referenced` on every entry the current output graph uses"""
+    import build_page
+    live, steps = get_live_steps()
+    live_hashes = {build_cache.hash_file(p) for p in live if os.path.isfile(p)}
+    by_name = {s.name: s for s in stores}
+    # Artifacts of the steps in the graph
+    manifests, objects = set(), set()
+    for target, (action, args) in steps.items():
+        if action == "build_page" and os.path.exists(args[0]):
+            manifests.add(build_page.get_key(os.path.splitext(target)[1], args[0]) + ".json")
+    for entry in by_name[ARTIFACT_STORE].entries:
+        name = os.path.basename(entry.path)
+        if name in manifests:
+            entry.referenced = True
+            try:
+                objects.add(json.loads(open(entry.path).read())["artifact"])
+            except (OSError, ValueError, KeyError):
+                pass
+    for entry in by_name[ARTIFACT_STORE].entries:
+        if os.path.basename(entry.path) in objects:
+            entry.referenced = True
+    # Cached bytes that are (or are keyed by) the content of a live file
+    for name in BLOB_STORES:
+        for entry in by_name[name].entries:
+            entry.referenced = os.path.basename(entry.path) in live_hashes \
+                or build_cache.hash_file(entry.path) in live_hashes
+    # Files Make builds
+    for name in "intermediate", "cache files":
+        for entry in by_name[name].entries:
+            entry.referenced = entry.path in live
+
+def parse_size(text):
+    """"2G" -> 2147483648"""
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+def format_size(size):
+    for unit in "", "K", "M", "G":
+        if size < 1024 or unit == "G":
+            break
+        size /= 1024.0
+    return "%.1f%s" %(size, unit) if unit else "%d" %size
+
+def print_stats():
+    stores = get_stores()
+    mark_referenced(stores)
+    print("%-14s %8s %9s %11s %12s %9s" %("cache", "entries", "size", "referenced", "reclaimable", "hit rate"))
+    totals = [0, 0, 0, 0]
+    for store in stores:
+        size = sum(e.size for e in store.entries)
+        referenced = sum(e.size for e in store.entries if e.referenced)
+        hits, misses = store.get_lookups()
+        rate = "%5.1f%% of %d" %(100.0 * hits / (hits + misses), hits + misses) if hits + misses else "-"
+        print("%-14s %8d %9s %11s %12s  %s" %(store.name, len(store.entries), format_size(size),
+            format_size(referenced), format_size(size - referenced), rate))
+        for i, n in enumerate((len(store.entries), size, referenced, size - referenced)):
+            totals[i] += n
+    print("%-14s %8d %9s %11s %12s" %("total", totals[0], format_size(totals[1]),
+        format_size(totals[2]), format_size(totals[3])))
+
+def collect_garbage(limit, max_age_days=None):
+    """Evict entries, least recently used first and referenced ones last,
+    until the caches take at most `limit` bytes. With `max_age_days`,
+    unreferenced entries unused for longer are evicted regardless."""
+    stores = get_stores()
+    mark_referenced(stores)
+    entries = sorted((e for s in stores for e in s.entries), key=lambda e: (e.referenced, e.last_used))
+    total = sum(e.size for e in entries)
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+    evicted = freed = evicted_referenced = 0
+    for entry in entries:
+        too_old = cutoff is not None and not entry.referenced and entry.last_used < cutoff
+        if total - freed <= limit and not too_old:
+            continue
+        entry.remove()
+        evicted += 1
+        freed += entry.size
+        evicted_referenced += entry.referenced
+    for store in stores:
+        store.compact_lookups()
+    print("Evicted %d entries (%s); the caches now take %s of %s" %(evicted, format_size(freed),
+        format_size(total - freed), format_size(limit)))
+    if evicted_referenced:
+        print("%d of them were still used by the current build, and will be rebuilt" %evicted_referenced)
+
+if __name__ == "__main__":
+    if len(sys.argv) == 2 and sys.argv[1] == "--stats":
+        print_stats()
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "--gc":
+        collect_garbage(parse_size(sys.argv[2]), *(float(a) for a in sys.argv[3:]))
+    else:
+        print("Usage: %s --stats | --gc <size limit> [max age in days]" %sys.argv[0])
+        sys.exit(1)
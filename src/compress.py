@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+""" Pre-compressed (.gz, .br) copies of published text files, so that servers
+can send them as-is instead of compressing on the fly.
+
+Compressing a file:
+    ./compress.py <file> <file>.gz
+    ./compress.py <file> <file>.br
+Listing the formats that can be produced here (brotli is optional):
+    ./compress.py --formats
+Showing the compression ratio and time of each file:
+    ./compress.py --report <cache dir>
+
+Compressed bytes are cached by the hash of the input, so unchanged files are
+never compressed twice.
+"""
+import gzip, json, os, shutil, subprocess, sys, time
+
+import build_cache, build_trace
+
+# Keep in sync with COMPRESS_EXTENSIONS in the Makefile
+TEXT_EXTENSIONS = ".html", ".css", ".svg", ".js", ".json", ".txt", ".xml"
+
+def compress_gzip(data):
+    # mtime=0 so that identical input gives identical output
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+def compress_brotli(data):
+    try:
+        import brotli
+    except ImportError:
+        return subprocess.check_output(["brotli", "--stdout", "--best", "-"], input=data)
+    return brotli.compress(data, quality=11)
+
+def brotli_available():
+    try:
+        import brotli
+        return True
+    except ImportError:
+        return shutil.which("brotli") is not None
+
+def get_formats():
+    """Return the formats (extensions, without '.') that can be produced"""
+    return ["gz"] + (["br"] if brotli_available() else [])
+
+COMPRESSORS = {".gz": compress_gzip, ".br": compress_brotli}
+
+def stats_path(cache_dir):
+    return os.path.join(cache_dir, "compress_stats.jsonl")
+
+@build_trace.step
+def main(in_path, out_path):
+    """Write the compressed copy of `in_path` to `out_path`, in the format
+    given by out_path's extension"""
+    from page_info import config
+    cache_dir = config["build"]["cache"]
+    fmt = os.path.splitext(out_path)[1]
+    data = open(in_path, "rb").read()
+    key = build_cache.step_key("compress", fmt, build_cache.hash_bytes(data))
+    cache = build_cache.BlobCache(os.path.join(cache_dir, "compressed"))
+    compressed = cache.get(key)
+    if compressed is None:
+        start = time.time()
+        compressed = COMPRESSORS[fmt](data)
+        elapsed = time.time() - start
+        cache.put(key, compressed)
+        record = dict(path=in_path, format=fmt, bytes_in=len(data),
+            bytes_out=len(compressed), seconds=elapsed)
+        with open(stats_path(cache_dir), "a") as f:
+            f.write(json.dumps(record) + "\n")
+    build_cache.write_atomic(out_path, compressed)
+
+def print_report(cache_dir):
+    """Show the compression ratio and time of the most recent compression of each file"""
+    records = {}
+    try:
+        for line in open(stats_path(cache_dir)):
+            record = json.loads(line)
+            records[record["path"], record["format"]] = record
+    except FileNotFoundError:
+        pass
+    totals = {}
+    for (path, fmt), r in sorted(records.items()):
+        print("%-4s %10d -> %10d bytes (%5.1f%%) %7.3fs  %s" %(fmt, r["bytes_in"], r["bytes_out"],
+            100.0 * r["bytes_out"] / max(r["bytes_in"], 1), r["seconds"], path))
+        total = totals.setdefault(fmt, [0, 0, 0.0])
+        total[0] += r["bytes_in"]
+        total[1] += r["bytes_out"]
+        total[2] += r["seconds"]
+    for fmt, (bytes_in, bytes_out, seconds) in sorted(totals.items()):
+        print("%-4s %10d -> %10d bytes (%5.1f%%) %7.3fs  in total" %(fmt, bytes_in, bytes_out,
+            100.0 * bytes_out / max(bytes_in, 1), seconds))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--formats"]:
+        print(" ".join(get_formats()))
+    elif len(sys.argv) == 3 and sys.argv[1] == "--report":
+        print_report(sys.argv[2])
+    elif len(sys.argv) == 3 and not sys.argv[1].startswith("-"):
+        main(*sys.argv[1:])
+    else:
+        print("Usage: %s <file> <file.gz|file.br> | --formats | --report <cache dir>" %sys.argv[0])
+        sys.exit(1)
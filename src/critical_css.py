@@ -0,0 +1,229 @@
+""" Critical CSS: the rules of a stylesheet that a page actually uses.
+
+include_css inlines these into the page's <head>, and loads the full
+stylesheet asynchronously, so that the first paint needn't wait for it.
+
+A style rule is kept if, for one of its selectors, each compound selector
+(e.g. `a.title`, `#footer`) matches some element of the page. Combinators and
+pseudo-classes (:hover, :not(...), ::before) aren't checked, so this may keep
+rules the page doesn't need, but shouldn't drop any that it does.
+@media/@supports blocks are filtered the same way. @font-face and @keyframes
+are kept if a kept rule names their font-family/animation.
+
+The critical CSS of a page is cached under the hash of the page, of the
+stylesheet, and of where the stylesheet is relative to the page (its url()s
+are rebased onto the page).
+"""
+import collections, html.parser, os, posixpath, re
+
+import build_cache, build_trace
+
+_TOKENS = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)""", re.DOTALL)
+_PSEUDO = re.compile(r"::?[\w-]+(\((?:[^()]|\([^()]*\))*\))?")
+_COMBINATOR = re.compile(r"\s*[>+~]\s*|\s+")
+_TAG = re.compile(r"^(\*|[\w-]+)")
+_ID = re.compile(r"#([\w-]+)")
+_CLASS = re.compile(r"\.([\w-]+)")
+_ATTRIBUTE = re.compile(r"\[\s*([\w-]+)[^\]]*\]")
+_FONT_FAMILY = re.compile(r"font-family\s*:\s*([^;}]+)", re.IGNORECASE)
+_ANIMATION_NAME = re.compile(r"@(?:-[\w]+-)?keyframes\s+([\w-]+)", re.IGNORECASE)
+_URL = re.compile(r"""url\(\s*(["']?)([^"')]+)\1\s*\)""")
+
+def strip_comments(css):
+    return _TOKENS.sub(lambda m: m.group(1) or "", css)
+
+def _skip_string(css, i):
+    quote = css[i]
+    i += 1
+    while i < len(css) and css[i] != quote:
+        i += 2 if css[i] == "\\" else 1
+    return i + 1
+
+def parse_rules(css):
+    """Split (comment-free) `css` into its top-level rules, as a list of
+    (prelude, block): `block` is the text between the rule's braces, or
+    None for statements such as @import."""
+    rules = []
+    pos, n = 0, len(css)
+    while True:
+        i = pos
+        while i < n and css[i] not in "{;}":
+            i = _skip_string(css, i) if css[i] in "\"'" else i + 1
+        if i >= n:
+            return rules
+        prelude = css[pos:i].strip()
+        if css[i] != "{":
+            if prelude:
+                rules.append((prelude, None))
+            pos = i + 1
+            continue
+        depth, j = 1, i + 1
+        while j < n and depth:
+            if css[j] in "\"'":
+                j = _skip_string(css, j)
+                continue
+            depth += {"{": 1, "}": -1}.get(css[j], 0)
+            j += 1
+        rules.append((prelude, css[i+1:j-1]))
+        pos = j
+
+def split_selectors(prelude):
+    """Split a selector list on its top-level commas"""
+    selectors, depth, start = [], 0, 0
+    for i, c in enumerate(prelude):
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == "," and depth == 0:
+            selectors.append(prelude[start:i])
+            start = i + 1
+    selectors.append(prelude[start:])
+    return [s.strip() for s in selectors if s.strip()]
+
+class Document(html.parser.HTMLParser):
+    """The elements of an html page, indexed for matching selectors"""
+    def __init__(self, text):
+        super().__init__(convert_charrefs=True)
+        self.elements = []
+        self.by_class = collections.defaultdict(list)
+        self.by_id = collections.defaultdict(list)
+        self.by_tag = collections.defaultdict(list)
+        self.feed(text)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        element = (tag, attrs.get("id"), frozenset((attrs.get("class") or "").split()), frozenset(attrs))
+        self.elements.append(element)
+        self.by_tag[tag].append(element)
+        if element[1]:
+            self.by_id[element[1]].append(element)
+        for cls in element[2]:
+            self.by_class[cls].append(element)
+
+    def matches_compound(self, compound):
+        """Whether some element matches the compound selector `compound`
+        (with its pseudo-classes already removed)"""
+        tag = _TAG.match(compound)
+        tag = tag.group(1).lower() if tag and tag.group(1) != "*" else None
+        ids, classes = _ID.findall(compound), set(_CLASS.findall(compound))
+        attributes = set(_ATTRIBUTE.findall(compound))
+        if ids:
+            candidates = self.by_id.get(ids[0], ())
+        elif classes:
+            candidates = self.by_class.get(min(classes, key=lambda c: len(self.by_class.get(c, ()))), ())
+        elif tag:
+            candidates = self.by_tag.get(tag, ())
+        else:
+            candidates = self.elements
+        for el_tag, el_id, el_classes, el_attrs in candidates:
+            if (tag is None or tag == el_tag) and all(i == el_id for i in ids) \
+                    and classes <= el_classes and attributes <= el_attrs:
+                return True
+        # A selector of only pseudo-classes (e.g. :root) matches something
+        return not (tag or ids or classes or attributes) and bool(self.elements)
+
+    def matches(self, selector):
+        """Whether `selector` may match an element, ignoring combinators"""
+        selector = _PSEUDO.sub("", selector)
+        return all(self.matches_compound(c) for c in _COMBINATOR.split(selector) if c)
+
+def _filter_rules(rules, document):
+    """Return the (prelude, block) rules of `rules` used by `document`.
+    The block of a kept @media/@supports is the list of its kept rules."""
+    kept = []
+    for prelude, block in rules:
+        if block is None:
+            # @import, @charset: the full stylesheet takes care of these
+            continue
+        if prelude.startswith("@"):
+            keyword = prelude.split(None, 1)[0].lower()
+            if keyword in ("@media", "@supports"):
+                inner = _filter_rules(parse_rules(block), document)
+                if inner:
+                    kept.append((prelude, inner))
+            else:
+                kept.append((prelude, block))
+        elif any(document.matches(s) for s in split_selectors(prelude)):
+            kept.append((prelude, block))
+    return kept
+
+def _serialize(rules):
+    return "".join("%s{%s}" %(prelude, block if isinstance(block, str) else _serialize(block))
+        for prelude, block in rules)
+
+def _drop_unused_at_rules(rules, used_text):
+    """Drop the @font-face and @keyframes of `rules` not named in `used_text`"""
+    kept = []
+    for prelude, block in rules:
+        keyword = prelude.split(None, 1)[0].lower() if prelude.startswith("@") else ""
+        if keyword == "@font-face":
+            families = _FONT_FAMILY.findall(block)
+            if not any(f.strip().strip("\"'").lower() in used_text for f in families):
+                continue
+        elif keyword.endswith("keyframes"):
+            name = _ANIMATION_NAME.match(prelude)
+            if name and name.group(1).lower() not in used_text:
+                continue
+        elif not isinstance(block, str):
+            block = _drop_unused_at_rules(block, used_text)
+        kept.append((prelude, block))
+    return kept
+
+def _is_at_rule(prelude, *keywords):
+    return prelude.startswith("@") and prelude.split(None, 1)[0].lower().endswith(keywords)
+
+def extract(css, document):
+    """Return the rules of the stylesheet `css` used by `document` (a Document)"""
+    rules = _filter_rules(parse_rules(strip_comments(css)), document)
+    # Only style rules can use a font/animation
+    used_text = _serialize([r for r in rules if not _is_at_rule(r[0], "font-face", "keyframes")]).lower()
+    return _serialize(_drop_unused_at_rules(rules, used_text))
+
+def rebase_urls(css, from_dir, to_dir):
+    """Rewrite the relative url()s of `css`, a stylesheet in `from_dir`, to
+    be relative to `to_dir` instead"""
+    def rebase(m):
+        url = m.group(2)
+        if re.match(r"^([a-z][\w+.-]*:|/|#)", url, re.IGNORECASE):
+            return m.group(0)
+        path, suffix = re.match(r"^([^?#]*)(.*)$", url, re.DOTALL).groups()
+        path = posixpath.relpath(posixpath.normpath(posixpath.join(from_dir, path)), to_dir or ".")
+        return "url(%s%s%s%s)" %(m.group(1), path, suffix, m.group(1))
+    return _URL.sub(rebase, css)
+
+class PageStyles(object):
+    """Collects the stylesheets to inline into a page while it renders.
+    The `critical_css` filter emits a placeholder for each; once the page is
+    rendered, substitute() swaps in the rules of each that the page uses.
+    """
+    PLACEHOLDER = re.compile("\0css:([0-9]+)\0")
+
+    def __init__(self, page_path, cache_dir):
+        # Paths are relative to the same root (e.g. both intermediate)
+        self.page_dir = os.path.dirname(page_path)
+        self.cache = build_cache.BlobCache(os.path.join(cache_dir, "critical_css"))
+        self.sheets = []
+
+    def placeholder(self, css, css_path):
+        self.sheets.append((css, os.path.dirname(css_path)))
+        return "\0css:%d\0" %(len(self.sheets) - 1)
+
+    def substitute(self, rendered):
+        if not self.sheets:
+            return rendered
+        page_hash = build_cache.hash_bytes(rendered.encode())
+        document = None
+        critical = []
+        for css, css_dir in self.sheets:
+            rel_dir = os.path.relpath(css_dir, self.page_dir)
+            key = build_cache.step_key("critical_css", page_hash, build_cache.hash_bytes(css.encode()), rel_dir)
+            stored = self.cache.get(key)
+            build_trace.annotate(cache="miss" if stored is None else "hit")
+            if stored is None:
+                document = document or Document(self.PLACEHOLDER.sub("", rendered))
+                stored = rebase_urls(extract(css, document), css_dir, self.page_dir).encode()
+                self.cache.put(key, stored)
+            critical.append(stored.decode())
+        return self.PLACEHOLDER.sub(lambda m: critical[int(m.group(1))], rendered)
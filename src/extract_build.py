@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
-from page_info import config
+from page_info import config, load_info
 
-import jsonpickle, sys
+import sys
+
+import build_cache, build_trace
+
+@build_trace.step
+def main(in_path, out_path):
+    """Write the content of the .build object at `in_path` to `out_path`"""
+    build = load_info(in_path)
+    if 'content_path' in build:
+        # Binary files are copied from their source, not stored in the build
+        build_cache.copy_file(build['content_path'], out_path)
+        return
+    output = build['content']
+    with open(out_path, 'w+' if isinstance(output, str) else 'wb+') as out_file:
+        out_file.write(output)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print("Usage: %s <input .build> <output>" %sys.argv[0])
         sys.exit(1)
-    in_path, out_path = sys.argv[1:]
-
-    build = jsonpickle.decode(open(in_path).read())
-    output = build['content']
-    if isinstance(output, str):
-        out_file = open(out_path, 'w+')
-    else:
-        out_file = open(out_path, 'wb+')
-    out_file.write(output)
-
+    main(*sys.argv[1:])
@@ -2,76 +2,37 @@
 """ Extract git info from a file,
 i.e. authors and commit dates.
 """
-from page_info import Author
-import dateutil, json, jsonpickle, subprocess, sys
+from page_info import Author, config, save_info
+import dateutil.parser, os, sys
 
-def get_unparsed_commits(filename):
-    """Returns an array of commit dicts, where each entry looks like:
-    { 'author': '<name>', 'date': '<date>', 'message': '<message>' }
-    """
-    proc = subprocess.Popen([
-            'git',
-            'log',
-            '--follow',
-            '--pretty=format:{%n  "author": "%aN",%n  "date": "%cD",%n  "message": "%s"%n},',
-            "--",
-            filename],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    if stderr:
-        raise RuntimeError("git log error:", stderr)
+import build_trace, git_index
 
-    raw = stdout.decode('utf-8')
-    return json.loads("[%s []]" %raw)[:-1]
+_index = None
 
-def get_commits(filename):
-    """Returns an array of commit dicts, where each entry looks like:
-    { 'author': <Author object>, 'date': <Datetime object>, 'message': '<message>' }
-    """
-    commits = get_unparsed_commits(filename)
-    for c in commits:
-        c["author"] = Author(c["author"])
-        c["date"] = dateutil.parser.parse(c["date"])
+def get_index():
+    """Return the repository-wide GitIndex, kept in the build cache"""
+    global _index
+    if _index is None:
+        _index = git_index.GitIndex(os.path.join(config["build"]["cache"], "git_index.json"))
+    return _index
 
-    return commits
+def parse_date(date):
+    return dateutil.parser.parse(date) if date else None
 
-def get_authors_of_file(filename):
-    """Return a set of Author objects that have commits associated with the
-    file"""
-    commits = get_commits(filename)
+@build_trace.step
+def main(git_filename, out_path):
+    """Write the git-derived .srcinfo for `git_filename` to `out_path`"""
+    entry = get_index().lookup(git_filename)
 
-    authors = set()
-    for commit in commits:
-        authors.add(commit['author'])
-    return list(authors)
-
-def get_pub_date_of_file(filename):
-    """Returns the date at which this file was committed with the message "PUBLISH", indicating it is ready to be made public"""
-    commits = get_commits(filename)
-
-    for c in commits:
-        if c["message"] == "PUBLISH":
-            return c["date"]
+    page_info = dict(
+        authors = [Author(a) for a in entry["authors"]],
+        pub_date = parse_date(entry["pub_date"]),
+        last_edit_date = parse_date(entry["last_edit_date"]),
+    )
+    save_info(out_path, page_info)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
         print("Usage: %s <input filename> <output .srcinfo>" %sys.argv[0])
         sys.exit(1)
-    git_filename, out_path = sys.argv[1:]
-
-    authors = get_authors_of_file(git_filename)
-    pub_date = get_pub_date_of_file(git_filename)
-    commits = sorted(get_commits(git_filename), key=lambda c: c["date"])
-    last_edit_date = commits[-1]["date"] if commits else None
-
-    page_info = dict(
-        authors = authors,
-        pub_date = pub_date,
-        last_edit_date = last_edit_date,
-    )
-
-    output = jsonpickle.encode(page_info)
-    out_file = open(out_path, "w+")
-    out_file.write(output)
-
+    main(*sys.argv[1:])
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
-from page_info import config
+from page_info import config, load_info
 
-import jsonpickle, sys
+import sys
+
+import build_trace
 
 def rm_anchor(url):
     if '.anchor.' in url:
         url = url.split(".anchor.")[0]
     return url
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: %s <input .build> <.rtdeps>" %sys.argv[0])
-        sys.exit(1)
-    in_path, out_path = sys.argv[1:]
-
-    build = jsonpickle.decode(open(in_path).read())
+@build_trace.step
+def main(in_path, out_path):
+    """Generate the Make fragment holding the runtime dependencies of the .build object at `in_path`"""
+    build = load_info(in_path)
     srcdep = out_path.replace(".rtdeps", ".srcdeps")
     build_path=build['build_path']
     # all runtime intermediates we need
@@ -49,7 +48,13 @@ endef
 # Which anchors this file provides at runtime
 {anchors}
 endif # include guard
-""".format(**globals())
-    out_file = open(out_path, 'w+')
-    out_file.write(output)
+""".format(**locals())
+    with open(out_path, 'w+') as out_file:
+        out_file.write(output)
 
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: %s <input .build> <.rtdeps>" %sys.argv[0])
+        sys.exit(1)
+    main(*sys.argv[1:])
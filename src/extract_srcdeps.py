@@ -1,15 +1,14 @@
 #!/usr/bin/env python3
-from page_info import config
+from page_info import config, load_info
 
-import jsonpickle, sys
+import sys
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: %s <input .srcinfo> <.srcdeps>" %sys.argv[0])
-        sys.exit(1)
-    in_path, out_path = sys.argv[1:]
+import build_trace
 
-    page_info = jsonpickle.decode(open(in_path).read())
+@build_trace.step
+def main(in_path, out_path):
+    """Generate the Make fragment holding the buildtime dependencies of the .srcinfo object at `in_path`"""
+    page_info = load_info(in_path)
     src_deps = "\n".join(
             "{intermediate_path}.build: {d}".format(d=d, **page_info)
             for d in page_info['srcdeps'])
@@ -29,11 +28,17 @@ INCL_{out_path}=y
 
 # How to build this file
 {intermediate_path}.build: {intermediate_src_path}
-	./build_page.py $< $@
+	$(BUILD_STEP) build_page $< $@
 endif
 """.format(intermediate_path=page_info['intermediate_path'],
         intermediate_src_path=page_info['intermediate_src_path'],
-        **globals())
-    out_file = open(out_path, 'w+')
-    out_file.write(output)
+        **locals())
+    with open(out_path, 'w+') as out_file:
+        out_file.write(output)
+
 
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: %s <input .srcinfo> <.srcdeps>" %sys.argv[0])
+        sys.exit(1)
+    main(*sys.argv[1:])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" A local, in-memory stand-in for the Cloudflare API, for testing
+publish_cloudflare.py without touching the real DNS records:
+
+    ./fake_cloudflare_api.py [port]
+    CLOUDFLARE_API=http://127.0.0.1:<port>/client/v4 ./publish_cloudflare.py <key> <IPFS id> ...
+
+It serves a zone for each of publish_cloudflare.dnslink_subdomains, with a TXT
+record for each subdomain. Only the endpoints publish_cloudflare.py uses are
+implemented: zone lookup, TXT record lookup & update, and cache purges. Each
+request is logged (with its body, for PUTs and purges).
+"""
+import http.server, json, re, sys, threading, uuid
+from urllib.parse import urlsplit, parse_qs
+
+from publish_cloudflare import dnslink_subdomains
+
+DEFAULT_PORT = 8099
+PREFIX = "/client/v4"
+
+class FakeCloudflare(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # zone id -> name
+        self.zones = {}
+        # record id -> record
+        self.records = {}
+        for zone_name, dnslinks in sorted(dnslink_subdomains.items()):
+            zone_id = uuid.uuid4().hex
+            self.zones[zone_id] = zone_name
+            for sub in dnslinks:
+                record_id = uuid.uuid4().hex
+                self.records[record_id] = dict(id=record_id, zone_id=zone_id, type="TXT",
+                    name=sub, content="dnslink=/ipfs/none", ttl=1)
+
+    def run(self, method, path, params, data):
+        """Return (status, result) of the API call, or (status, None) on error"""
+        if method == "GET" and path == "/zones":
+            return 200, [dict(id=i, name=n) for i, n in self.zones.items() if n == params.get("name", n)]
+        m = re.match(r"^/zones/(\w+)/(dns_records|purge_cache)(?:/(\w+))?$", path)
+        if m is None or m.group(1) not in self.zones:
+            return 404, None
+        zone_id, endpoint, record_id = m.groups()
+        if endpoint == "purge_cache" and method == "POST" and record_id is None:
+            if data.get("purge_everything") is not True and not data.get("files"):
+                return 400, None
+            if len(data.get("files", ())) > 30:
+                return 400, None
+            return 200, dict(id=zone_id)
+        if endpoint != "dns_records":
+            return 404, None
+        if record_id is None and method == "GET":
+            return 200, [r for r in self.records.values() if r["zone_id"] == zone_id
+                and all(r.get(k) == v for k, v in params.items() if k in ("type", "name"))]
+        record = self.records.get(record_id)
+        if record is None or record["zone_id"] != zone_id:
+            return 404, None
+        if method == "GET":
+            return 200, record
+        if method == "PUT":
+            record.update({k: v for k, v in data.items() if k in ("type", "name", "content", "ttl")})
+            return 200, record
+        return 405, None
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def handle_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length)) if length else {}
+        if data:
+            self.log_message("%s", json.dumps(data))
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if not url.path.startswith(PREFIX) or not self.headers.get("X-Auth-Key"):
+            status, result = 403, None
+        else:
+            with self.server.cloudflare.lock:
+                status, result = self.server.cloudflare.run(self.command, url.path[len(PREFIX):], params, data)
+        body = dict(success=result is not None, result=result, messages=[],
+            errors=[] if result is not None else [dict(code=status, message="fake API error")])
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+def serve(port=DEFAULT_PORT):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.cloudflare = FakeCloudflare()
+    print("Fake Cloudflare API at http://127.0.0.1:%d%s" %(server.server_address[1], PREFIX), file=sys.stderr, flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [port]" %sys.argv[0])
+        sys.exit(1)
+    serve(int(sys.argv[1]) if len(sys.argv) == 2 else DEFAULT_PORT)
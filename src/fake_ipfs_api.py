@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+""" A local, in-memory stand-in for the IPFS daemon's HTTP API, for testing
+publish_ipfs.py without touching a real node:
+
+    ./fake_ipfs_api.py [port]
+    IPFS_API=http://127.0.0.1:<port>/api/v0 ./publish_ipfs.py <output dir> <manifest>
+
+Only the commands publish_ipfs.py uses are implemented: add, cat, pin/add and
+files/{cp,flush,mkdir,rm,stat}. CIDs are content hashes, but not real
+multihashes. Each request is logged, so it's visible what a publish added.
+"""
+import email.parser, hashlib, http.server, json, sys, threading
+from urllib.parse import urlsplit, parse_qs
+
+DEFAULT_PORT = 5001
+
+class ApiError(Exception):
+    pass
+
+class FakeIpfs(object):
+    def __init__(self):
+        # CID -> bytes (a file) or {name: CID} (a directory)
+        self.objects = {}
+        # The MFS: nested dicts of name -> CID (file) or dict (directory)
+        self.mfs = {}
+        self.pins = set()
+        self.lock = threading.Lock()
+
+    def put(self, obj):
+        if isinstance(obj, bytes):
+            cid = "Qmf" + hashlib.sha256(obj).hexdigest()[:43]
+        else:
+            cid = "Qmd" + hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()[:43]
+        self.objects[cid] = obj
+        return cid
+
+    def resolve(self, path):
+        """Return the object at /ipfs/<cid>/<path...>"""
+        parts = [p for p in path.split("/") if p]
+        if len(parts) < 2 or parts[0] != "ipfs" or parts[1] not in self.objects:
+            raise ApiError("%s: not found" %path)
+        obj = self.objects[parts[1]]
+        for name in parts[2:]:
+            if not isinstance(obj, dict) or name not in obj:
+                raise ApiError("%s: not found" %path)
+            obj = self.objects[obj[name]]
+        return obj
+
+    def _to_mfs(self, obj):
+        if isinstance(obj, bytes):
+            return self.put(obj)
+        return {name: self._to_mfs(self.objects[cid]) for name, cid in obj.items()}
+
+    def _freeze(self, node):
+        """Return the CID of the MFS node `node`"""
+        if isinstance(node, str):
+            return node
+        return self.put({name: self._freeze(child) for name, child in node.items()})
+
+    def _lookup(self, path, create=False):
+        """Return (parent dict, name) of the MFS `path`"""
+        parts = [p for p in path.split("/") if p]
+        if not parts:
+            raise ApiError("can't modify the MFS root")
+        node = self.mfs
+        for name in parts[:-1]:
+            if name not in node:
+                if not create:
+                    raise ApiError("%s: no such directory" %path)
+                node[name] = {}
+            node = node[name]
+            if not isinstance(node, dict):
+                raise ApiError("%s: not a directory" %path)
+        return node, parts[-1]
+
+    def run(self, command, args, params, body):
+        if command == "add":
+            cid = self.put(body)
+            return dict(Name=cid, Hash=cid, Size=str(len(body)))
+        if command == "cat":
+            obj = self.resolve(args[0])
+            if not isinstance(obj, bytes):
+                raise ApiError("%s is a directory" %args[0])
+            return obj
+        if command == "pin/add":
+            cid = args[0].split("/")[-1]
+            self.resolve("/ipfs/" + cid)
+            self.pins.add(cid)
+            return dict(Pins=[cid])
+        if command == "files/cp":
+            parent, name = self._lookup(args[1])
+            if name in parent:
+                raise ApiError("%s already exists" %args[1])
+            parent[name] = self._to_mfs(self.resolve(args[0]))
+            return None
+        if command == "files/mkdir":
+            parent, name = self._lookup(args[0], create=params.get("parents") == "true")
+            if name in parent and not isinstance(parent[name], dict):
+                raise ApiError("%s: file exists" %args[0])
+            if name in parent and params.get("parents") != "true":
+                raise ApiError("%s already exists" %args[0])
+            parent.setdefault(name, {})
+            return None
+        if command == "files/rm":
+            parent, name = self._lookup(args[0])
+            if name not in parent:
+                raise ApiError("%s: file does not exist" %args[0])
+            if isinstance(parent[name], dict) and params.get("recursive") != "true":
+                raise ApiError("%s is a directory, use -r to remove directories" %args[0])
+            del parent[name]
+            return None
+        if command == "files/flush":
+            return None
+        if command == "files/stat":
+            parent, name = self._lookup(args[0])
+            if name not in parent:
+                raise ApiError("%s: file does not exist" %args[0])
+            node = parent[name]
+            return dict(Hash=self._freeze(node), Type="directory" if isinstance(node, dict) else "file")
+        raise ApiError("unknown command %s" %command)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlsplit(self.path)
+        command = url.path[len("/api/v0/"):]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        args = parse_qs(url.query).get("arg", [])
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if command == "add":
+            # The file is the (only) part of a multipart/form-data body
+            message = email.parser.BytesParser().parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+            body = message.get_payload()[0].get_payload(decode=True)
+        try:
+            with self.server.ipfs.lock:
+                result = self.server.ipfs.run(command, args, params, body)
+        except ApiError as e:
+            return self.respond(500, json.dumps(dict(Message=str(e), Code=0, Type="error")).encode())
+        if isinstance(result, bytes):
+            return self.respond(200, result, "application/octet-stream")
+        self.respond(200, json.dumps(result).encode() if result is not None else b"")
+
+    def respond(self, status, data, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def serve(port=DEFAULT_PORT):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.ipfs = FakeIpfs()
+    print("Fake IPFS API at http://127.0.0.1:%d/api/v0" %server.server_address[1], file=sys.stderr, flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage: %s [port]" %sys.argv[0])
+        sys.exit(1)
+    serve(int(sys.argv[1]) if len(sys.argv) == 2 else DEFAULT_PORT)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+""" Content-fingerprinted copy of the build output, for immutable caching.
+
+    ./fingerprint.py <output dir> <fingerprinted dir> <manifest.json>
+
+Every file the pages (or stylesheets) link to, but the html pages, is renamed
+to include a hash of its content (css/global.css -> css/global.<hash>.css), so
+that it can be cached forever: a changed file is a new URL. The pages keep
+their URLs, and so do the files nothing links to, which are only reached by
+URL (e.g. the videos colin-dance publishes through page_info.rtdeps). The
+references to renamed files in the pages and stylesheets (as produced by
+to_rel_path: href, src, srcset and poster attributes, and CSS url()s) are
+rewritten; since a stylesheet's hash is taken after rewriting, a changed font
+renames the stylesheets using it too. Pre-compressed copies (.gz, .br) follow
+their file, and are recompressed where its content was rewritten.
+
+The manifest maps each renamed file's logical path (relative to the output)
+to its fingerprinted path. Files already in the fingerprinted folder are only
+rewritten if they changed, so publish_ipfs.py's manifest stays valid.
+"""
+import json, os, posixpath, re, sys
+
+import build_cache, compress
+
+# Published under their own names, but with their references rewritten
+PAGE_EXTENSIONS = ".html",
+# Renamed, and with their references rewritten
+STYLE_EXTENSIONS = ".css",
+COMPRESSED_EXTENSIONS = tuple(compress.COMPRESSORS)
+HASH_LENGTH = 10
+
+_ATTRIBUTE = re.compile(r"""(\b(?:href|src|poster)\s*=\s*)(["'])(.*?)\2""", re.IGNORECASE | re.DOTALL)
+_SRCSET = re.compile(r"""(\bsrcset\s*=\s*)(["'])(.*?)\2""", re.IGNORECASE | re.DOTALL)
+_CSS_URL = re.compile(r"""(url\(\s*)(["']?)([^"')]*)\2(\s*\))""", re.IGNORECASE)
+_EXTERNAL = re.compile(r"^(?:[a-z][a-z0-9+.-]*:|//|#)", re.IGNORECASE)
+
+def fingerprinted_name(path, digest):
+    """css/global.css -> css/global.<digest>.css"""
+    base, ext = posixpath.splitext(path)
+    return "%s.%s%s" %(base, digest[:HASH_LENGTH], ext)
+
+class Fingerprinter(object):
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        # Every published file (relative path), but the compressed copies
+        self.files = set()
+        for dirpath, _dirnames, filenames in os.walk(output_dir):
+            for name in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, name), output_dir).replace(os.sep, "/")
+                self.files.add(rel)
+        self.compressed = {f for f in self.files if f.endswith(COMPRESSED_EXTENSIONS)
+            and posixpath.splitext(f)[0] in self.files}
+        self.files -= self.compressed
+        # logical path -> fingerprinted path
+        self.names = {}
+        # logical path -> rewritten content (of pages & stylesheets)
+        self.rewritten = {}
+        self._resolving = set()
+
+    def get_name(self, path):
+        """Return the published name of the output file `path`, linked to
+        by a page or stylesheet"""
+        if path in self.names:
+            return self.names[path]
+        ext = posixpath.splitext(path)[1]
+        if ext in PAGE_EXTENSIONS:
+            self.names[path] = path
+            self.rewritten[path] = self.rewrite(path)
+        elif ext in STYLE_EXTENSIONS:
+            if path in self._resolving:
+                # A cycle of stylesheets: leave this reference be
+                return path
+            self._resolving.add(path)
+            content = self.rewrite(path)
+            self._resolving.discard(path)
+            self.rewritten[path] = content
+            self.names[path] = fingerprinted_name(path, build_cache.hash_bytes(content))
+        else:
+            digest = build_cache.hash_file(os.path.join(self.output_dir, path))
+            self.names[path] = fingerprinted_name(path, digest)
+        return self.names[path]
+
+    def rewrite_url(self, url, from_path):
+        """Return `url`, referenced from the file `from_path`, pointing to the
+        fingerprinted name of the file it refers to"""
+        if not url or _EXTERNAL.match(url):
+            return url
+        split = min([i for i in (url.find("?"), url.find("#")) if i >= 0] or [len(url)])
+        rel, suffix = url[:split], url[split:]
+        from_dir = posixpath.dirname(from_path)
+        if rel.startswith("/"):
+            target, from_dir = posixpath.normpath(rel.lstrip("/")), ""
+        else:
+            target = posixpath.normpath(posixpath.join(from_dir, rel))
+        if target not in self.files or posixpath.splitext(target)[1] in PAGE_EXTENSIONS:
+            # Pages (and folders, i.e. their index.html) keep their URLs
+            return url
+        name = self.get_name(target)
+        new = posixpath.relpath(name, from_dir or ".") if not rel.startswith("/") else "/" + name
+        return new + suffix
+
+    def rewrite(self, path):
+        """Return the content of `path` with its references rewritten"""
+        with open(os.path.join(self.output_dir, path), "rb") as f:
+            text = f.read().decode("utf-8")
+        rewrite = lambda url: self.rewrite_url(url, path)
+        css_url = lambda m: m.group(1) + m.group(2) + rewrite(m.group(3)) + m.group(2) + m.group(4)
+        if posixpath.splitext(path)[1] in PAGE_EXTENSIONS:
+            text = _ATTRIBUTE.sub(lambda m: m.group(1) + m.group(2) + rewrite(m.group(3)) + m.group(2), text)
+            text = _SRCSET.sub(lambda m: m.group(1) + m.group(2) + ", ".join(
+                " ".join([rewrite(c.split()[0])] + c.split()[1:]) for c in m.group(3).split(",") if c.strip()
+            ) + m.group(2), text)
+        # Stylesheets, and the <style>s & style attributes of pages
+        text = _CSS_URL.sub(css_url, text)
+        return text.encode("utf-8")
+
+    def write(self, dest_dir):
+        """Write the fingerprinted files to `dest_dir`, removing any others.
+        Returns the manifest: {logical path: fingerprinted path}."""
+        pages = [p for p in self.files if posixpath.splitext(p)[1] in PAGE_EXTENSIONS]
+        for path in sorted(pages):
+            self.get_name(path)
+        # What's left isn't linked to from the pages: it keeps its name. The
+        # stylesheets go first, since what they link to is renamed.
+        is_style = lambda p: posixpath.splitext(p)[1] in STYLE_EXTENSIONS
+        for path in sorted(self.files - set(self.names), key=lambda p: (not is_style(p), p)):
+            if path in self.names:
+                # Linked to by one of these stylesheets
+                continue
+            self.names[path] = path
+            if is_style(path):
+                self.rewritten[path] = self.rewrite(path)
+        written = set()
+        for path, name in self.names.items():
+            src = os.path.join(self.output_dir, path)
+            dest = os.path.join(dest_dir, name)
+            content = self.rewritten.get(path)
+            if content is None:
+                # Content as-is: the name says whether it's already there
+                if not os.path.exists(dest):
+                    build_cache.copy_file(src, dest)
+            elif not os.path.exists(dest) or open(dest, "rb").read() != content:
+                build_cache.write_atomic(dest, content)
+            written.add(name)
+            for ext in COMPRESSED_EXTENSIONS:
+                if path + ext not in self.compressed:
+                    continue
+                compressed_dest = dest + ext
+                written.add(name + ext)
+                if os.path.exists(compressed_dest) and os.path.getmtime(compressed_dest) >= os.path.getmtime(dest):
+                    continue
+                if content is None or content == open(src, "rb").read():
+                    build_cache.copy_file(src + ext, compressed_dest)
+                else:
+                    compress.main(dest, compressed_dest)
+        # Drop what an earlier run wrote, but this one didn't
+        for dirpath, _dirnames, filenames in os.walk(dest_dir, topdown=False):
+            for f in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, f), dest_dir).replace(os.sep, "/")
+                if rel not in written:
+                    os.remove(os.path.join(dirpath, f))
+            if dirpath != dest_dir and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return {path: name for path, name in sorted(self.names.items()) if name != path}
+
+def main(output_dir, dest_dir, manifest_path):
+    manifest = Fingerprinter(output_dir).write(dest_dir)
+    build_cache.write_atomic(manifest_path, json.dumps(dict(files=manifest), indent=1, sort_keys=True).encode())
+    print("%d files fingerprinted" %len(manifest))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: %s <output dir> <fingerprinted dir> <manifest.json>" %sys.argv[0])
+        sys.exit(1)
+    main(*sys.argv[1:])
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" Subset the self-hosted fonts to the characters the site actually uses.
+
+The rendered pages are scanned for the characters they contain and the
+FontAwesome icons (fa-* classes) they use; the result is stored in the usage
+file ($(BUILD_CACHE)/font_usage.json), which is only rewritten when it changes.
+Fonts are then subset to those characters: the icon font (config
+fonts.icons) to the used icons, every other font to the used text.
+
+Scanning rendered output (exits with status 3 if the usage changed, in which
+case the subset fonts must be rebuilt):
+    ./font_subset.py --scan <rendered .html/.css file> ...
+Subsetting a font:
+    ./font_subset.py <font.ttf> <font.subset.ttf>
+
+Until the site has been scanned once, "subset" fonts are full copies.
+Subsetting requires fontTools (pip install fonttools); without it, fonts are
+copied unchanged.
+"""
+import html, json, os, re, shutil, subprocess, sys, tempfile
+
+import build_cache, build_trace
+
+# Source of the icon classes and their code points
+ICON_CSS = "pages/css/font-awesome.css.jinja.css"
+# Always kept in text fonts, so that small edits don't need a new subset
+ALWAYS_INCLUDED = "".join(chr(c) for c in range(0x20, 0x7f))
+# Exit status of --scan when the usage changed
+STATUS_CHANGED = 3
+
+_ICON_RULE = re.compile(r'((?:\.fa-[\w-]+:before\s*,?\s*)+)\{\s*content:\s*"\\([0-9a-fA-F]+)"')
+_ICON_CLASS = re.compile(r'\bfa-([\w-]+)')
+_CSS_CONTENT = re.compile(r'content:\s*"((?:\\.|[^"\\])*)"')
+_CSS_ESCAPE = re.compile(r'\\([0-9a-fA-F]{1,6})\s?')
+
+def get_icon_table():
+    """Return {icon name: character} for every icon in ICON_CSS"""
+    table = {}
+    for selectors, code in _ICON_RULE.findall(open(ICON_CSS).read()):
+        for name in _ICON_CLASS.findall(selectors):
+            table[name] = chr(int(code, 16))
+    return table
+
+def is_private_use(char):
+    # Icon fonts map their glyphs into the private use area
+    return 0xe000 <= ord(char) <= 0xf8ff
+
+def scan(paths):
+    """Return the usage of the rendered html/css files at `paths`:
+    {"text": characters, "icons": characters}"""
+    icon_table = get_icon_table()
+    text, icons = set(ALWAYS_INCLUDED), set()
+    for path in paths:
+        content = open(path, encoding="utf-8").read()
+        # Stylesheets, and the <style>s pages inline: content strings may
+        # hold text, or icons referenced by their code point. The icon
+        # classes' own rules don't count: those icons are used where the
+        # classes are.
+        for string in _CSS_CONTENT.findall(_ICON_RULE.sub("", content)):
+            string = _CSS_ESCAPE.sub(lambda m: chr(int(m.group(1), 16)), string)
+            text.update(c for c in string if not is_private_use(c))
+            icons.update(c for c in string if is_private_use(c))
+        if not path.endswith(".css"):
+            # As displayed: &amp;, &#8212; ... are the characters they stand for
+            text.update(html.unescape(content))
+            icons.update(icon_table[name] for name in _ICON_CLASS.findall(content) if name in icon_table)
+    return dict(text="".join(sorted(c for c in text if c.isprintable())), icons="".join(sorted(icons)))
+
+def usage_path():
+    from page_info import config
+    return os.path.join(config["build"]["cache"], "font_usage.json")
+
+def load_usage():
+    """Return the usage last stored by update_usage, or None if there's none"""
+    try:
+        return json.loads(open(usage_path()).read())
+    except FileNotFoundError:
+        return None
+
+def update_usage(paths):
+    """Scan `paths` and store the usage, if it changed. Returns whether it did."""
+    usage = scan(paths)
+    if usage == load_usage():
+        return False
+    build_cache.write_atomic(usage_path(), json.dumps(usage, sort_keys=True).encode())
+    return True
+
+def subset_font(data, chars, ext):
+    """Return the font `data` (bytes) reduced to the characters `chars`,
+    or None if no subsetting tool is available."""
+    try:
+        from fontTools import subset
+    except ImportError:
+        subset = None
+    if subset is None and shutil.which("pyftsubset") is None:
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path, out_path = os.path.join(tmp, "in" + ext), os.path.join(tmp, "out" + ext)
+        open(in_path, "wb").write(data)
+        unicodes = ",".join("U+%04X" %ord(c) for c in chars)
+        args = [in_path, "--unicodes=" + unicodes, "--output-file=" + out_path,
+            "--layout-features=*", "--name-IDs=*", "--notdef-outline"]
+        if subset is not None:
+            subset.main(args)
+        else:
+            subprocess.check_call(["pyftsubset"] + args)
+        return open(out_path, "rb").read()
+
+@build_trace.step
+def main(in_path, out_path):
+    """Write the subset of the font at `in_path` to `out_path`"""
+    from page_info import config
+    usage = load_usage()
+    data = open(in_path, "rb").read()
+    if usage is None:
+        # Nothing's been scanned yet
+        build_cache.write_atomic(out_path, data)
+        return
+    is_icon_font = os.path.basename(in_path).startswith(config["fonts"]["icons"])
+    chars = usage["icons"] if is_icon_font else usage["text"]
+    ext = os.path.splitext(in_path)[1]
+    key = build_cache.step_key("font_subset", build_cache.hash_bytes(data), chars)
+    cache = build_cache.BlobCache(os.path.join(config["build"]["cache"], "font_subsets"))
+    subset = cache.get(key)
+    if subset is None:
+        subset = subset_font(data, chars, ext)
+        if subset is None:
+            print("fontTools isn't installed; not subsetting %s" %in_path, file=sys.stderr)
+            build_cache.write_atomic(out_path, data)
+            return
+        cache.put(key, subset)
+    build_cache.write_atomic(out_path, subset)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--scan"]:
+        sys.exit(STATUS_CHANGED if update_usage(sys.argv[2:]) else 0)
+    elif len(sys.argv) == 3:
+        main(*sys.argv[1:])
+    else:
+        print("Usage: %s --scan <rendered file> ... | <font> <subset font>" %sys.argv[0])
+        sys.exit(1)
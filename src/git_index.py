@@ -0,0 +1,166 @@
+""" Repository-wide index of git history, per file.
+
+Rather than running `git log --follow` (several times) for every source file,
+the history is walked once, oldest commit first, following renames. Only
+first parents are followed: a merge counts as one commit, by whoever merged,
+making the changes it brings in. Deleted files are dropped. For each path, the
+index holds:
+
+    authors         names of everyone who committed to the file
+    pub_date        date of the newest commit with the message "PUBLISH"
+    last_edit_date  date of the newest commit to the file
+
+Dates are stored as ISO 8601 strings (committer dates). The index remembers
+the commit it was built up to, and is only extended by the commits made since.
+HEAD is only resolved again when .git/HEAD, the branch it points to, or
+packed-refs changed.
+"""
+import datetime, fcntl, json, os, subprocess
+
+import build_trace
+
+# Bumped whenever the way the index is built changes, to rebuild older ones
+VERSION = 2
+
+def git(*args):
+    """Run git with the given arguments, returning its stdout as str"""
+    with build_trace.span("git " + args[0], "git"):
+        proc = subprocess.Popen(("git",) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+    if proc.returncode:
+        raise RuntimeError("git %s error:" %args[0], stderr)
+    return stdout.decode('utf-8')
+
+def get_head():
+    """Return the hash of HEAD, or None in a repository without commits"""
+    try:
+        return git("rev-parse", "--verify", "-q", "HEAD").strip()
+    except RuntimeError:
+        return None
+
+def get_dirs():
+    """Return (working tree root, git dir, common git dir) as absolute paths"""
+    toplevel, git_dir, common_dir = git("rev-parse", "--show-toplevel", "--absolute-git-dir",
+        "--git-common-dir").splitlines()
+    return os.path.realpath(toplevel), git_dir, os.path.abspath(common_dir)
+
+def iter_commits(rev_range):
+    """Yield (author, date, message, changes) for each commit in `rev_range`,
+    oldest first. `changes` is a list of (status, old path, new path);
+    old path equals new path unless the file was renamed."""
+    raw = git("log", "--reverse", "-M", "-m", "--first-parent", "--name-status", "-z",
+        "--format=%x01%H%x00%aN%x00%cI%x00%s", rev_range)
+    for chunk in raw.split("\x01")[1:]:
+        _hash, author, date, message, *status = chunk.split("\0")
+        changes = []
+        status = [s.lstrip("\n") for s in status if s.lstrip("\n")]
+        while status:
+            kind = status.pop(0)
+            if kind[0] in "RC":
+                old, new = status.pop(0), status.pop(0)
+            else:
+                old = new = status.pop(0)
+            changes.append((kind[0], old, new))
+        yield author, date, message, changes
+
+def apply_commit(files, author, date, message, changes):
+    """Update the per-path table `files` with a single commit"""
+    for kind, old, new in changes:
+        if kind == "D":
+            files.pop(old, None)
+            continue
+        if kind == "R":
+            entry = files.pop(old, None) or dict(authors=[], pub_date=None, last_edit_date=None)
+        else:
+            entry = files.setdefault(new, dict(authors=[], pub_date=None, last_edit_date=None))
+        files[new] = entry
+        if author not in entry["authors"]:
+            entry["authors"].append(author)
+        if message == "PUBLISH":
+            entry["pub_date"] = date
+        # Committers may be in different timezones, so compare the parsed dates
+        if entry["last_edit_date"] is None or \
+                datetime.datetime.fromisoformat(entry["last_edit_date"]) < datetime.datetime.fromisoformat(date):
+            entry["last_edit_date"] = date
+
+class GitIndex(object):
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.toplevel, self.git_dir, self.common_dir = get_dirs()
+        self.head = None
+        self.head_stamp = None
+        self.files = {}
+
+    def _load(self):
+        try:
+            index = json.loads(open(self.index_path).read())
+        except FileNotFoundError:
+            return
+        if index.get("version") == VERSION and index["toplevel"] == self.toplevel:
+            self.head, self.files = index["head"], index["files"]
+
+    def _save(self):
+        tmp_path = "%s.%d.tmp" %(self.index_path, os.getpid())
+        with open(tmp_path, "w+") as f:
+            f.write(json.dumps(dict(version=VERSION, toplevel=self.toplevel, head=self.head, files=self.files)))
+        os.replace(tmp_path, self.index_path)
+
+    def _stat_head(self):
+        """Return the stat of the files HEAD is resolved from, which changes
+        with every commit, checkout or reset"""
+        head_path = os.path.join(self.git_dir, "HEAD")
+        paths = [head_path]
+        try:
+            ref = open(head_path).read().strip()
+        except FileNotFoundError:
+            ref = ""
+        if ref.startswith("ref: "):
+            paths += [os.path.join(self.common_dir, ref[len("ref: "):]), os.path.join(self.common_dir, "packed-refs")]
+        stamp = [ref]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
+
+    def update(self):
+        """Bring the index up to date with HEAD"""
+        stamp = self._stat_head()
+        if stamp == self.head_stamp:
+            return
+        self._update(get_head())
+        self.head_stamp = stamp
+
+    def _update(self, head):
+        if head == self.head:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        # Several build steps may try to update the index at once
+        with open(self.index_path + ".lock", "w+") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            if head == self.head:
+                return
+            if head is None:
+                self.files = {}
+            elif self.head is not None and subprocess.call(
+                    ["git", "merge-base", "--is-ancestor", self.head, head],
+                    stderr=subprocess.DEVNULL) == 0:
+                for commit in iter_commits("%s..%s" %(self.head, head)):
+                    apply_commit(self.files, *commit)
+            else:
+                # First run, or history was rewritten
+                self.files = {}
+                for commit in iter_commits(head):
+                    apply_commit(self.files, *commit)
+            self.head = head
+            self._save()
+
+    def lookup(self, filename):
+        """Return the entry for `filename` (relative to the working directory),
+        with empty values if it was never committed."""
+        self.update()
+        path = os.path.relpath(os.path.realpath(filename), self.toplevel)
+        return self.files.get(path, dict(authors=[], pub_date=None, last_edit_date=None))
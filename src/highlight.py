@@ -0,0 +1,63 @@
+""" Memoized syntax highlighting, for the highlight_code filter.
+
+Guessing a lexer tries every lexer pygments has, and the same code blocks are
+highlighted again on every render of a page. Instead, lexers and formatters
+are resolved once per process, and highlighted html is cached (in memory, and
+on disk) under a hash of the code, the lexer and the formatter options.
+"""
+import collections, functools, json, threading
+
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import guess_lexer, get_lexer_by_name
+
+import build_cache, build_trace
+
+# Most highlighted blocks kept in memory, per process
+MEMORY_ENTRIES = 1024
+
+@functools.lru_cache(maxsize=None)
+def get_lexer(filetype):
+    return get_lexer_by_name(filetype)
+
+@functools.lru_cache(maxsize=None)
+def _get_formatter(options):
+    return HtmlFormatter(**dict(options))
+
+def get_formatter(**options):
+    return _get_formatter(tuple(sorted(options.items())))
+
+@functools.lru_cache(maxsize=None)
+def get_css():
+    """Return the CSS needed to perform syntax highlighting"""
+    return HtmlFormatter().get_style_defs('.highlight')
+
+class Highlighter(object):
+    def __init__(self, root):
+        self.cache = build_cache.BlobCache(root)
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def highlight(self, code, filetype=None, **options):
+        """Return `code` as highlighted html. If no `filetype` (a pygments
+        lexer name) is given, the lexer is guessed from the code."""
+        key = build_cache.step_key("highlight", pygments.__version__,
+            build_cache.hash_bytes(code.encode()), filetype or "", json.dumps(options, sort_keys=True))
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                build_trace.annotate(cache="memory")
+                return self.memory[key]
+        stored = self.cache.get(key)
+        build_trace.annotate(cache="miss" if stored is None else "disk")
+        if stored is not None:
+            html = stored.decode()
+        else:
+            lexer = get_lexer(filetype) if filetype else guess_lexer(code)
+            html = pygments.highlight(code, lexer, get_formatter(**options))
+            self.cache.put(key, html.encode())
+        with self.lock:
+            self.memory[key] = html
+            if len(self.memory) > MEMORY_ENTRIES:
+                self.memory.popitem(last=False)
+        return html
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+""" Smaller and WebP versions of raster images, for srcset/<picture>.
+
+For an image foo.png (or .jpg), the variants are named:
+
+    foo.png.<W>w.png    foo.png scaled down to W pixels wide, for each W in
+    foo.png.<W>w.webp   WIDTHS narrower than the image
+    foo.png.webp        foo.png at full size, as WebP
+
+Making a variant:
+    ./image_variants.py <source image> <variant>
+Showing how many bytes the variants save each page:
+    ./image_variants.py --report
+
+Variants are cached by the source's content hash, so they're only ever
+resized/encoded once.
+"""
+import io, os, re, sys
+
+import build_cache, build_trace
+
+# Keep in sync with IMAGE_WIDTHS in the Makefile
+WIDTHS = 480, 960, 1440
+# Formats that variants are made for (lower case), and their mime types
+SOURCE_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg"}
+WEBP_QUALITY = 80
+JPEG_QUALITY = 90
+
+VARIANT_NAME = re.compile(r"^(?P<source>.+?(?P<source_ext>\.png|\.jpg|\.jpeg))(\.(?P<width>[0-9]+)w)?(?P<ext>\.png|\.jpg|\.jpeg|\.webp)$",
+    re.IGNORECASE)
+
+def parse_variant(path):
+    """Return (source path, width or None, extension) if `path` names a
+    variant of an image, else None."""
+    m = VARIANT_NAME.match(path)
+    if m is None:
+        return None
+    width, ext = m.group("width"), m.group("ext").lower()
+    if width is None and ext != ".webp":
+        # That's just the image itself
+        return None
+    if width is not None and ext not in (".webp", m.group("source_ext").lower()):
+        return None
+    return m.group("source"), width and int(width), ext
+
+def get_variants(path, size):
+    """Return the variants to be made for the image at `path` of the given
+    (width, height), as a list of dicts with path, width, height and type.
+    Narrowest first."""
+    source_ext = os.path.splitext(path)[1].lower()
+    if source_ext not in SOURCE_TYPES or parse_variant(path) is not None:
+        return []
+    width, height = size
+    variants = []
+    for w in WIDTHS:
+        if w >= width:
+            break
+        h = max(1, round(height * w / width))
+        variants.append(dict(path="%s.%dw%s" %(path, w, source_ext), width=w, height=h, type=SOURCE_TYPES[source_ext]))
+        variants.append(dict(path="%s.%dw.webp" %(path, w), width=w, height=h, type="image/webp"))
+    variants.append(dict(path=path + ".webp", width=width, height=height, type="image/webp"))
+    return variants
+
+def encode_variant(data, width, ext):
+    """Resize the image `data` (bytes) to `width` (None to keep its size)
+    and encode it as `ext`. Returns bytes."""
+    import PIL, PIL.Image
+    im = PIL.Image.open(io.BytesIO(data))
+    if im.mode not in ("RGB", "RGBA", "L", "LA"):
+        im = im.convert("RGBA" if "transparency" in im.info or im.mode.endswith("A") else "RGB")
+    if width is not None:
+        height = max(1, round(im.size[1] * width / im.size[0]))
+        im = im.resize((width, height), PIL.Image.LANCZOS)
+    out = io.BytesIO()
+    if ext == ".webp":
+        im.save(out, "WEBP", quality=WEBP_QUALITY, method=6)
+    elif ext == ".png":
+        im.save(out, "PNG", optimize=True)
+    else:
+        im.convert("RGB").save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+@build_trace.step
+def main(in_path, out_path):
+    """Write the variant named by `out_path` of the image at `in_path`"""
+    import PIL
+    from page_info import config
+    cache_dir = config["build"]["cache"]
+    _source, width, ext = parse_variant(out_path)
+    data = open(in_path, "rb").read()
+    key = build_cache.step_key("variant", PIL.__version__, build_cache.hash_bytes(data),
+        str(width), ext, str(WEBP_QUALITY), str(JPEG_QUALITY))
+    cache = build_cache.BlobCache(os.path.join(cache_dir, "image_variants"))
+    variant = cache.get(key)
+    if variant is None:
+        variant = encode_variant(data, width, ext)
+        cache.put(key, variant)
+    build_cache.write_atomic(out_path, variant)
+
+def print_report():
+    """For each page, compare the bytes of its full-size images to those of
+    the smallest variants a browser may pick instead"""
+    import glob
+    from page_info import config, load_info
+    intermediate, output = config["build"]["intermediate"], config["build"]["output"]
+    total_full = total_small = 0
+    for build_path in sorted(glob.glob(os.path.join(intermediate, "**", "*.html.build"), recursive=True)):
+        page_full = page_small = 0
+        for dep in load_info(build_path)["rtdeps"]:
+            dep = dep.replace(output, intermediate)
+            if os.path.splitext(dep)[1].lower() not in SOURCE_TYPES or parse_variant(dep) is not None:
+                continue
+            try:
+                variants = load_info(dep + ".srcinfo").get("variants", [])
+                full = os.path.getsize(dep)
+                small = min([full] + [os.path.getsize(v["path"]) for v in variants if os.path.exists(v["path"])])
+            except FileNotFoundError:
+                continue
+            page_full += full
+            page_small += small
+        if page_full:
+            print("%10d -> %10d bytes (%5.1f%% saved)  %s" %(page_full, page_small,
+                100.0 * (page_full - page_small) / page_full, os.path.relpath(build_path[:-len(".build")], intermediate)))
+        total_full += page_full
+        total_small += page_small
+    print("%10d -> %10d bytes in total" %(total_full, total_small))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--report"]:
+        print_report()
+    elif len(sys.argv) == 3:
+        main(*sys.argv[1:])
+    else:
+        print("Usage: %s <source image> <variant> | --report" %sys.argv[0])
+        sys.exit(1)
@@ -0,0 +1,146 @@
+""" Header-only media metadata, with a persistent index keyed by content hash.
+
+Finding an image's size used to mean parsing the whole SVG, decoding the raster
+with PIL or running ffprobe. The dimensions are all stored near the start of
+the file, so only the headers are read here:
+
+    PNG     the IHDR chunk
+    GIF     the logical screen descriptor
+    JPEG    the first SOFn segment
+    SVG     the attributes of the root element (streaming parse)
+    WebM    PixelWidth/PixelHeight of the first video track (EBML)
+
+Results are stored in <root>/<hh>/<content hash>, so an image is only ever
+probed once, however many pages or builds ask for its size.
+"""
+import json, os, re, struct
+import xml.etree.ElementTree as ElementTree
+
+import build_cache, build_trace
+
+class UnknownFormat(Exception):
+    pass
+
+def png_size(f):
+    header = f.read(24)
+    if header[12:16] != b"IHDR":
+        raise UnknownFormat("PNG without an IHDR chunk")
+    return struct.unpack(">II", header[16:24])
+
+def gif_size(f):
+    return struct.unpack("<HH", f.read(10)[6:10])
+
+def jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        # Markers may be padded with any number of 0xff bytes
+        while marker[1:] == b"\xff":
+            marker = marker[1:] + f.read(1)
+        if len(marker) != 2 or marker[0] != 0xff:
+            raise UnknownFormat("JPEG without a SOF segment")
+        length, = struct.unpack(">H", f.read(2))
+        # SOF0..SOF15, except DHT (c4), JPG (c8) and DAC (cc)
+        if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+            _precision, height, width = struct.unpack(">BHH", f.read(5))
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+def svg_length(value):
+    """Parse an svg length such as "12.5pt", truncated to an int"""
+    return int(float(re.sub("[a-z%]+$", "", value.strip())))
+
+def svg_size(f):
+    for _event, root in ElementTree.iterparse(f, events=("start",)):
+        # Width and Height are stored as attributes on the root SVG element.
+        if "width" in root.attrib and "height" in root.attrib:
+            return svg_length(root.attrib["width"]), svg_length(root.attrib["height"])
+        _x, _y, width, height = re.split("[ ,]+", root.attrib["viewBox"].strip())
+        return svg_length(width), svg_length(height)
+
+# EBML element IDs needed to reach a WebM's video dimensions
+EBML_SEGMENT = 0x18538067
+EBML_TRACKS = 0x1654ae6b
+EBML_TRACK_ENTRY = 0xae
+EBML_VIDEO = 0xe0
+EBML_PIXEL_WIDTH = 0xb0
+EBML_PIXEL_HEIGHT = 0xba
+
+def read_vint(f, keep_marker):
+    """Read an EBML variable-length integer. Element IDs keep their length
+    marker bit; sizes don't. Returns None for a size of "unknown"."""
+    first = f.read(1)
+    if not first:
+        raise UnknownFormat("truncated EBML")
+    first = first[0]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnknownFormat("invalid EBML integer")
+    value = first if keep_marker else first & (0xff >> length)
+    rest = f.read(length - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None
+    return value
+
+def webm_size(f):
+    end = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    width = height = None
+    while f.tell() < end:
+        element = read_vint(f, keep_marker=True)
+        size = read_vint(f, keep_marker=False)
+        if element in (EBML_SEGMENT, EBML_TRACKS, EBML_TRACK_ENTRY, EBML_VIDEO):
+            # Descend into the element's children
+            continue
+        if element == EBML_PIXEL_WIDTH:
+            width = int.from_bytes(f.read(size), "big")
+        elif element == EBML_PIXEL_HEIGHT:
+            height = int.from_bytes(f.read(size), "big")
+        elif size is None:
+            raise UnknownFormat("unknown-sized element in WebM")
+        else:
+            f.seek(size, os.SEEK_CUR)
+        if width is not None and height is not None:
+            return width, height
+    raise UnknownFormat("WebM without a video track")
+
+def read_size(path):
+    """Return the (width, height) of the image or video at `path`, in pixels"""
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        f.seek(0)
+        if magic.startswith(b"\x89PNG"):
+            return png_size(f)
+        if magic.startswith(b"GIF8"):
+            return gif_size(f)
+        if magic.startswith(b"\xff\xd8"):
+            return jpeg_size(f)
+        if magic.startswith(b"\x1a\x45\xdf\xa3"):
+            return webm_size(f)
+        if magic.lstrip().startswith(b"<"):
+            return svg_size(f)
+    raise UnknownFormat("unrecognized media file: %s" %path)
+
+class MediaIndex(object):
+    def __init__(self, root):
+        self.cache = build_cache.BlobCache(root)
+
+    def get(self, path):
+        """Return the metadata of the media file at `path`, as a dict:
+        {"size": (width, height), "content_hash": ..., "byte_size": ...}"""
+        # hash_file is memoized by the file's mtime & size
+        content_hash = build_cache.hash_file(path)
+        if content_hash is None:
+            raise FileNotFoundError(path)
+        stored = self.cache.get(content_hash)
+        build_trace.annotate(cache="miss" if stored is None else "hit")
+        if stored is not None:
+            info = json.loads(stored.decode())
+        else:
+            info = dict(size=read_size(path), byte_size=os.path.getsize(path))
+            self.cache.put(content_hash, json.dumps(info).encode())
+        return dict(size=tuple(info["size"]), content_hash=content_hash, byte_size=info["byte_size"])
@@ -0,0 +1,90 @@
+""" Conservative HTML and CSS minification, applied to rendered pages.
+
+Only whitespace and comments are removed, and only where that can't change
+how the page renders:
+  - HTML: runs of whitespace in text and between attributes are collapsed
+    into a single character (as the browser would do anyway) and comments
+    are dropped; quoted attribute values (title, alt, srcset...) and the
+    contents of <pre>, <code>, <textarea> and <script> are left alone, and
+    <style> elements are minified as CSS.
+  - CSS: comments are dropped and whitespace is removed around braces,
+    semicolons, commas and child combinators; strings are left alone.
+"""
+import re
+
+# Elements whose content is whitespace-sensitive (or not html at all)
+PRESERVE_TAGS = "pre", "code", "textarea", "script"
+
+_PRESERVED = re.compile(r"(<(%s)\b.*?</\2\s*>)" %"|".join(PRESERVE_TAGS), re.DOTALL | re.IGNORECASE)
+_STYLE = re.compile(r"(<style\b[^>]*>)(.*?)(</style\s*>)", re.DOTALL | re.IGNORECASE)
+_HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+_WHITESPACE = re.compile(r"\s+")
+_TAG = re.compile(r"""<[a-zA-Z/!](?:[^>"']|"[^"]*"|'[^']*')*>""")
+_QUOTED = re.compile(r"""("[^"]*"|'[^']*')""")
+
+_CSS_TOKENS = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)""", re.DOTALL)
+_CSS_AROUND = re.compile(r"\s*([{};,>])\s*")
+_CSS_EMPTY_DECL = re.compile(r";}")
+
+def _collapse_whitespace(text):
+    return _WHITESPACE.sub(lambda m: "\n" if "\n" in m.group(0) else " ", text)
+
+def _collapse_html_whitespace(html):
+    """_collapse_whitespace, but for the quoted attribute values of tags"""
+    out = []
+    pos = 0
+    for m in _TAG.finditer(html):
+        out.append(_collapse_whitespace(html[pos:m.start()]))
+        # Every other part is a quoted value
+        parts = _QUOTED.split(m.group(0))
+        out.append("".join(p if i % 2 else _collapse_whitespace(p) for i, p in enumerate(parts)))
+        pos = m.end()
+    out.append(_collapse_whitespace(html[pos:]))
+    return "".join(out)
+
+def minify_css(css):
+    """Return `css` (str) without comments and needless whitespace"""
+    out = []
+    pos = 0
+    for m in _CSS_TOKENS.finditer(css):
+        out.append(_minify_css_code(css[pos:m.start()]))
+        if m.group(1):
+            # A string: keep as is
+            out.append(m.group(1))
+        pos = m.end()
+    out.append(_minify_css_code(css[pos:]))
+    return "".join(out).strip()
+
+def _minify_css_code(code):
+    code = _WHITESPACE.sub(" ", code)
+    code = _CSS_AROUND.sub(r"\1", code)
+    return _CSS_EMPTY_DECL.sub("}", code)
+
+def minify_html(html):
+    """Return `html` (str) without comments and needless whitespace"""
+    out = []
+    pos = 0
+    for m in _PRESERVED.finditer(html):
+        out.append(_minify_html_text(html[pos:m.start()]))
+        out.append(m.group(1))
+        pos = m.end()
+    out.append(_minify_html_text(html[pos:]))
+    return "".join(out).strip()
+
+def _minify_html_text(html):
+    html = _HTML_COMMENT.sub("", html)
+    parts = []
+    pos = 0
+    for m in _STYLE.finditer(html):
+        parts.append(_collapse_html_whitespace(html[pos:m.start()]))
+        parts.append(m.group(1) + minify_css(m.group(2)) + m.group(3))
+        pos = m.end()
+    parts.append(_collapse_html_whitespace(html[pos:]))
+    return "".join(parts)
+
+MINIFIERS = {".html": minify_html, ".css": minify_css}
+
+def minify(text, ext):
+    """Minify `text` according to the file extension `ext`.
+    Text of other types is returned as is."""
+    return MINIFIERS[ext](text) if ext in MINIFIERS else text
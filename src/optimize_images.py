@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+""" Lossless image optimization, with a content-hash results cache.
+
+Optimizing a single image:
+    ./optimize_images.py <source image> <destination>
+Optimizing every image under a directory, across all cores (the destination
+of pages/foo/bar.png is <cache dir>/foo/bar.png, as in the Makefile's rules):
+    ./optimize_images.py --all <source dir> <cache dir>
+Showing how much each optimizer saves, and how long it takes:
+    ./optimize_images.py --report <cache dir>
+
+Optimized bytes are keyed by the hash of the input and the optimizer's command
+line, so identical or re-touched images are never optimized twice.
+The optimizers' binaries are taken from the environment (see the Makefile);
+an empty value disables that optimizer.
+"""
+import concurrent.futures, fcntl, json, os, subprocess, sys, tempfile, time
+
+import build_cache, build_trace
+
+# Optimizer command lines, by extension. {in} and {out} are replaced by file
+# paths; optimizers without {out} modify {in} in place.
+OPTIMIZERS = {
+    ".png": ["$OPTIPNG", "--quiet", "{in}"],
+    ".jpg": ["$JPGCRUSH", "{in}"],
+    ".jpeg": ["$JPGCRUSH", "{in}"],
+    ".gif": ["$GIFSICLE", "-O3", "-b", "{in}"],
+    ".svg": ["$SCOUR", "-i", "{in}", "--enable-comment-stripping", "--enable-id-stripping",
+        "--create-groups", "--no-line-breaks", "--strip-xml-prolog", "-p", "10", "-o", "{out}"],
+}
+DEFAULT_BINARIES = dict(OPTIPNG="optipng", JPGCRUSH="jpgcrush", GIFSICLE="", SCOUR="scour")
+
+def get_command(ext):
+    """Return the optimizer command line for files with extension `ext`,
+    or None if there's no (enabled) optimizer for it."""
+    if ext not in OPTIMIZERS:
+        return None
+    binary = OPTIMIZERS[ext][0][1:]
+    binary = os.environ.get(binary, DEFAULT_BINARIES[binary])
+    if not binary:
+        return None
+    return [binary] + OPTIMIZERS[ext][1:]
+
+def stats_path(cache_dir):
+    return os.path.join(cache_dir, "optimize_stats.jsonl")
+
+def run_optimizer(command, data, ext):
+    """Run `command` over `data` (bytes); return the optimized bytes,
+    or None if the optimizer failed (e.g. isn't installed)."""
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path = os.path.join(tmp, "in" + ext)
+        out_path = os.path.join(tmp, "out" + ext)
+        open(in_path, "wb").write(data)
+        args = [a.replace("{in}", in_path).replace("{out}", out_path) for a in command]
+        try:
+            with build_trace.span(os.path.basename(command[0]), "external", target=in_path):
+                subprocess.check_call(args, stdout=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("%s failed: %s" %(command[0], e), file=sys.stderr)
+            return None
+        result_path = out_path if "{out}" in command else in_path
+        result = open(result_path, "rb").read()
+        # Never make an image bigger
+        return result if 0 < len(result) < len(data) else data
+
+@build_trace.traced("optimize", "step")
+def optimize(src, dst, cache_dir):
+    """Write an optimized copy of `src` to `dst`"""
+    ext = os.path.splitext(src)[1].lower()
+    command = get_command(ext)
+    if command is None:
+        build_cache.copy_file(src, dst)
+        return
+    data = open(src, "rb").read()
+    key = build_cache.step_key("optimize", build_cache.hash_bytes(data), *command)
+    cache = build_cache.BlobCache(os.path.join(cache_dir, "optimized"))
+    optimized = cache.get(key)
+    build_trace.annotate(cache="miss" if optimized is None else "hit")
+    if optimized is None:
+        start = time.time()
+        optimized = run_optimizer(command, data, ext)
+        elapsed = time.time() - start
+        if optimized is None:
+            # Not cached, so that the image is optimized once the tool is fixed
+            build_cache.write_atomic(dst, data)
+            return
+        cache.put(key, optimized)
+        record = dict(path=src, tool=command[0], bytes_in=len(data),
+            bytes_out=len(optimized), seconds=elapsed)
+        # Appends this small are atomic, so parallel optimizers don't interleave
+        with open(stats_path(cache_dir), "a") as f:
+            f.write(json.dumps(record) + "\n")
+    build_cache.write_atomic(dst, optimized)
+
+def needs_update(src, dst):
+    """Make's rule for when `dst` is out of date"""
+    return not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src)
+
+def optimize_all(src_dir, cache_dir):
+    """Optimize every out-of-date image under `src_dir`, using all cores"""
+    os.makedirs(cache_dir, exist_ok=True)
+    # Parallel (sub-)makes may start this at once: the later ones wait, then
+    # find everything up to date
+    with open(os.path.join(cache_dir, "optimize.lock"), "w+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _optimize_all(src_dir, cache_dir)
+
+def _optimize_all(src_dir, cache_dir):
+    jobs = []
+    for dirpath, _dirnames, filenames in os.walk(src_dir):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() not in OPTIMIZERS:
+                continue
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(cache_dir, os.path.relpath(src, src_dir))
+            if needs_update(src, dst):
+                jobs.append((src, dst))
+    with concurrent.futures.ProcessPoolExecutor(os.cpu_count()) as executor:
+        futures = [executor.submit(optimize, src, dst, cache_dir) for src, dst in jobs]
+        for future in futures:
+            future.result()
+
+def print_report(cache_dir):
+    """Summarize the recorded optimizations, per tool and per image"""
+    records = {}
+    try:
+        for line in open(stats_path(cache_dir)):
+            record = json.loads(line)
+            # Only the most recent optimization of each image is relevant
+            records[record["path"]] = record
+    except FileNotFoundError:
+        pass
+    by_tool = {}
+    for r in records.values():
+        entry = by_tool.setdefault(r["tool"], dict(images=0, bytes_in=0, bytes_out=0, seconds=0.0))
+        entry["images"] += 1
+        for key in ("bytes_in", "bytes_out", "seconds"):
+            entry[key] += r[key]
+    for tool, t in sorted(by_tool.items()):
+        saved = t["bytes_in"] - t["bytes_out"]
+        print("%-12s %5d images, %10d bytes saved (%4.1f%%), %8.2fs, %8d bytes/s" %(
+            tool, t["images"], saved, 100.0 * saved / max(t["bytes_in"], 1),
+            t["seconds"], saved / max(t["seconds"], 1e-9)))
+    print()
+    for r in sorted(records.values(), key=lambda r: r["bytes_in"] - r["bytes_out"], reverse=True):
+        print("%10d bytes saved %7.2fs  %s" %(r["bytes_in"] - r["bytes_out"], r["seconds"], r["path"]))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--all":
+        optimize_all(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 3 and sys.argv[1] == "--report":
+        print_report(sys.argv[2])
+    elif len(sys.argv) == 3 and not sys.argv[1].startswith("-"):
+        src, dst = sys.argv[1:]
+        # The cache dir is the root of dst's tree, like BUILD_CACHE
+        cache_dir = os.environ.get("BUILD_CACHE", os.path.dirname(dst))
+        optimize(src, dst, cache_dir)
+    else:
+        print("Usage: %s <source image> <destination> | --all <source dir> <cache dir> | --report <cache dir>" %sys.argv[0])
+        sys.exit(1)
@@ -1,18 +1,15 @@
 #!/usr/bin/env python3
-# Requires the following pip packages:
-# python-dateutil, jinja2
+""" The site's config, its .srcinfo/.build objects and the Page types.
 
-import json, os, subprocess, jsonpickle
-import re
+This is imported by every build step, so it's kept light: rendering (jinja2
+and the filters pages use) lives in page_render, and media inspection in
+media_info, which are only imported once a page is rendered or an image
+inspected.
+"""
 
-import dateutil.parser, jinja2, joblib, PIL.Image, pygments
-import xml.etree.ElementTree as ElementTree
-import jinja2.ext
-from jinja2 import Environment, PackageLoader, ChoiceLoader, FileSystemLoader, StrictUndefined
-from jinja2.utils import Namespace
-from urllib.parse import urlsplit
-from pygments.lexers import guess_lexer, get_lexer_by_name
-from pygments.formatters import HtmlFormatter
+import json, os
+
+import build_cache, build_store, build_trace
 
 
 CONFIG_PATH = "../build/config.json"
@@ -27,10 +24,12 @@ GFX_EXTENSIONS = IMG_EXTENSIONS + VID_EXTENSIONS
 FONT_EXTENSIONS = ".eot", ".ttf", ".woff", ".woff2"
 CSS_EXTENSIONS = ".css",
 
-# Config file read from .json on disk
-config = json.loads(open(CONFIG_PATH, "r").read())
+def load_config():
+    """Read the site config from CONFIG_PATH"""
+    return json.loads(open(CONFIG_PATH, "r").read())
 
-persistent = joblib.Memory(cachedir="../build/joblib", verbose=0)
+# Config file read from .json on disk
+config = load_config()
 
 def get_ext(path):
     """Return the extension of a filename.
@@ -40,90 +39,62 @@ def get_ext(path):
     """
     return os.path.splitext(path)[1]
 
-def highlight_code(code, filetype=None):
-    if filetype:
-        lexer = get_lexer_by_name(filetype)
-    else:
-        lexer = guess_lexer(code)
-    return pygments.highlight(code, lexer, HtmlFormatter())
-def get_highlight_css():
-    """Return the CSS needed to perform syntax highlighting"""
-    return HtmlFormatter().get_style_defs('.highlight')
-
-def filter_into_tag(value):
-    """Given some text, this returns a human-readable tag that closely
-    corresponds to the text but is safe to use in a URL.
-    Example:
-    >>> filter_into_tag("Hello, This is Arnold")
-    "hello-this-is-arnold"
-    """
-    valid = 'abcdefghijklmnopqrstuvwxyz0123456789'
-    # Make lowercase and replace illegal chars with hyphens
-    value = "".join([c if c in valid else '-' for c in value.lower()])
-    # Squash pairs of hyphens
-    while len(value) != len(value.replace("--", "-")):
-            value = value.replace("--", "-")
-
-    return value
-
-def filter_friendly_date(date):
-    """Takes a datetime.datetime object, returns a friendly version of the date, e.g. 'Jan 22, 2015'"""
-    return date.strftime("%b %d, %Y")
-
-def filter_detailed_date(date):
-    """Takes a datetime.datetime object, returns a detailed version of the date, e.g. 'Jan 22, 2015 at 8:09 PM PST'"""
-    return date.strftime("%b %d, %Y at %I:%M %p PST")
+_stores = {}
 
-def filter_drop_null_values(dict):
-    """Returns a new dict that contains only the items for which bool(item.value) == True
-    Example:
-    >>> filter_drop_null_values(dict(x=2, y=None, z="", k="yes", j="False"))
-    dict(x=2, k="yes", j="False")
-    """
+def get_store():
+    """Return the BuildStore holding all .srcinfo and .build objects"""
+    db_path = os.path.join(config["build"]["intermediate"], "build.db")
+    if db_path not in _stores:
+        _stores[db_path] = build_store.BuildStore(db_path)
+    return _stores[db_path]
 
-    filt = {}
-    for k, v in dict.items():
-        if v:
-            filt[k] = v
-    return filt
-
-def filter_url_with_args(path, **kwargs):
-    """Returns `path` + "?" + urlencode(kwargs),
-    or just `path` if there are no kwargs
-    """
-    urlargs = "?" + jinja2.filters.do_urlencode(kwargs) if kwargs else ""
-    return path + urlargs
+# .srcinfo/.build records, keyed by path.
+# Each entry is ((mtime, size), record).
+_info_cache = {}
 
-@persistent.cache
-def filter_tex_to_svg(tex):
-    """Convert LaTeX into an inline svg.
-    e.g. "e=mc^2"|tex
+def load_info(path):
+    """Return the .srcinfo or .build object stored at `path`, as a lazily
+    loaded build_store.Record.
+    Records are remembered for as long as the file is unchanged, so
+    long-lived processes (see build_server.py) don't reload them repeatedly.
     """
-    # Note: we prepend a space to fix bug in tex2svg when input is a number or starts with '-'
-    tex = subprocess.Popen(["tex2svg", "--inline", " " + tex], stdout=subprocess.PIPE)
-    res = subprocess.check_output(["scour", "-q", "-p" "10",
-            "--strip-xml-prolog",
-            "--enable-comment-stripping",
-            "--enable-id-stripping",
-            "--create-groups",
-        ], stdin=tex.stdout)
-    res = res.decode().strip()
-    if not "<svg" in res.lower():
-        print("ERROR IN filter_tex_to_svg: %r", res)
-        print("Is tex2svg installed? Install via 'npm install -g tex-equation-to-svg'")
-    return res
-    
-def filter_unique(it):
-    """Skip items if they've been seen before in the sequence.
+    build_cache.record_dep(path)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _info_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    info = get_store().get(path)
+    _info_cache[path] = (key, info)
+    return info
+
+def save_info(path, info):
+    """Store a .srcinfo or .build object (a dict) at `path`"""
+    get_store().put(path, build_store.pack(info))
+
+_media_indices = {}
+
+def get_media_index():
+    """Return the index of image/video sizes, keyed by content hash"""
+    import media_info
+    root = os.path.join(config["build"]["cache"], "media_info")
+    if root not in _media_indices:
+        _media_indices[root] = media_info.MediaIndex(root)
+    return _media_indices[root]
+
+def to_build_path(abs_path):
+    # TODO: result should be an absolute/canonical path!
+    return abs_path.replace(config['build']['intermediate'],
+            config['build']['output'])
+
+def path_from_root(path):
+    """ Treat `path' as a path relative to the intermediate root.
     """
-    seen = set()
-    for i in it:
-        if i not in seen:
-            seen.add(i)
-            yield i
+    return os.path.join(config['build']['intermediate'], path)
 
 
 
+@build_store.register_type
 class Page(object):
     @staticmethod
     def from_unknown_type(src_filename, **kwargs):
@@ -167,7 +138,7 @@ class Page(object):
         sometimes unpopulated. """
         # If there's info associated with the source, provide that, too.
         try:
-            src_srcinfo = jsonpickle.decode(open(self.src_srcinfo_file).read())
+            src_srcinfo = load_info(self.src_srcinfo_file)
         except FileNotFoundError:
             src_srcinfo = {}
 
@@ -190,138 +161,24 @@ class Page(object):
         )
 
     def get_build(self):
-        """ Default build rule for POD files """
+        """ Default build rule for POD files.
+        The content stays in the source file, and is referenced by its path,
+        and by its hash so that the record changes whenever the content does
+        (see extract_build.py). """
         build = self.base_build_info
         build['rtdeps'] = set()
-        build['content'] = \
-            open(self.src_filename, 'rb').read()
+        build['content_path'] = self.src_filename
+        build['content_hash'] = build_cache.hash_file(self.src_filename)
         return build
 
+@build_store.register_type
 class JinjaPage(Page):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def _get_jinja_env(self, do_render=False):
-        global config
-
-        src_info = Namespace(
-            title = "",
-            desc = "",
-            comments = dict(),
-            page_type = Page,
-            anchors = set(),
-            **self.base_src_info
-        )
-
-        def to_build_path(abs_path):
-            # TODO: result should be an absolute/canonical path!
-            return abs_path.replace(config['build']['intermediate'],
-                    config['build']['output'])
-        def path_from_root(path):
-            """ Treat `path' as a path relative to the intermediate root.
-            """
-            return os.path.join(config['build']['intermediate'], path)
-        def path_from_here(path):
-            """ Treat `path' as a path relative to the current folder
-            """
-            return os.path.join(self.intermediate_dir, path)
-
-        def to_rel_path(abs_path):
-            #build_root = config["build"]["output"] + "/"
-            #if abs_path.startswith(build_root):
-            #    abs_path = abs_path[len(build_root):]
-            # Separate the anchor, if it was provided
-            if "#" in abs_path:
-                abs_path, anchor = abs_path.split("#")
-            else:
-                anchor = ""
-            # Remove any stem that is common to (abs_path, build_path).
-            if abs_path.startswith(config['build']['output']):
-                parts_out, parts_abs = src_info.build_path.split("/"), abs_path.split("/")
-            else:
-                parts_out, parts_abs = src_info.intermediate_path.split("/"), abs_path.split("/")
-            while parts_out and parts_abs and parts_out[0] == parts_abs[0]:
-                del parts_out[0]
-                del parts_abs[0]
-            
-            # add necessary ../ parents
-            prefix = "../"*(len(parts_out)-1)
-            # Add the leaf
-            base = os.path.join(prefix, "/".join(parts_abs))
-            # Remove index.html from the path if configured to.
-            if base.endswith("index.html") and config["omit_index_from_url"]:
-                base = base[:-len("index.html")]
-            # Re-add the anchor, if there was one
-            retstr = "#".join((base, anchor)) if anchor else base
-            if retstr == "":
-                # old web browsers misinterpret empty href. See http://stackoverflow.com/questions/5637969/is-an-empty-href-valid
-                retstr = "#"
-            return retstr
-
-        def get_srcinfo(pg):
-            nonlocal src_info
-            basedir = os.path.dirname(self.src_filename)
-            full_path = os.path.join(basedir, pg) + ".srcinfo"
-            src_info.srcdeps.add(full_path)
-            if do_render:
-                # load the page info
-                info = jsonpickle.decode(open(full_path).read())
-                return info
-
-        def get_resource(pg):
-            nonlocal src_info
-            basedir = os.path.dirname(self.src_filename)
-            full_path = os.path.join(basedir, pg) + ".build"
-            src_info.srcdeps.add(full_path)
-            if do_render:
-                # load the page info
-                info = jsonpickle.decode(open(full_path).read())
-                return info
-
-
-        env = Environment(trim_blocks=True, lstrip_blocks=True, undefined=StrictUndefined,
-            extensions=[jinja2.ext.do],
-            loader=ChoiceLoader([
-                PackageLoader("__main__", TEMPLATE_DIR),
-                FileSystemLoader("/")
-            ]))
-
-        # Populate template global variables & filters
-        env.globals.update(config)
-        env.globals["do_render"] = do_render
-        env.globals["config"] = config
-        env.globals["get_srcinfo"] = get_srcinfo
-        # TODO: replace with get_resource
-        env.globals["get_page"] = get_resource
-        env.globals["get_image"] = get_srcinfo
-        env.globals["get_audio"] = get_srcinfo
-        env.filters["into_tag"] = filter_into_tag
-        env.filters["friendly_date"] = filter_friendly_date
-        env.filters["highlight_code"] = highlight_code
-        env.filters["detailed_date"] = filter_detailed_date
-        env.filters["drop_null_values"] = filter_drop_null_values
-        env.filters["url_with_args"] = filter_url_with_args
-        env.filters["unique"] = filter_unique
-        env.filters["tex"] = filter_tex_to_svg
-        env.filters["to_rel_path"] = to_rel_path
-        env.filters["to_build_path"] = to_build_path
-        env.filters["path_from_root"] = path_from_root
-        env.filters["path_from_here"] = path_from_here
-        env.globals["get_highlight_css"] = get_highlight_css
-        # Expose these types for passing to the `page.set_type` macro
-        env.globals["BlogEntry"] = BlogEntry
-        env.globals["HomePage"] = HomePage
-        env.globals["AboutPage"] = AboutPage
-        env.globals["Page"] = Page
-        env.globals['page_info'] = src_info
-
-        return env, src_info._Namespace__attrs
-
     def get_rendered_jinja(self, do_render):
-        env, jinja_info = self._get_jinja_env(do_render=do_render)
-
-        template = env.get_template(self.src_filename)
-        rendered = template.render().strip()
+        from page_render import render_page
+        jinja_info, rendered = render_page(self, do_render)
         # Don't rely on self!
         jinja_info['srcdeps'].discard(self.intermediate_path)
         jinja_info['rtdeps'].discard(self.intermediate_path)
@@ -329,54 +186,59 @@ class JinjaPage(Page):
         
         return jinja_info, rendered
 
-
-    def get_build(self):
-        """ Render a .jinja.html page to html. """
-        jinja_info, rendered = self.get_rendered_jinja(do_render=True)
-
+    def _build_from_render(self, jinja_info, rendered):
         build = self.base_build_info
+        if config["build"].get("minify"):
+            import minify
+            with build_trace.span("minify"):
+                rendered = minify.minify(rendered, get_ext(self.intermediate_path))
         build['content'] = rendered
         build['rtdeps'] = jinja_info['rtdeps']
         build['anchors'] = jinja_info['anchors']
-
         return build
 
+    def get_build(self):
+        """ Render a .jinja.html page to html. """
+        return self._build_from_render(*self.get_rendered_jinja(do_render=True))
+
     def get_src_info(self):
-        src_info, _rendered = self.get_rendered_jinja(do_render=False)
+        """ Collect the page's info by rendering it.
+        If everything the page depends on is already built, this is a full
+        render, and its result is kept as self.prerendered_build so that the
+        .build step needn't render the page again. Otherwise, the page is only
+        scanned for its dependencies. """
+        from page_render import MissingDependency
+        try:
+            src_info, rendered = self.get_rendered_jinja(do_render=True)
+        except MissingDependency:
+            src_info, _rendered = self.get_rendered_jinja(do_render=False)
+            return src_info
+        self.prerendered_build = self._build_from_render(src_info, rendered)
         return src_info
 
 
 
+@build_store.register_type
 class Image(Page):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
     @property
+    def media_info(self):
+        """Returns the image's size, content_hash and byte_size (see media_info.py)"""
+        with build_trace.span("Image.media_info", "media"):
+            return get_media_index().get(self.src_filename)
+
+    @property
     def size(self):
         """Returns the size of the image in pixels (width, height)"""
-        if get_ext(self.intermediate_path) == ".svg":
-            # PIL doesn't support SVG.
-            # Instead, parse as XML.
-            # Width and Height are stored as attributes on the root SVG element.
-            tree = ElementTree.parse(self.src_filename)
-            root = tree.getroot()
-            width = int(float(root.attrib["width"].replace("pt", "").replace("mm", "")))
-            height = int(float(root.attrib["height"].replace("pt", "").replace("mm", "")))
-            return (width, height)
-        elif get_ext(self.intermediate_path) in VID_EXTENSIONS:
-            cmd = "ffprobe -show_entries stream=height,width -v error -of flat=s=_ %s" %self.src_filename
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = p.communicate()
-            video_vars = {}
-            for line in output:
-                exec(line, video_vars)
-            return int(video_vars["streams_stream_0_width"]), int(video_vars["streams_stream_0_height"])
-        else:
-            im = PIL.Image.open(self.src_filename)
-            return im.size
+        return self.media_info["size"]
 
     def get_src_info(self):
         src_info = self.base_src_info
-        src_info['size'] = self.size
+        src_info.update(self.media_info)
+        # Smaller/WebP versions of the image, for srcset (see image_variants.py)
+        import image_variants
+        src_info['variants'] = image_variants.get_variants(self.intermediate_path, src_info['size'])
         return src_info
 
 
@@ -390,10 +252,12 @@ class Image(Page):
     #    else:
     #        return self
 
+@build_store.register_type
 class BinaryBlob(Page):
     def get_src_info(self):
         return self.base_src_info
 
+@build_store.register_type
 class Author(object):
     def __init__(self, name):
         self.name = name
@@ -402,12 +266,15 @@ class Author(object):
     def __hash__(self):
         return hash(self.name)
 
+@build_store.register_type
 class BlogEntry(Page):
     do_render_with_jinja = True
 
+@build_store.register_type
 class HomePage(Page):
     do_render_with_jinja = True
 
+@build_store.register_type
 class AboutPage(Page):
     do_render_with_jinja = True
 
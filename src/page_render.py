@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+""" Rendering of jinja pages: the shared jinja Environment, with the template
+globals & filters pages use (get_srcinfo, tex, highlight_code, ...).
+
+This is the heavy half of page_info (jinja2, joblib, pygments...), split off
+so that build steps which only read .srcinfo/.build objects (extract_*.py)
+don't pay for importing it. page_info.JinjaPage imports it when a page is
+first rendered.
+"""
+import base64, copy, mimetypes, os, threading, urllib.parse
+
+import build_cache, build_trace, critical_css, highlight, tex_render
+from page_info import AboutPage, BlogEntry, HomePage, Page, TEMPLATE_DIR, config, load_info, path_from_root, to_build_path
+
+import jinja2, joblib
+import jinja2.ext
+from jinja2 import Environment, PackageLoader, ChoiceLoader, FileSystemLoader, FileSystemBytecodeCache, StrictUndefined
+from jinja2.utils import Namespace
+
+
+# Relative to src/, like page_info.CONFIG_PATH
+JOBLIB_DIR = "../build/joblib"
+persistent = joblib.Memory(cachedir=JOBLIB_DIR, verbose=0)
+
+_highlighters = {}
+
+def get_highlighter():
+    """Return the memoizing syntax highlighter (see highlight.py)"""
+    root = os.path.join(config["build"]["cache"], "highlight")
+    if root not in _highlighters:
+        _highlighters[root] = highlight.Highlighter(root)
+    return _highlighters[root]
+
+@build_trace.traced("highlight_code", "filter")
+def highlight_code(code, filetype=None, **options):
+    return get_highlighter().highlight(code, filetype, **options)
+def get_highlight_css():
+    """Return the CSS needed to perform syntax highlighting"""
+    return highlight.get_css()
+
+def filter_into_tag(value):
+    """Given some text, this returns a human-readable tag that closely
+    corresponds to the text but is safe to use in a URL.
+    Example:
+    >>> filter_into_tag("Hello, This is Arnold")
+    "hello-this-is-arnold"
+    """
+    valid = 'abcdefghijklmnopqrstuvwxyz0123456789'
+    # Make lowercase and replace illegal chars with hyphens
+    value = "".join([c if c in valid else '-' for c in value.lower()])
+    # Squash pairs of hyphens
+    while len(value) != len(value.replace("--", "-")):
+            value = value.replace("--", "-")
+
+    return value
+
+def filter_friendly_date(date):
+    """Takes a datetime.datetime object, returns a friendly version of the date, e.g. 'Jan 22, 2015'"""
+    return date.strftime("%b %d, %Y")
+
+def filter_detailed_date(date):
+    """Takes a datetime.datetime object, returns a detailed version of the date, e.g. 'Jan 22, 2015 at 8:09 PM PST'"""
+    return date.strftime("%b %d, %Y at %I:%M %p PST")
+
+def filter_drop_null_values(dict):
+    """Returns a new dict that contains only the items for which bool(item.value) == True
+    Example:
+    >>> filter_drop_null_values(dict(x=2, y=None, z="", k="yes", j="False"))
+    dict(x=2, k="yes", j="False")
+    """
+
+    filt = {}
+    for k, v in dict.items():
+        if v:
+            filt[k] = v
+    return filt
+
+def filter_url_with_args(path, **kwargs):
+    """Returns `path` + "?" + urlencode(kwargs),
+    or just `path` if there are no kwargs
+    """
+    urlargs = "?" + jinja2.filters.do_urlencode(kwargs) if kwargs else ""
+    return path + urlargs
+
+@persistent.cache
+def filter_tex_to_svg(tex):
+    """Convert LaTeX into an inline svg.
+    e.g. "e=mc^2"|tex
+    """
+    res = tex_render.get_renderer().render(tex)
+    if not "<svg" in res.lower():
+        print("ERROR IN filter_tex_to_svg: %r", res)
+        print("Is tex2svg installed? Install via 'npm install -g tex-equation-to-svg'")
+    return res
+
+def render_equation(tex):
+    """filter_tex_to_svg, traced along with whether its persistent cache hit"""
+    with build_trace.span("tex_to_svg", "filter") as trace:
+        hit = filter_tex_to_svg.check_call_in_cache(tex)
+        build_cache.count_lookup(JOBLIB_DIR, hit)
+        trace["cache"] = "hit" if hit else "miss"
+        return filter_tex_to_svg(tex)
+    
+def filter_unique(it):
+    """Skip items if they've been seen before in the sequence.
+    """
+    seen = set()
+    for i in it:
+        if i not in seen:
+            seen.add(i)
+            yield i
+
+class MissingDependency(Exception):
+    """A page referenced a .srcinfo or .build object that hasn't been built (yet)"""
+    pass
+
+# What the current thread is rendering. Set by rendering(); read by the
+# template globals & filters below, since the Environment is shared by all pages.
+_render = threading.local()
+
+class rendering(object):
+    """Context manager making `page` the page rendered by the current thread"""
+    def __init__(self, page, src_info, do_render, equations, styles):
+        self.state = dict(page=page, src_info=src_info, do_render=do_render, equations=equations, styles=styles)
+    def __enter__(self):
+        self.previous = dict(_render.__dict__)
+        _render.__dict__.update(self.state)
+    def __exit__(self, *exc):
+        _render.__dict__.clear()
+        _render.__dict__.update(self.previous)
+
+class PageInfoProxy(Namespace):
+    """The `page_info` global: the src_info Namespace of the page being rendered"""
+    def __init__(self):
+        pass
+    def __getattribute__(self, name):
+        if name == "__class__":
+            return object.__getattribute__(self, name)
+        return getattr(_render.src_info, name)
+    def __setitem__(self, name, value):
+        _render.src_info[name] = value
+    def __repr__(self):
+        return repr(_render.src_info)
+
+class RenderFlag(object):
+    """The `do_render` global: whether dependencies are available (True), or
+    the page is only being scanned for them (False)"""
+    def __bool__(self):
+        return _render.do_render
+
+def path_from_here(path):
+    """ Treat `path' as a path relative to the current folder
+    """
+    return os.path.join(_render.page.intermediate_dir, path)
+
+def to_rel_path(abs_path):
+    src_info = _render.src_info
+    #build_root = config["build"]["output"] + "/"
+    #if abs_path.startswith(build_root):
+    #    abs_path = abs_path[len(build_root):]
+    # Separate the anchor, if it was provided
+    if "#" in abs_path:
+        abs_path, anchor = abs_path.split("#")
+    else:
+        anchor = ""
+    # Remove any stem that is common to (abs_path, build_path).
+    if abs_path.startswith(config['build']['output']):
+        parts_out, parts_abs = src_info.build_path.split("/"), abs_path.split("/")
+    else:
+        parts_out, parts_abs = src_info.intermediate_path.split("/"), abs_path.split("/")
+    while parts_out and parts_abs and parts_out[0] == parts_abs[0]:
+        del parts_out[0]
+        del parts_abs[0]
+
+    # add necessary ../ parents
+    prefix = "../"*(len(parts_out)-1)
+    # Add the leaf
+    base = os.path.join(prefix, "/".join(parts_abs))
+    # Remove index.html from the path if configured to.
+    if base.endswith("index.html") and config["omit_index_from_url"]:
+        base = base[:-len("index.html")]
+    # Re-add the anchor, if there was one
+    retstr = "#".join((base, anchor)) if anchor else base
+    if retstr == "":
+        # old web browsers misinterpret empty href. See http://stackoverflow.com/questions/5637969/is-an-empty-href-valid
+        retstr = "#"
+    return retstr
+
+def _get_dependency(pg, ext):
+    basedir = os.path.dirname(_render.page.src_filename)
+    # Normalized, so that each target has a single name (e.g. "../a" from b/ is a)
+    full_path = os.path.normpath(os.path.join(basedir, pg)) + ext
+    _render.src_info.srcdeps.add(full_path)
+    if _render.do_render:
+        # load the page info
+        try:
+            return load_info(full_path)
+        except FileNotFoundError:
+            raise MissingDependency(full_path)
+
+def get_srcinfo(pg):
+    return _get_dependency(pg, ".srcinfo")
+
+def get_resource(pg):
+    return _get_dependency(pg, ".build")
+
+def filter_critical_css(css_page):
+    """Return the rules of the stylesheet `css_page` (an intermediate path)
+    used by the page. These are only known once the page is rendered, so a
+    placeholder is returned (see critical_css.PageStyles)."""
+    build = get_resource(css_page)
+    if build is None:
+        # Only scanning for dependencies
+        return ""
+    return _render.styles.placeholder(build["content"], css_page)
+
+def filter_data_uri(resource):
+    """Return the content of `resource` (a .srcinfo) as a data: URI, if it's
+    at most config.build.inline_max_bytes, else "". Small images are cheaper
+    inline than as one more request through the gateway; the macros using
+    this leave inlined images out of the page's rtdeps, so they're not
+    published on their own."""
+    limit = config["build"].get("inline_max_bytes", 0)
+    path = resource["intermediate_src_path"]
+    mime = mimetypes.guess_type(resource["intermediate_path"])[0]
+    if not limit or mime is None or os.path.getsize(path) > limit:
+        return ""
+    build_cache.record_dep(path)
+    data = open(path, "rb").read()
+    if mime == "image/svg+xml":
+        # Percent-encoded text is smaller than base64. No quotes, spaces or
+        # parentheses are left, so the URI can go in an attribute or url() as-is.
+        return "data:image/svg+xml," + urllib.parse.quote(data.decode("utf-8"), safe="/:=;,-._~!*")
+    return "data:%s;base64,%s" %(mime, base64.b64encode(data).decode("ascii"))
+
+def filter_tex(tex):
+    # Equations are rendered all at once, after the rest of the page
+    equations = getattr(_render, "equations", None)
+    return equations.placeholder(tex) if equations else filter_tex_to_svg(tex)
+
+class RecordingEnvironment(Environment):
+    """Environment noting each template it hands out as a dependency of the
+    current build step (see build_cache.record_dep), even when the template
+    was already loaded for an earlier page."""
+    def get_template(self, name, parent=None, globals=None):
+        template = super().get_template(name, parent, globals)
+        if template.filename:
+            build_cache.record_dep(template.filename)
+        return template
+
+# Shared by all pages rendered by this process, along with the config it was built from
+_jinja_env = None
+_jinja_env_config = None
+
+def get_jinja_env():
+    """Return the Environment used to render every page.
+    Compiled templates are kept in memory, and on disk in a bytecode cache."""
+    if _jinja_env is not None and _jinja_env_config == config:
+        return _jinja_env
+    with build_trace.span("create environment", "jinja"):
+        return _create_jinja_env()
+
+def _create_jinja_env():
+    global _jinja_env, _jinja_env_config
+    bytecode_dir = os.path.join(config["build"]["cache"], "jinja")
+    os.makedirs(bytecode_dir, exist_ok=True)
+    env = RecordingEnvironment(trim_blocks=True, lstrip_blocks=True, undefined=StrictUndefined,
+        extensions=[jinja2.ext.do],
+        bytecode_cache=FileSystemBytecodeCache(bytecode_dir),
+        loader=ChoiceLoader([
+            PackageLoader("__main__", TEMPLATE_DIR),
+            FileSystemLoader("/")
+        ]))
+
+    # Populate template global variables & filters
+    env.globals.update(config)
+    env.globals["do_render"] = RenderFlag()
+    env.globals["config"] = config
+    env.globals["get_srcinfo"] = get_srcinfo
+    # TODO: replace with get_resource
+    env.globals["get_page"] = get_resource
+    env.globals["get_image"] = get_srcinfo
+    env.globals["get_audio"] = get_srcinfo
+    env.filters["into_tag"] = filter_into_tag
+    env.filters["friendly_date"] = filter_friendly_date
+    env.filters["highlight_code"] = highlight_code
+    env.filters["detailed_date"] = filter_detailed_date
+    env.filters["drop_null_values"] = filter_drop_null_values
+    env.filters["url_with_args"] = filter_url_with_args
+    env.filters["unique"] = filter_unique
+    env.filters["tex"] = filter_tex
+    env.filters["critical_css"] = filter_critical_css
+    env.filters["data_uri"] = filter_data_uri
+    env.filters["to_rel_path"] = to_rel_path
+    env.filters["to_build_path"] = to_build_path
+    env.filters["path_from_root"] = path_from_root
+    env.filters["path_from_here"] = path_from_here
+    env.globals["get_highlight_css"] = get_highlight_css
+    # Expose these types for passing to the `page.set_type` macro
+    env.globals["BlogEntry"] = BlogEntry
+    env.globals["HomePage"] = HomePage
+    env.globals["AboutPage"] = AboutPage
+    env.globals["Page"] = Page
+    env.globals['page_info'] = PageInfoProxy()
+
+    _jinja_env, _jinja_env_config = env, copy.deepcopy(config)
+    return env
+
+
+def render_page(page, do_render):
+    """Render the JinjaPage `page`. Returns (src_info, rendered text).
+    Unless `do_render`, the page is only scanned for its dependencies."""
+    src_info = Namespace(
+        title = "",
+        desc = "",
+        comments = dict(),
+        page_type = Page,
+        anchors = set(),
+        **page.base_src_info
+    )
+    # Equations are rendered on other threads
+    equations = tex_render.PageEquations(build_trace.bind(render_equation))
+    styles = critical_css.PageStyles(page.intermediate_path, config["build"]["cache"])
+    with rendering(page, src_info, do_render, equations, styles):
+        with build_trace.span("render", "jinja", do_render=do_render):
+            template = get_jinja_env().get_template(page.src_filename)
+            rendered = template.render()
+        with build_trace.span("tex equations", "filter", count=len(equations.equations)):
+            rendered = equations.substitute(rendered)
+        with build_trace.span("critical_css", "filter"):
+            rendered = styles.substitute(rendered).strip()
+    return src_info._Namespace__attrs, rendered
@@ -18,9 +18,23 @@
 ##### ipfs.yourdomain.com/XYZ will serve the IPFS object: QmRpCcmoMWVEa8mYn1bczeUDxS2QUcsysodPUBuMkxfzPN/XYZ
 
 # Note: Cloudflare API docs: https://api.cloudflare.com/
+#
+# All zones are updated concurrently, over one pooled session. The zone and
+# record ids, and the content last written to each record, are cached in the
+# id cache file, so an unchanged record costs no API calls at all (pass
+# --refresh to look everything up again). Given publish_ipfs.py's manifest,
+# only the URLs of the files that changed in the last publish are purged
+# from Cloudflare's cache, rather than everything.
+#
+# fake_cloudflare_api.py serves a local stand-in for testing; point
+# $CLOUDFLARE_API at it.
+
 
+import concurrent.futures, json, os, sys, threading
 
-import json, requests, sys
+import requests
+
+import build_cache
 
 # Cloudflare Name for the DNS TXT entries that we wish to link to IPFS, plus the root address relative to the ipfs folder we publish.
 dnslink_subdomains = {
@@ -44,51 +58,165 @@ dnslink_subdomains = {
 
 user_email = "wallacoloo@gmail.com"
 
-def api_call(api_key, api_path, params=None, method="GET", data=None):
-    """Make an API call to the given url with params=dict(), data=object() or None.
-    `data` will be cast to JSON before being sent.
-    The response is a python dict, parsed from the server's JSON response."""
-    headers = {
-            'X-Auth-Email': user_email,
-            'X-Auth-Key': api_key,
-            'Content-Type': 'application/json'
-    }
-    r = requests.request(method, "https://api.cloudflare.com/client/v4" + api_path, params=params, headers=headers, data=json.dumps(data) if data else None)
-    print(r.text)
-    return json.loads(r.text)
+DEFAULT_API = "https://api.cloudflare.com/client/v4"
+# Most URLs Cloudflare accepts per purge request
+PURGE_BATCH = 30
+
+class CloudflareError(Exception):
+    pass
+
+class Api(object):
+    def __init__(self, api_key, url=None):
+        self.url = (url or os.environ.get("CLOUDFLARE_API") or DEFAULT_API).rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=len(dnslink_subdomains))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+                'X-Auth-Email': user_email,
+                'X-Auth-Key': api_key,
+                'Content-Type': 'application/json'
+        })
+
+    def call(self, api_path, params=None, method="GET", data=None):
+        """Make an API call to the given url with params=dict(), data=object() or None.
+        `data` will be cast to JSON before being sent.
+        Returns the "result" of the server's JSON response."""
+        r = self.session.request(method, self.url + api_path, params=params, data=json.dumps(data) if data else None)
+        try:
+            response = r.json()
+        except ValueError:
+            raise CloudflareError("%s %s: HTTP %d" %(method, api_path, r.status_code))
+        if not response.get("success"):
+            raise CloudflareError("%s %s: %s" %(method, api_path, response.get("errors")))
+        return response["result"]
+
+class IdCache(object):
+    """Zone ids, and the TXT records (with their ids) as last written"""
+    def __init__(self, path, load=True):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            self.data = json.loads(open(path).read()) if path and load else {}
+        except FileNotFoundError:
+            self.data = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
 
-def get_zone_id(api_key, site_name):
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def save(self):
+        if self.path:
+            build_cache.write_atomic(self.path, json.dumps(self.data, indent=1, sort_keys=True).encode())
+
+def get_zone_id(api, ids, site_name):
     """Return the CloudFlare id of the website with name 'site_name'"""
-    r = api_call(api_key, "/zones", params={'name': site_name})
-    return r["result"][0]["id"]
+    key = "zone:" + site_name
+    if ids.get(key) is None:
+        ids.set(key, api.call("/zones", params={'name': site_name})[0]["id"])
+    return ids.get(key)
 
-def get_dns_txt_info(api_key, zone_id, dns_name):
-    """Return the CloudFlare id of the DNS TXT entry with name=ipfs for the given zone_id"""
-    r = api_call(api_key, "/zones/%s/dns_records" %zone_id, params={'type': 'TXT', 'name': dns_name})
-    return r["result"][0] # TODO: a subdomain may have multiple TXT records!
+def get_dns_txt_info(api, zone_id, dns_name):
+    """Return the CloudFlare DNS TXT entry with name=dns_name for the given zone_id"""
+    r = api.call("/zones/%s/dns_records" %zone_id, params={'type': 'TXT', 'name': dns_name})
+    return r[0] # TODO: a subdomain may have multiple TXT records!
 
-def update_txt_record(api_key, zone_id, record_data):
-    """Update the TXT dns record to direct to the given ipfs object"""
-    r = api_call(api_key, "/zones/%s/dns_records/%s" %(zone_id, record_data["id"]), method="PUT", data=record_data)
+def update_txt_record(api, ids, zone_id, dns_name, content):
+    """Point the TXT dns record `dns_name` to `content`, unless it already does.
+    Returns whether the record was changed."""
+    key = "record:%s:%s" %(zone_id, dns_name)
+    record = ids.get(key) or get_dns_txt_info(api, zone_id, dns_name)
+    if record["content"] == content:
+        ids.set(key, record)
+        return False
+    record = dict(record, content=content)
+    api.call("/zones/%s/dns_records/%s" %(zone_id, record["id"]), method="PUT", data=record)
+    ids.set(key, record)
+    return True
 
-def purge_cache(api_key, zone_id):
-    """Purge all files in the given zone from Cloudflare's cache"""
-    r = api_call(api_key, "/zones/%s/purge_cache" %zone_id, method="DELETE", data={"purge_everything": True})
+def get_changed_urls(changed, dns_name, leaf):
+    """Return the URLs under https://`dns_name`/ (which serves the published
+    folder `leaf`) of the published files `changed`"""
+    prefix = leaf.strip("/") + "/" if leaf.strip("/") else ""
+    urls = []
+    for path in changed:
+        if not path.startswith(prefix):
+            continue
+        url = "https://%s/%s" %(dns_name, path[len(prefix):])
+        urls.append(url)
+        # Pages are also reached by their folder
+        if url.endswith("/index.html"):
+            urls.append(url[:-len("index.html")])
+    return urls
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: %s <API Key> <IPFS id of website root>" %(sys.argv[0] if sys.argv else "update_cloudflare.py"))
-        sys.exit(1)
+def purge_cache(api, zone_id, urls=None):
+    """Purge `urls` (or, if None, all files) in the given zone from Cloudflare's cache"""
+    if urls is None:
+        api.call("/zones/%s/purge_cache" %zone_id, method="POST", data={"purge_everything": True})
+        return
+    for i in range(0, len(urls), PURGE_BATCH):
+        api.call("/zones/%s/purge_cache" %zone_id, method="POST", data={"files": urls[i:i+PURGE_BATCH]})
 
-    api_key = sys.argv[1]
-    ipfs_id = sys.argv[2]
-    
-    for zone_name, dnslinks in dnslink_subdomains.items():
-        zone_id = get_zone_id(api_key, zone_name)
-        for sub, leaf in dnslinks.items():
-            print("updating", sub, "for", zone_name)
-            dns_entry = get_dns_txt_info(api_key, zone_id, sub)
-            dns_entry["content"] = "dnslink=/ipfs/%s" %ipfs_id + leaf
-            update_txt_record(api_key, zone_id, dns_entry)
-        purge_cache(api_key, zone_id)
+def update_zone(api, ids, zone_name, dnslinks, ipfs_id, changed):
+    """Point the zone's dnslinks to `ipfs_id` and purge what changed (all, if `changed` is None)"""
+    zone_id = get_zone_id(api, ids, zone_name)
+    urls = [] if changed is not None else None
+    for sub, leaf in dnslinks.items():
+        if update_txt_record(api, ids, zone_id, sub, "dnslink=/ipfs/%s" %ipfs_id + leaf):
+            print("updated", sub, "for", zone_name, flush=True)
+        if urls is not None:
+            urls += get_changed_urls(changed, sub, leaf)
+    if urls is None or urls:
+        purge_cache(api, zone_id, urls)
+        print("purged", "everything" if urls is None else "%d urls" %len(urls), "for", zone_name, flush=True)
 
+def update_zone_retrying(api, ids, zone_name, dnslinks, ipfs_id, changed):
+    """update_zone, looking the ids up again if the cached ones are stale"""
+    try:
+        update_zone(api, ids, zone_name, dnslinks, ipfs_id, changed)
+    except CloudflareError as e:
+        print("retrying %s without cached ids (%s)" %(zone_name, e), flush=True)
+        zone_id = ids.get("zone:" + zone_name)
+        ids.discard("zone:" + zone_name)
+        for sub in dnslinks:
+            ids.discard("record:%s:%s" %(zone_id, sub))
+        update_zone(api, ids, zone_name, dnslinks, ipfs_id, changed)
+
+def main(api_key, ipfs_id, manifest_path=None, ids_path=None, refresh=False):
+    api = Api(api_key)
+    ids = IdCache(ids_path, load=not refresh)
+    changed = None
+    if manifest_path:
+        try:
+            changed = json.loads(open(manifest_path).read())["changed"]
+        except FileNotFoundError:
+            pass
+    with concurrent.futures.ThreadPoolExecutor(len(dnslink_subdomains)) as executor:
+        futures = [executor.submit(update_zone_retrying, api, ids, zone_name, dnslinks, ipfs_id, changed)
+            for zone_name, dnslinks in dnslink_subdomains.items()]
+        try:
+            for f in futures:
+                f.result()
+        finally:
+            ids.save()
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    refresh = "--refresh" in args
+    args = [a for a in args if a != "--refresh"]
+    if not 2 <= len(args) <= 4:
+        print("Usage: %s [--refresh] <API Key> <IPFS id of website root> [<publish manifest> [<id cache>]]" %(sys.argv[0] if sys.argv else "update_cloudflare.py"))
+        sys.exit(1)
+    try:
+        main(*args, refresh=refresh)
+    except (CloudflareError, requests.ConnectionError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+""" Publish the build output to IPFS, adding only what changed since the last publish.
+
+`ipfs add -r` re-hashes and re-chunks the whole output on every publish.
+Instead, a manifest of the last publish is kept: the content hash and CID of
+each file, and the root CID. Only files whose content changed are added; the
+previous root is copied into MFS (the IPFS daemon's mutable filesystem), the
+changed files are swapped in, removed ones deleted, and the MFS directory's
+hash is the new root.
+
+    ./publish_ipfs.py [--subsite <folder>] <output dir> <manifest> > <ipfs id file>
+
+The new root CID is printed on stdout (progress goes to stderr), and pinned.
+With --subsite, only that folder of the output (e.g. twi-dance, built alone by
+`make all SUBSITE=twi-dance`) is scanned and patched: its subtree CID is
+spliced into the previous root, and the rest of the site is left as it was.
+The daemon's API is at $IPFS_API (default http://127.0.0.1:5001/api/v0);
+fake_ipfs_api.py serves a local stand-in for testing.
+
+The manifest also records which files the last publish changed, for
+publish_cloudflare.py to purge.
+"""
+import concurrent.futures, json, os, posixpath, sys
+
+import requests
+
+import build_cache
+
+DEFAULT_API = "http://127.0.0.1:5001/api/v0"
+# Where the site is assembled in MFS
+MFS_ROOT = "/mooooo-publish"
+# Files added to the daemon at once
+ADD_JOBS = 8
+
+class IpfsError(Exception):
+    pass
+
+class IpfsApi(object):
+    """Minimal client of the IPFS daemon's HTTP API, over a pooled session"""
+    def __init__(self, url=None):
+        self.url = (url or os.environ.get("IPFS_API") or DEFAULT_API).rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=ADD_JOBS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def call(self, command, *args, files=None, **params):
+        """Run the API `command` (e.g. "files/cp") with the positional `args`
+        and the options `params`. Returns the parsed JSON response, if any."""
+        params = dict(params, arg=list(args)) if args else params
+        params = {k: (str(v).lower() if isinstance(v, bool) else v) for k, v in params.items()}
+        r = self.session.post("%s/%s" %(self.url, command), params=params, files=files)
+        if r.status_code != 200:
+            try:
+                message = r.json()["Message"]
+            except ValueError:
+                message = r.text
+            raise IpfsError("%s %s: %s" %(command, " ".join(args), message))
+        return r.json() if r.text.strip() else None
+
+    def add(self, path):
+        """Add the file at `path` (unpinned; the root gets pinned). Returns its CID."""
+        with open(path, "rb") as f:
+            r = self.call("add", files={"file": (os.path.basename(path), f)}, pin=False, quieter=True)
+        return r["Hash"]
+
+    def exists(self, mfs_path):
+        try:
+            self.call("files/stat", mfs_path)
+            return True
+        except IpfsError:
+            return False
+
+def load_manifest(path):
+    """Return the manifest of the last publish: {"root": CID or None,
+    "files": {path: {"hash", "cid", "mtime", "size"}}, "changed": [path]}"""
+    try:
+        return json.loads(open(path).read())
+    except FileNotFoundError:
+        return dict(root=None, files={}, changed=[])
+
+def in_subtree(path, subtree):
+    return subtree is None or path.startswith(subtree + "/")
+
+def scan_output(output_dir, previous, subtree=None):
+    """Return {path (relative to `output_dir`): entry} for every file of the
+    output (or of its folder `subtree`). Files whose mtime and size match
+    their `previous` entry aren't re-hashed."""
+    files = {}
+    for dirpath, _dirnames, filenames in os.walk(os.path.join(output_dir, subtree or "")):
+        for name in filenames:
+            full = os.path.join(dirpath, name)
+            rel = os.path.relpath(full, output_dir).replace(os.sep, "/")
+            st = os.stat(full)
+            old = previous.get(rel)
+            if old is not None and (old["mtime"], old["size"]) == (st.st_mtime_ns, st.st_size):
+                files[rel] = dict(old)
+                continue
+            digest = build_cache.hash_file(full)
+            cid = old["cid"] if old is not None and old["hash"] == digest else None
+            files[rel] = dict(hash=digest, cid=cid, mtime=st.st_mtime_ns, size=st.st_size)
+    return files
+
+def log(*args):
+    print(*args, file=sys.stderr, flush=True)
+
+def publish(output_dir, manifest_path, api=None, mfs_root=MFS_ROOT, subtree=None):
+    """Publish `output_dir` (or only its folder `subtree`), given the manifest
+    of the last publish. Returns the new root CID."""
+    api = api or IpfsApi()
+    manifest = load_manifest(manifest_path)
+    previous = manifest["files"]
+    files = scan_output(output_dir, previous, subtree)
+
+    # Start from the previous root, if the daemon still has it
+    if api.exists(mfs_root):
+        api.call("files/rm", mfs_root, recursive=True)
+    incremental = False
+    if manifest["root"]:
+        try:
+            api.call("files/cp", "/ipfs/" + manifest["root"], mfs_root)
+            incremental = True
+        except IpfsError as e:
+            log("can't reuse the last publish (%s); adding everything" %e)
+    if not incremental:
+        if subtree is not None:
+            raise IpfsError("no previous publish to splice %s into: publish the whole site first" %subtree)
+        api.call("files/mkdir", mfs_root, parents=True)
+
+    changed = sorted(p for p, f in files.items() if not incremental
+        or p not in previous or previous[p]["hash"] != f["hash"])
+    removed = sorted(p for p in previous if p not in files and in_subtree(p, subtree)) if incremental else []
+
+    # Add the changed files' content, in parallel
+    with concurrent.futures.ThreadPoolExecutor(ADD_JOBS) as executor:
+        cids = executor.map(lambda p: api.add(os.path.join(output_dir, p)), changed)
+        for p, cid in zip(changed, cids):
+            files[p]["cid"] = cid
+
+    # Then patch the tree
+    for p in removed:
+        log("removing", p)
+        api.call("files/rm", posixpath.join(mfs_root, p), recursive=True)
+    for d in sorted({posixpath.dirname(p) for p in removed}, key=len, reverse=True):
+        # Directories that no longer exist in the output
+        if d and not os.path.isdir(os.path.join(output_dir, d)) and api.exists(posixpath.join(mfs_root, d)):
+            api.call("files/rm", posixpath.join(mfs_root, d), recursive=True)
+    for p in changed:
+        log("adding", p)
+        dest = posixpath.join(mfs_root, p)
+        if posixpath.dirname(p):
+            api.call("files/mkdir", posixpath.dirname(dest), parents=True)
+        if incremental and p in previous:
+            api.call("files/rm", dest)
+        api.call("files/cp", "/ipfs/" + files[p]["cid"], dest)
+
+    api.call("files/flush", mfs_root)
+    root = api.call("files/stat", mfs_root)["Hash"]
+    api.call("pin/add", root)
+    log("%d files changed, %d removed, %d unchanged" %(len(changed), len(removed), len(files) - len(changed)))
+    if subtree is not None:
+        log("%s is %s" %(subtree, api.call("files/stat", posixpath.join(mfs_root, subtree))["Hash"]))
+        # The rest of the site is as the last publish left it
+        files = dict({p: f for p, f in previous.items() if not in_subtree(p, subtree)}, **files)
+    build_cache.write_atomic(manifest_path, json.dumps(
+        dict(root=root, files=files, changed=changed + removed), indent=1, sort_keys=True).encode())
+    return root
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    subtree = None
+    if args[:1] == ["--subsite"] and len(args) >= 2:
+        subtree = args[1].strip("/")
+        args = args[2:]
+    if len(args) != 2:
+        print("Usage: %s [--subsite <folder>] <output dir> <manifest>" %sys.argv[0])
+        sys.exit(1)
+    try:
+        print(publish(*args, subtree=subtree))
+    except (IpfsError, requests.ConnectionError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
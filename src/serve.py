@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+""" Development server: builds the site, serves the output, and rebuilds
+whatever an edit to pages/ or templates/ affects, reloading the browser.
+
+    ./serve.py [-j <jobs>] [port]
+
+The site is built once, as by build_site.py, but in this process (on a
+thread pool), so that the jinja environment, git index and caches stay warm
+between rebuilds. While building, the server notes what each target was
+built from: its prerequisites (including the srcdeps of pages) and every file
+its build step read (templates, other pages' .srcinfo/.build objects...; see
+build_cache.record_dep). Inverting that gives, for any edited file, exactly
+the targets it invalidates, which are rebuilt without re-checking the rest of
+the site. Pages whose runtime dependencies changed (e.g. a new image) have
+those published too.
+
+Sources are watched with inotify, or by polling their mtimes where inotify
+isn't available. Served html pages get a script that reloads them when a
+rebuild finishes (via server-sent events at RELOAD_PATH); the files in the
+output folder are left untouched.
+"""
+import asyncio, collections, concurrent.futures, ctypes, ctypes.util, functools, http.server, os, select, struct, sys, threading, time, traceback
+
+import build_cache, build_page, build_site
+from page_info import config, load_info
+
+DEFAULT_PORT = 8000
+WATCHED_DIRS = [build_site.PAGES_DIR, "templates"]
+# Wait this long after a change for others (e.g. an editor's save-to-temp-and-rename)
+DEBOUNCE = 0.05
+POLL_INTERVAL = 0.3
+RELOAD_PATH = "/__reload"
+RELOAD_SCRIPT = ('<script>new EventSource("%s").onmessage = function() { location.reload(); };</script>'
+    %RELOAD_PATH).encode()
+
+def is_ignored(path):
+    """Editors' swap & backup files"""
+    name = os.path.basename(path)
+    return name.startswith(".") or name.endswith("~")
+
+class InotifyWatcher(object):
+    """Reports the files changed under `dirs`, using Linux's inotify (via libc)"""
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_ISDIR = 0x100, 0x200, 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, dirs):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> directory
+        self.dirs = {}
+        for d in dirs:
+            self.watch_tree(d)
+
+    def watch_tree(self, root):
+        """Watch `root` and its subdirectories. Returns the files within them."""
+        files = set()
+        for dirpath, _dirnames, filenames in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "can't watch %s" %dirpath)
+            self.dirs[wd] = dirpath
+            files.update(os.path.join(dirpath, f) for f in filenames)
+        return files
+
+    def read_events(self):
+        changed = set()
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if wd not in self.dirs or not name:
+                continue
+            path = os.path.join(self.dirs[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                # A new (or moved in) directory may already hold files
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and os.path.isdir(path):
+                    changed |= self.watch_tree(path)
+            elif mask & self.IN_CREATE:
+                # Its content arrives with IN_CLOSE_WRITE
+                continue
+            else:
+                changed.add(path)
+        return changed
+
+    def changes(self):
+        """Wait for files to change, and return their paths"""
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            changed = self.read_events()
+            while select.select([self.fd], [], [], DEBOUNCE)[0]:
+                changed |= self.read_events()
+            changed = {p for p in changed if not is_ignored(p)}
+        return changed
+
+class PollingWatcher(object):
+    """Reports the files changed under `dirs`, by comparing their mtimes every POLL_INTERVAL"""
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root in self.dirs:
+            for dirpath, _dirnames, filenames in os.walk(root):
+                for f in filenames:
+                    path = os.path.join(dirpath, f)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def changes(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            snapshot = self.scan()
+            changed = {p for p in set(snapshot) | set(self.snapshot)
+                if snapshot.get(p) != self.snapshot.get(p) and not is_ignored(p)}
+            self.snapshot = snapshot
+            if changed:
+                return changed
+
+def get_watcher(dirs):
+    try:
+        return InotifyWatcher(dirs)
+    except (OSError, AttributeError, TypeError) as e:
+        # Not Linux, or out of inotify watches
+        print("inotify unavailable (%s); polling for changes" %e, file=sys.stderr)
+        return PollingWatcher(dirs)
+
+class DependencyIndex(object):
+    """What each target was built from, and its inverse: the targets built
+    from each file. Paths are absolute."""
+    def __init__(self):
+        # target -> prerequisites; target -> files read by its build step
+        self.prereqs = {}
+        self.recorded = {}
+        # file -> targets
+        self.rdeps = collections.defaultdict(set)
+
+    def _update(self, table, target, deps):
+        for d in self.prereqs.get(target, set()) | self.recorded.get(target, set()):
+            self.rdeps[d].discard(target)
+        table[target] = {os.path.abspath(d) for d in deps}
+        for d in self.prereqs.get(target, set()) | self.recorded.get(target, set()):
+            self.rdeps[d].add(target)
+
+    def set_prereqs(self, target, prereqs):
+        self._update(self.prereqs, target, prereqs)
+
+    def set_recorded(self, target, deps):
+        self._update(self.recorded, target, deps)
+
+    def invalidated(self, paths):
+        """Return the targets (transitively) built from any of `paths`"""
+        targets, stack = set(), [os.path.abspath(p) for p in paths]
+        while stack:
+            for t in self.rdeps.get(stack.pop(), ()):
+                if t not in targets:
+                    targets.add(t)
+                    stack.append(t)
+        return targets
+
+def run_recording(action, args):
+    """Run a build action, returning the files it read"""
+    with build_cache.recording() as deps:
+        build_site.run_action(action, args)
+    return deps
+
+class ServeBuilder(build_site.Builder):
+    """Builder running its actions on a thread pool, noting what each target
+    was built from in `index`. The `forced` targets are rebuilt even if
+    they're newer than their prerequisites."""
+    def __init__(self, executor, index, forced=()):
+        super().__init__(executor)
+        self.index = index
+        self.forced = set(forced)
+        self.rebuilt = set()
+
+    async def run(self, target, action, args):
+        loop = asyncio.get_running_loop()
+        deps = await loop.run_in_executor(self.executor, run_recording, action, args)
+        self.index.set_recorded(target, deps)
+        self.rebuilt.add(target)
+
+    def is_outdated(self, target, prereqs):
+        return target in self.forced or super().is_outdated(target, prereqs)
+
+    def update_index(self):
+        artifacts = build_page.get_artifact_cache()
+        for target, prereqs in self.prereqs.items():
+            self.index.set_prereqs(target, prereqs)
+            action, args = self.steps[target]
+            if action == "build_page" and target not in self.index.recorded:
+                # Up to date, so not run: what it read is in the artifact cache
+                deps = artifacts.get_deps(build_page.get_key(os.path.splitext(target)[1], args[0]))
+                if deps is not None:
+                    self.index.set_recorded(target, deps)
+
+class Reloads(object):
+    """Counts completed rebuilds, for the clients waiting on them"""
+    def __init__(self):
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """Wait until a rebuild newer than `generation`; return the latest"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == RELOAD_PATH:
+            return self.stream_reloads()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split("?")[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not path.endswith(".html") or not os.path.isfile(path):
+            return super().do_GET()
+        content = open(path, "rb").read()
+        end = content.rfind(b"</body>")
+        content = content[:end] + RELOAD_SCRIPT + content[end:] if end >= 0 else content + RELOAD_SCRIPT
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def stream_reloads(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        reloads = self.server.reloads
+        generation = reloads.generation
+        try:
+            while True:
+                latest = reloads.wait(generation, timeout=15)
+                # Comments keep the connection alive
+                self.wfile.write(b"data: reload\n\n" if latest != generation else b": idle\n\n")
+                self.wfile.flush()
+                generation = latest
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class DevServer(object):
+    def __init__(self, executor):
+        self.executor = executor
+        self.index = DependencyIndex()
+        self.root = os.path.join(config["build"]["intermediate"], build_site.DEFAULT_TARGET)
+        # page .build -> its rtdeps, as last published
+        self.rtdeps = {}
+
+    def build_all(self):
+        builder = ServeBuilder(self.executor, self.index)
+        try:
+            asyncio.run(builder.publish(self.root))
+        finally:
+            builder.update_index()
+        self.note_rtdeps(builder.prereqs)
+
+    def note_rtdeps(self, targets):
+        """Remember the rtdeps of the pages among `targets`; return the pages whose rtdeps changed"""
+        changed = []
+        for target in targets:
+            if not target.endswith(".build") or not os.path.exists(target):
+                continue
+            rtdeps = set(load_info(target)["rtdeps"])
+            if self.rtdeps.get(target) != rtdeps:
+                if target in self.rtdeps:
+                    changed.append(target[:-len(".build")])
+                self.rtdeps[target] = rtdeps
+        return changed
+
+    def rebuild(self, changed):
+        """Rebuild the targets invalidated by the `changed` files; return how many were run"""
+        targets = self.index.invalidated(changed)
+        if not targets:
+            return 0
+        builder = ServeBuilder(self.executor, self.index, forced=targets)
+        async def work():
+            await builder.ensure_all(sorted(targets))
+            # Publish what the rebuilt pages newly need at runtime
+            pages = self.note_rtdeps(builder.rebuilt)
+            await asyncio.gather(*(builder.publish(p) for p in pages))
+        try:
+            asyncio.run(work())
+        finally:
+            builder.update_index()
+        self.note_rtdeps(builder.rebuilt)
+        return len(builder.rebuilt)
+
+def serve(port, jobs):
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        dev = DevServer(executor)
+        start = time.time()
+        try:
+            dev.build_all()
+        except build_site.BuildError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print("built the site in %.2fs" %(time.time() - start), flush=True)
+
+        handler = functools.partial(Handler, directory=config["build"]["output"])
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        server.daemon_threads = True
+        server.reloads = Reloads()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("serving at http://127.0.0.1:%d/" %server.server_address[1], flush=True)
+
+        watcher = get_watcher(WATCHED_DIRS)
+        while True:
+            changed = watcher.changes()
+            start = time.time()
+            try:
+                count = dev.rebuild(changed)
+            except build_site.BuildError as e:
+                print(e, file=sys.stderr, flush=True)
+                continue
+            except Exception:
+                traceback.print_exc()
+                continue
+            if count:
+                server.reloads.notify()
+            print("%s: rebuilt %d targets in %.2fs" %(", ".join(sorted(changed)), count, time.time() - start), flush=True)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    jobs = os.cpu_count()
+    if args[:1] == ["-j"] and len(args) >= 2:
+        jobs = int(args[1])
+        args = args[2:]
+    if len(args) > 1 or any(a.startswith("-") for a in args):
+        print("Usage: %s [-j <jobs>] [port]" %sys.argv[0])
+        sys.exit(1)
+    try:
+        serve(int(args[0]) if args else DEFAULT_PORT, jobs)
+    except KeyboardInterrupt:
+        pass
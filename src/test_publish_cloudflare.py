@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+""" Tests of publish_cloudflare.py, against fake_cloudflare_api.py's stand-in API.
+
+    python3 -m unittest test_publish_cloudflare
+"""
+import contextlib, http.server, io, json, os, shutil, tempfile, threading, unittest
+from unittest import mock
+
+import fake_cloudflare_api, publish_cloudflare
+
+class RecordingCloudflare(fake_cloudflare_api.FakeCloudflare):
+    """FakeCloudflare, keeping a log of (method, path, data) of each call"""
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def run(self, method, path, params, data):
+        self.calls.append((method, path, data))
+        return super().run(method, path, params, data)
+
+class QuietHandler(fake_cloudflare_api.Handler):
+    def log_message(self, *args):
+        pass
+
+class PublishCloudflareTest(unittest.TestCase):
+    def setUp(self):
+        # Port 0: any free port
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+        self.server.cloudflare = self.cloudflare = RecordingCloudflare()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:%d%s" %(self.server.server_address[1], fake_cloudflare_api.PREFIX)
+        patcher = mock.patch.dict(os.environ, CLOUDFLARE_API=url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmp, "manifest.json")
+        self.ids = os.path.join(self.tmp, "ids.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def publish(self, ipfs_id, changed, refresh=False):
+        """Run publish_cloudflare.py's main, returning the API calls it made"""
+        with open(self.manifest, "w") as f:
+            json.dump(dict(root=ipfs_id, files={}, changed=changed), f)
+        self.cloudflare.calls = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            publish_cloudflare.main("key", ipfs_id, self.manifest, self.ids, refresh=refresh)
+        return self.cloudflare.calls
+
+    def get_zone_id(self, name):
+        return next(i for i, n in self.cloudflare.zones.items() if n == name)
+
+    def test_publish(self):
+        changed = ["post-%d/index.html" %i for i in range(40)] + ["css/global.css", "twi-dance/index.html"]
+        calls = self.publish("QmFirst", changed)
+
+        # Every record now points to the new root
+        puts = [c for c in calls if c[0] == "PUT"]
+        self.assertEqual(len(puts), sum(len(d) for d in publish_cloudflare.dnslink_subdomains.values()))
+        for record in self.cloudflare.records.values():
+            leaf = publish_cloudflare.dnslink_subdomains[self.cloudflare.zones[record["zone_id"]]][record["name"]]
+            self.assertEqual(record["content"], "dnslink=/ipfs/QmFirst" + leaf)
+
+        # Purges are POSTs of at most PURGE_BATCH urls, of the changed files only
+        purges = [c for c in calls if c[1].endswith("/purge_cache")]
+        self.assertTrue(purges)
+        purged = {}
+        for method, path, data in purges:
+            self.assertEqual(method, "POST")
+            self.assertLessEqual(len(data["files"]), publish_cloudflare.PURGE_BATCH)
+            purged.setdefault(path.split("/")[2], []).extend(data["files"])
+        # 41 pages, by their path and their folder, and a stylesheet: the
+        # root domain serves the subsites' folders too
+        self.assertEqual(len(purged[self.get_zone_id("mooooo.ooo")]), 83)
+        self.assertEqual(len([p for p in purges if self.get_zone_id("mooooo.ooo") in p[1]]), 3)
+        self.assertEqual(sorted(purged[self.get_zone_id("twi.dance")]), ["https://twi.dance/", "https://twi.dance/index.html"])
+        self.assertEqual(set(purged), {self.get_zone_id("mooooo.ooo"), self.get_zone_id("twi.dance")})
+
+    def test_unchanged_records_are_not_updated(self):
+        self.publish("QmFirst", ["index.html"])
+        # With the ids cached, an unchanged record costs no call at all
+        calls = self.publish("QmFirst", ["index.html"])
+        self.assertEqual([c for c in calls if c[0] != "POST"], [])
+        # Looked up again, the record's content is compared before PUTting it
+        calls = self.publish("QmFirst", ["index.html"], refresh=True)
+        self.assertTrue([c for c in calls if c[0] == "GET"])
+        self.assertEqual([c for c in calls if c[0] == "PUT"], [])
+        # A new root changes every record; with no file changed, nothing is purged
+        calls = self.publish("QmSecond", [])
+        self.assertEqual(len([c for c in calls if c[0] == "PUT"]), len(self.cloudflare.records))
+        self.assertEqual([c for c in calls if c[0] == "POST"], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+""" Tests of publish_ipfs.py, against fake_ipfs_api.py's stand-in daemon.
+
+    python3 -m unittest test_publish_ipfs
+"""
+import contextlib, http.server, io, json, os, shutil, tempfile, threading, unittest
+
+import fake_ipfs_api, publish_ipfs
+
+class QuietHandler(fake_ipfs_api.Handler):
+    def log_message(self, *args):
+        pass
+
+class PublishIpfsTest(unittest.TestCase):
+    def setUp(self):
+        # Port 0: any free port
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QuietHandler)
+        self.server.ipfs = self.ipfs = fake_ipfs_api.FakeIpfs()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api = publish_ipfs.IpfsApi("http://127.0.0.1:%d/api/v0" %self.server.server_address[1])
+        self.tmp = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp, "output")
+        self.manifest = os.path.join(self.tmp, "manifest.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        full = os.path.join(self.output, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as f:
+            f.write(content)
+
+    def publish(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            root = publish_ipfs.publish(self.output, self.manifest, api=self.api, mfs_root="/test-publish")
+        with open(self.manifest) as f:
+            return root, json.load(f)
+
+    def get_tree(self, cid):
+        """Return the directory `cid` as {path: content}"""
+        tree = {}
+        for name, child in self.ipfs.objects[cid].items():
+            obj = self.ipfs.objects[child]
+            if isinstance(obj, bytes):
+                tree[name] = obj
+            else:
+                tree.update({name + "/" + p: c for p, c in self.get_tree(child).items()})
+        return tree
+
+    def test_full_then_incremental(self):
+        self.write("index.html", b"home")
+        self.write("post/index.html", b"post")
+        self.write("post/image.png", b"png")
+        self.write("old/page.html", b"old")
+        root, manifest = self.publish()
+        self.assertEqual(self.get_tree(root), {"index.html": b"home", "post/index.html": b"post",
+            "post/image.png": b"png", "old/page.html": b"old"})
+        self.assertEqual(manifest["root"], root)
+        self.assertEqual(manifest["changed"], ["index.html", "old/page.html", "post/image.png", "post/index.html"])
+        self.assertIn(root, self.ipfs.pins)
+
+        # Edit a page, add one, and remove a folder
+        self.write("post/index.html", b"edited post")
+        self.write("new/index.html", b"new")
+        shutil.rmtree(os.path.join(self.output, "old"))
+        new_root, manifest = self.publish()
+        self.assertNotEqual(new_root, root)
+        self.assertEqual(self.get_tree(new_root), {"index.html": b"home", "post/index.html": b"edited post",
+            "post/image.png": b"png", "new/index.html": b"new"})
+        self.assertEqual(manifest["root"], new_root)
+        self.assertEqual(manifest["changed"], ["new/index.html", "post/index.html", "old/page.html"])
+        self.assertEqual(sorted(manifest["files"]), ["index.html", "new/index.html", "post/image.png", "post/index.html"])
+        self.assertEqual(self.ipfs.pins, {root, new_root})
+        # The MFS working copy is the new root
+        self.assertEqual(self.api.call("files/stat", "/test-publish")["Hash"], new_root)
+
+        # Nothing changed: same root, nothing to purge
+        same_root, manifest = self.publish()
+        self.assertEqual(same_root, new_root)
+        self.assertEqual(manifest["changed"], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+""" Enforces the startup budget of the build steps Make runs once per target
+(see bench.py --startup): each must import within bench.STARTUP_BUDGET, and
+without any of bench.HEAVY_MODULES.
+
+    python3 -m unittest test_startup
+"""
+import os, unittest
+
+import bench
+
+CONFIG_PATH = os.path.join(bench.SRC_DIR, "..", "build", "config.json")
+
+@unittest.skipUnless(os.path.exists(CONFIG_PATH), "build the config first: make ../build/config.json")
+class StartupTest(unittest.TestCase):
+    def test_startup_budget(self):
+        for module in bench.STARTUP_STEPS:
+            with self.subTest(module=module):
+                seconds, heavy = bench.time_startup(module, repeat=5)
+                self.assertEqual(heavy, [], "%s imports heavy modules" %module)
+                self.assertLessEqual(seconds, bench.STARTUP_BUDGET,
+                    "%s takes %.1fms to start" %(module, seconds * 1e3))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+""" Batched TeX -> SVG rendering.
+
+The `tex` filter used to spawn a tex2svg (node) process and a scour process
+for every equation. Instead, a small pool of long-lived MathJax workers
+(tex_worker.js) is kept running. Equations are queued and each worker takes
+them off the queue in batches; the resulting SVGs are then minified with
+scour's python module, in-process.
+
+Equations of a page are collected while the page renders (see PageEquations)
+and rendered concurrently once the render is done.
+
+If node/mathjax-node aren't available, this falls back to running tex2svg and
+scour once per equation, as before.
+"""
+import concurrent.futures, json, os, queue, re, subprocess, threading
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tex_worker.js")
+# Most equations a worker is sent at once
+BATCH_SIZE = 32
+NUM_WORKERS = min(4, os.cpu_count() or 1)
+
+SCOUR_ARGS = ["-q", "-p" "10",
+    "--strip-xml-prolog",
+    "--enable-comment-stripping",
+    "--enable-id-stripping",
+    "--create-groups",
+]
+
+def render_with_subprocess(tex):
+    """Render a single equation with the tex2svg and scour command-line tools"""
+    # Note: we prepend a space to fix bug in tex2svg when input is a number or starts with '-'
+    tex = subprocess.Popen(["tex2svg", "--inline", " " + tex], stdout=subprocess.PIPE)
+    res = subprocess.check_output(["scour"] + SCOUR_ARGS, stdin=tex.stdout)
+    return res.decode().strip()
+
+_scour_options = None
+
+def minify_svg(svg):
+    """Run scour over an svg (str), as the command-line `scour SCOUR_ARGS` would"""
+    global _scour_options
+    try:
+        from scour import scour
+    except ImportError:
+        return subprocess.check_output(["scour"] + SCOUR_ARGS, input=svg.encode()).decode().strip()
+    if _scour_options is None:
+        _scour_options = scour.parse_args(SCOUR_ARGS)
+    return scour.scourString(svg, _scour_options).strip()
+
+class WorkerUnavailable(Exception):
+    pass
+
+class TexRenderer(object):
+    """Pool of tex_worker.js processes fed from a shared queue"""
+    def __init__(self, num_workers=NUM_WORKERS):
+        self.queue = queue.Queue()
+        self.available = True
+        for _ in range(num_workers):
+            threading.Thread(target=self._run_worker, daemon=True).start()
+
+    def render(self, tex):
+        """Render `tex` to a minified inline svg (str). Blocks until done."""
+        if not self.available:
+            return render_with_subprocess(tex)
+        future = concurrent.futures.Future()
+        self.queue.put((tex, future))
+        try:
+            return future.result()
+        except WorkerUnavailable:
+            return render_with_subprocess(tex)
+
+    def _start_worker(self):
+        try:
+            return subprocess.Popen(["node", WORKER_SCRIPT],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        except FileNotFoundError:
+            return None
+
+    def _run_worker(self):
+        proc = self._start_worker()
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                if proc is None:
+                    raise WorkerUnavailable()
+                for i, (tex, _future) in enumerate(batch):
+                    proc.stdin.write(json.dumps(dict(id=i, math=tex)) + "\n")
+                proc.stdin.flush()
+                for _ in batch:
+                    line = proc.stdout.readline()
+                    if not line:
+                        raise WorkerUnavailable()
+                    response = json.loads(line)
+                    future = batch[response["id"]][1]
+                    # Errors are passed on as the result, for the caller to report
+                    future.set_result(response["error"] if "error" in response
+                        else minify_svg(response["svg"]))
+            except (WorkerUnavailable, BrokenPipeError):
+                # e.g. node or mathjax-node isn't installed
+                self.available = False
+                proc = None
+                for _tex, future in batch:
+                    if not future.done():
+                        future.set_exception(WorkerUnavailable())
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def get_renderer():
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = TexRenderer()
+        return _renderer
+
+class PageEquations(object):
+    """Collects the equations of a page while it renders.
+    The `tex` filter emits a placeholder for each equation; once the page is
+    rendered, substitute() renders all of the equations at once and swaps
+    them in.
+    """
+    PLACEHOLDER = re.compile("\0tex:([0-9]+)\0")
+
+    def __init__(self, render_one):
+        # Function rendering a single equation, e.g. a cached wrapper of
+        # get_renderer().render
+        self.render_one = render_one
+        self.equations = []
+
+    def placeholder(self, tex):
+        self.equations.append(tex)
+        return "\0tex:%d\0" %(len(self.equations) - 1)
+
+    def substitute(self, rendered):
+        if not self.equations:
+            return rendered
+        with concurrent.futures.ThreadPoolExecutor(BATCH_SIZE) as executor:
+            svgs = list(executor.map(self.render_one, self.equations))
+        return self.PLACEHOLDER.sub(lambda m: svgs[int(m.group(1))], rendered)
@@ -0,0 +1,24 @@
+// Long-lived MathJax worker used by tex_render.py.
+// Reads one JSON request per line from stdin: {"id": <n>, "math": "<tex>"}
+// and writes one JSON response per line to stdout: {"id": <n>, "svg": "<svg...>"}
+// or {"id": <n>, "error": "<message>"}. Responses may arrive out of order.
+// Requires mathjax-node (a dependency of tex-equation-to-svg; see Readme.md)
+var mjAPI = require("mathjax-node");
+var readline = require("readline");
+
+mjAPI.config({ MathJax: {} });
+mjAPI.start();
+
+var lines = readline.createInterface({ input: process.stdin });
+lines.on("line", function(line) {
+	var request = JSON.parse(line);
+	mjAPI.typeset({ math: request.math, format: "inline-TeX", svg: true }, function(data) {
+		var response = data.errors ?
+			{ id: request.id, error: data.errors.join("\n") } :
+			{ id: request.id, svg: data.svg };
+		process.stdout.write(JSON.stringify(response) + "\n");
+	});
+});
+lines.on("close", function() {
+	process.exit(0);
+});